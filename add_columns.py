@@ -11,27 +11,100 @@ schema.
  This must be run after the create_model.py script has been run, because this modifies
  the ERD created by that script.
  
- The expectation is this is run once. If it is run a second time, we expect errors
- indicating the columns already exist.
+ Only the columns that are missing from the live catalog are created (see schema_reconcile.py),
+ so running this a second time reports that there is nothing to do instead of failing.
+
+ Each metadata column also gets a controlled vocabulary: a vocabulary table of the same name
+ in the Vocab schema, and a <column>_Term foreign key column on Forecast that references the
+ row's term. populate_columns.py fills in the terms, and facets on the Term columns only
+ scan the small vocabulary tables.
+
+ The values hidden in the text fields are also added as typed columns (Sim_Start_Date,
+ Days_After, Magnitude, Rupture_Scale, No_Spont), which populate_columns.py derives from
+ the same names. Range filters such as "14 to 35 days after a M7 or larger event" then run
+ in the catalog against these columns instead of parsing every Forecast_Name on the client.
  
 Philip Maechling
 3 April 2021
 """
 import os
 import sys
+import argparse
 from deriva.core import DerivaServer, ErmrestCatalog, get_credential
 from deriva.chisel import Model, Schema, Table, Column, Key, ForeignKey, builtin_types, tag
+from model_cache import connect_catalog, load_model
+from schema_reconcile import plan_columns, plan_fkeys, plan_schema, print_plan, apply_changes
+from etas_vocab import VOCAB_SCHEMA, vocabulary_columns
+
+#
+# The metadata fields extracted from the ETAS directory names (see the notes in the main block)
+forecast_metadata_columns = [
+    Column.define('Sim_Start_Time',
+                  builtin_types.text,
+                  comment="Simulation Start Time"),
+
+    Column.define('Catalog_Mag',
+                  builtin_types.text,
+                  comment="Catalog Name and Event Magnitude"),
+
+    Column.define('Event_ID',
+                  builtin_types.text,
+                  comment="Earthquake Event ID"),
+
+    Column.define('Post_Event_Date',
+                  builtin_types.text,
+                  comment="Days Forecast made after Mainshock"),
+
+    Column.define('Rupture_Definition',
+                  builtin_types.text,
+                  comment="Type of Rupture used in ETAS forecast"),
+]
+
+vocabulary_table_defs = [
+    Table.define_vocabulary(column, 'SCEC:{RID}', comment="Terms of the Forecast {0} column".format(column))
+    for column in vocabulary_columns
+]
+
+#
+# The Term columns are nullable: an empty value (e.g. no Post_Event_Date) has no term
+term_column_defs = [
+    Column.define(term_column, builtin_types.ermrest_rid, comment="{0} term".format(column))
+    for column, term_column in vocabulary_columns.items()
+]
+
+#
+# Typed values derived from the text fields, see derive_typed_fields in populate_columns.py.
+# They are nullable: a name that does not carry a value (e.g. no Post_Event_Date) leaves it empty.
+typed_column_defs = [
+    Column.define('Sim_Start_Date', builtin_types.date,
+                  comment="Simulation start date, from Sim_Start_Time"),
+    Column.define('Days_After', builtin_types.int4,
+                  comment="Days the forecast was made after the mainshock, from Post_Event_Date"),
+    Column.define('Magnitude', builtin_types.float8,
+                  comment="Event magnitude, from Catalog_Mag"),
+    Column.define('Rupture_Scale', builtin_types.float8,
+                  comment="Rupture scale factor, from Rupture_Definition"),
+    Column.define('No_Spont', builtin_types.boolean,
+                  comment="Spontaneous events turned off (noSpont), from Rupture_Definition"),
+]
+
+term_fkey_defs = [
+    ForeignKey.define([term_column], VOCAB_SCHEMA, column, ['RID'])
+    for column, term_column in vocabulary_columns.items()
+]
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add the Forecast metadata columns and vocabularies to the ETAS schema")
+    parser.add_argument("--dry-run", action="store_true", help="print the changes without applying them")
+    args = parser.parse_args()
 
     # Connect to server and catalog ------------------------------------------------------------------#
 
     hostname = 'forecast.derivacloud.org'  # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
     catalog_id = '5'  # this was a throw-away catalog used to test this script (change to TBD)
 
-    model = Model.from_catalog(
-        DerivaServer('https', hostname, credentials=get_credential(hostname)).connect_ermrest(catalog_id)
-    )
+    catalog = connect_catalog(hostname, catalog_id)
+    model = load_model(catalog)   # cached locally, revalidated with one request
 
     #
     # During testing, exit before any table modifications are done
@@ -47,8 +120,8 @@ if __name__ == "__main__":
     Define a series of column names that reflect metadata we expect to extract from
     the ETAS directory names. These are initial names, defined by developers.
     ETAS modelers may want to rename these columns to be more meaningful to domain experts.
-    For this first version, all fields are defined as free text.
-    Redefinition of these values as controlled vocabularies are a future refinement.
+    The fields are defined as free text, and each one also has a controlled vocabulary
+    (vocabulary_table_defs above) that the Forecast <field>_Term columns reference.
     
     1) Sim_Start_Time: Enumeration List
     e.g: "2019_07_16"
@@ -73,25 +146,15 @@ if __name__ == "__main__":
     """
 
 
-    tabname.create_column(Column.define('Sim_Start_Time',
-                                        builtin_types.text,
-                                        comment="Simulation Start Time"))
-
-    tabname.create_column(Column.define('Catalog_Mag',
-                                        builtin_types.text,
-                                        comment="Catalog Name and Event Magnitude"))
-
-    tabname.create_column(Column.define('Event_ID',
-                                        builtin_types.text,
-                                        comment="Earthquake Event ID"))
-
-    tabname.create_column(Column.define('Post_Event_Date',
-                                        builtin_types.text,
-                                        comment="Days Forecast made after Mainshock"))
-
-    tabname.create_column(Column.define('Rupture_Definition',
-                                        builtin_types.text,
-                                        comment="Type of Rupture used in ETAS forecast"))
+    changes = plan_columns(tabname, forecast_metadata_columns, report_extra=False)
+    changes.extend(plan_columns(tabname, typed_column_defs, report_extra=False))
+    changes.extend(plan_schema(model, VOCAB_SCHEMA, vocabulary_table_defs))
+    changes.extend(plan_columns(tabname, term_column_defs, report_extra=False))
+    changes.extend(plan_fkeys(tabname, term_fkey_defs))
+    print_plan(changes)
+    if args.dry_run:
+        sys.exit(0)
+    apply_changes(changes)
 
     # retrieve catalog model again to ensure we reflect latest structural changes
     # example shows this, but I'm not sure what it returns
@@ -0,0 +1,113 @@
+"""annotation_apply.py: Send only the annotation and ACL changes a configuration script actually made.
+
+model.apply() PUTs the annotations, ACLs and ACL bindings of every schema, table, column, key and
+foreign key in the catalog, even when a script such as scec_config.py sets them to the values
+they already have. Here a hash of each element's annotations, ACLs and ACL bindings is taken
+from the live model before the script changes anything; afterwards only the elements whose
+hash changed are sent, each with one PUT per changed resource. A catalog that is already up to
+date costs no requests at all beyond loading the (cached) model.
+
+Typical use:
+    model = load_model(catalog)
+    baseline = element_hashes(model)
+    ... set annotations and acls on model ...
+    apply_changed(model, baseline)
+"""
+import json
+import hashlib
+from dataclasses import dataclass
+from deriva.core.ermrest_model import Model
+
+#
+# Per-element resources: attribute on the model element -> ERMrest sub-resource
+RESOURCES = {
+    "annotations": "/annotation",
+    "acls": "/acl",
+    "acl_bindings": "/acl_binding",
+}
+
+@dataclass
+class ApplyStats:
+    elements: int = 0
+    changed: int = 0
+    requests: int = 0
+
+    def report(self):
+        """
+        Print how many elements were sent and how many were skipped as unchanged
+        :return:
+        """
+        print("Sent {0} changed elements with {1} requests, skipped {2} of {3} elements as unchanged".format(
+            self.changed, self.requests, self.elements - self.changed, self.elements))
+
+def iter_elements(model):
+    """
+    :param model: Model
+    :return: generator of every annotatable element: the catalog, schemas, tables, columns, keys, fkeys
+    """
+    yield model
+    for schema in model.schemas.values():
+        yield schema
+        for table in schema.tables.values():
+            yield table
+            yield from table.columns
+            yield from table.keys
+            yield from table.foreign_keys
+
+def element_path(element):
+    """
+    :param element: model element
+    :return: URL path of the element, relative to the catalog
+    """
+    # Model.uri_path is "/schema", but the catalog-level resources are /annotation and /acl
+    return "" if isinstance(element, Model) else element.uri_path
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+def element_hashes(model):
+    """
+    Hash the annotations, ACLs and ACL bindings of every element of a model
+    :param model: Model, as loaded from the catalog
+    :return: dict of element path -> dict of resource attribute -> hash
+    """
+    hashes = {}
+    for element in iter_elements(model):
+        hashes[element_path(element)] = {attr: _digest(getattr(element, attr))
+                                    for attr in RESOURCES if hasattr(element, attr)}
+    return hashes
+
+def put_resource(element, attr):
+    """
+    Send one resource (annotations, acls or acl_bindings) of a model element to the server
+    :param element: model element
+    :param attr: one of RESOURCES
+    :return:
+    """
+    element.catalog.put(element_path(element) + RESOURCES[attr], json=getattr(element, attr))
+
+def put_annotations(element):
+    put_resource(element, "annotations")
+
+def apply_changed(model, baseline, stats=None):
+    """
+    Send the annotations, ACLs and ACL bindings of the elements that differ from the baseline
+    :param model: Model, with local changes
+    :param baseline: dict from element_hashes, taken before the changes
+    :param stats: ApplyStats to fill in, optional
+    :return: ApplyStats
+    """
+    if stats is None:
+        stats = ApplyStats()
+    for element in iter_elements(model):
+        stats.elements += 1
+        before = baseline.get(element_path(element), {})
+        changed = [attr for attr in RESOURCES
+                   if hasattr(element, attr) and before.get(attr) != _digest(getattr(element, attr))]
+        if not changed:
+            continue
+        stats.changed += 1
+        for attr in changed:
+            put_resource(element, attr)
+            stats.requests += 1
+    return stats
@@ -0,0 +1,99 @@
+"""async_catalog.py: asyncio access to an ERMrest catalog with bounded concurrency and pooled connections.
+
+deriva-py's client is synchronous, so a script waits for every page fetch, lookup and update
+before it sends the next one, and on a high latency link the round trip time sets the
+throughput. AsyncCatalog lets independent requests overlap: each request runs on a worker
+thread of a shared pool (run_in_executor), every worker thread keeps its own catalog
+connection (so its keep-alive connection is reused), and an asyncio semaphore bounds how
+many requests are in flight at once.
+
+Requests are made with plain ERMrest URLs through the same connect_catalog used by the
+synchronous scripts, so the SCEC_DERIVA_SERVER override and request instrumentation apply.
+
+Typical use:
+    async with AsyncCatalog(hostname, catalog_id, concurrency=16) as catalog:
+        snapshot = await catalog.snapshot()
+        pages = await asyncio.gather(*(snapshot.get_json(url) for url in urls))
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from model_cache import connect_catalog
+
+DEFAULT_CONCURRENCY = 8
+
+class AsyncCatalog:
+    """
+    Bounded, pooled asyncio front end for one catalog (or one snapshot of it)
+    """
+    def __init__(self, hostname, catalog_id, concurrency=DEFAULT_CONCURRENCY, executor=None, semaphore=None):
+        """
+        :param hostname:
+        :param catalog_id: catalog id, optionally with an @snapshot suffix
+        :param concurrency: maximum number of requests in flight
+        :param executor: shared thread pool (snapshots share their catalog's pool)
+        :param semaphore: shared concurrency bound (snapshots share their catalog's bound)
+        """
+        self.hostname = hostname
+        self.catalog_id = catalog_id
+        self.concurrency = concurrency
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=concurrency,
+                                                       thread_name_prefix="async-catalog")
+        self._semaphore = semaphore
+        self._local = threading.local()
+        self.requests = 0
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def _catalog(self):
+        catalog = getattr(self._local, "catalog", None)
+        if catalog is None:
+            catalog = self._local.catalog = connect_catalog(self.hostname, self.catalog_id)
+        return catalog
+
+    async def _call(self, method, url, **kwargs):
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            self.requests += 1
+            return await loop.run_in_executor(
+                self.executor, lambda: getattr(self._catalog(), method)(url, **kwargs))
+
+    async def get_json(self, url):
+        """
+        :param url: ERMrest URL below the catalog, e.g. /attribute/ETAS:Forecast/RID
+        :return: decoded JSON response
+        """
+        response = await self._call("get", url)
+        return response.json()
+
+    async def put_json(self, url, body):
+        response = await self._call("put", url, json=body)
+        return response.json()
+
+    async def post_json(self, url, body):
+        response = await self._call("post", url, json=body)
+        return response.json()
+
+    async def snapshot(self):
+        """
+        Pin the latest snapshot of the catalog
+        :return: AsyncCatalog for the snapshot, sharing this catalog's pool and bound
+        """
+        info = await self.get_json("/")
+        return AsyncCatalog(self.hostname, "{0}@{1}".format(self.catalog_id.split("@")[0], info["snaptime"]),
+                            self.concurrency, self.executor, self.semaphore)
+
+    def close(self):
+        if self._owns_executor:
+            self.executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
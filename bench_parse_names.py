@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+
+"""bench_parse_names.py: This script benchmarks the forecast name parser in populate_columns.py
+on large synthetic corpora of ETAS forecast directory names.
+
+The corpus covers every naming variant the extract_* methods handle:
+    2019_07_16-ComCatM7p1_ci38457511_7DaysAfter_ShakeMapSurfaces-noSpont-full_td-scale1.14
+    2019_08_31-ComCatM7p1_ci38457511_56DaysAfter_ShakeMapSurfaces
+    2019_09_04-ComCatM7p1_ci38457511_ShakeMapSurfaces
+    2019_09_04-ComCatM7p1_ci38457511_ShakeMapSurfaces-noSpont-full_td-scale1.14
+plus a fixed share of malformed names (no '-', the wrong number of '-' or '_' separated
+fields, an empty field), which must come back as errors.
+
+For each corpus size the script measures names/s and peak memory (tracemalloc) for
+single-name parsing (parse_forecast_name) and batch parsing (parse_forecast_names).
+Timing and memory are measured in separate passes, since tracing slows parsing down, and
+small corpora are timed over repeated passes (best of) to keep the rates stable.
+
+The results are compared with stored baselines; if a rate drops, or peak memory grows, by
+more than the tolerance, the run fails with exit status 1. The first run (or --update-baseline)
+records the baselines. Baselines are machine specific, so they are kept locally.
+
+Example:
+    python bench_parse_names.py --sizes 1000,10000,100000,1000000
+"""
+import gc
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from populate_columns import parse_forecast_name, parse_forecast_names, ForecastNameError
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+#
+# One name in this many is malformed
+DEFAULT_MALFORMED_EVERY = 100
+
+#
+# Allowed slowdown (or memory growth) relative to the baseline before the run fails
+DEFAULT_TOLERANCE = 0.20
+
+#
+# Small corpora are parsed repeatedly for at least this long, and the best rate is kept,
+# so that timer noise does not trip the tolerance
+MIN_TIME = 0.5
+
+DEFAULT_BASELINE_FILE = os.path.join(os.path.expanduser("~"), ".scec_deriva", "bench_parse_names.json")
+
+_RUPTURES = ["ShakeMapSurfaces", "ShakeMapSurfaces-noSpont-full_td-scale1.14",
+             "ShakeMapSurfaces-noSpont-full_td-scale1.0", "FiniteFault"]
+
+_MALFORMED = [
+    "{date}_ComCatM{mag}_{event}_{rupture}",                     # no '-' after the sim start time
+    "{date}-ComCatM{mag}_{event}-{rupture}",                     # wrong number of '-' fields
+    "{date}-ComCatM{mag}_{rupture}",                             # too few '_' fields
+    "{date}-ComCatM{mag}_{event}_7DaysAfter_extra_{rupture}",    # too many '_' fields
+    "{date}-ComCatM{mag}__{rupture}",                            # empty field
+]
+
+def synthetic_corpus(count, malformed_every=DEFAULT_MALFORMED_EVERY):
+    """
+    Generate distinct forecast directory names covering all of the naming variants
+    :param count: number of names
+    :param malformed_every: one name in this many is malformed, 0 for none
+    :return: generator of names
+    """
+    for i in range(count):
+        date = "20{0:02d}_{1:02d}_{2:02d}".format(19 + i % 7, 1 + i % 12, 1 + i % 28)
+        mag = "{0}p{1}".format(4 + i % 4, i % 10)
+        event = "ci{0:08d}".format(38457511 + i)
+        rupture = _RUPTURES[(i // 2) % len(_RUPTURES)]
+        if malformed_every and i % malformed_every == malformed_every - 1:
+            template = _MALFORMED[(i // malformed_every) % len(_MALFORMED)]
+            yield template.format(date=date, mag=mag, event=event, rupture=rupture)
+        elif i % 2:
+            yield "{0}-ComCatM{1}_{2}_{3}DaysAfter_{4}".format(date, mag, event, 7 * (1 + i % 10), rupture)
+        else:
+            yield "{0}-ComCatM{1}_{2}_{3}".format(date, mag, event, rupture)
+
+def expected_errors(count, malformed_every=DEFAULT_MALFORMED_EVERY):
+    """
+    :return: number of malformed names in synthetic_corpus(count, malformed_every)
+    """
+    return count // malformed_every if malformed_every else 0
+
+def parse_single(names):
+    """
+    Parse the names one call at a time
+    :param names: list of names
+    :return: (number parsed, number of errors)
+    """
+    parsed = 0
+    errors = 0
+    for name in names:
+        try:
+            parse_forecast_name(name)
+            parsed += 1
+        except ForecastNameError:
+            errors += 1
+    return parsed, errors
+
+def parse_batch(names):
+    """
+    Parse the names in one parse_forecast_names call
+    :param names: list of names
+    :return: (number parsed, number of errors)
+    """
+    column_metadata, errors = parse_forecast_names(names)
+    return len(column_metadata), len(errors)
+
+MODES = {"single": parse_single, "batch": parse_batch}
+
+def run_benchmark(size, modes=MODES, memory=True):
+    """
+    :param size: corpus size
+    :param modes: dict of mode name -> parse function
+    :param memory: also measure peak memory with tracemalloc
+    :return: dict of mode -> {"names_per_s": float, "peak_bytes": int or None}
+    """
+    names = list(synthetic_corpus(size))
+    want_errors = expected_errors(size)
+    results = {}
+    for mode, parse in modes.items():
+        best = None
+        total = 0.0
+        while total < MIN_TIME or best is None:
+            gc.collect()
+            gc.disable()   # as timeit does, so collections triggered by earlier passes do not add noise
+            start = time.perf_counter()
+            parsed, errors = parse(names)
+            elapsed = time.perf_counter() - start
+            gc.enable()
+            total += elapsed
+            best = elapsed if best is None else min(best, elapsed)
+        if errors != want_errors or parsed != size - want_errors:
+            raise RuntimeError("{0} parsing of {1} names: {2} parsed, {3} errors, expected {4} errors".format(
+                mode, size, parsed, errors, want_errors))
+        peak = None
+        if memory:
+            tracemalloc.start()
+            parse(names)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[mode] = {"names_per_s": size / best if best > 0 else float("inf"), "peak_bytes": peak}
+    return results
+
+def compare(results, baselines, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare benchmark results with the stored baselines
+    :param results: dict of "mode/size" -> result
+    :param baselines: dict of "mode/size" -> result
+    :param tolerance: allowed fractional regression
+    :return: list of regression messages (empty when everything is within tolerance)
+    """
+    regressions = []
+    for key, result in results.items():
+        baseline = baselines.get(key)
+        if baseline is None:
+            continue
+        if result["names_per_s"] < baseline["names_per_s"] * (1 - tolerance):
+            regressions.append("{0}: {1:.0f} names/s, baseline {2:.0f} names/s".format(
+                key, result["names_per_s"], baseline["names_per_s"]))
+        if result["peak_bytes"] is not None and baseline.get("peak_bytes") and \
+                result["peak_bytes"] > baseline["peak_bytes"] * (1 + tolerance):
+            regressions.append("{0}: peak {1} bytes, baseline {2} bytes".format(
+                key, result["peak_bytes"], baseline["peak_bytes"]))
+    return regressions
+
+def load_baselines(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_baselines(path, baselines):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark forecast name parsing on synthetic corpora")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="comma separated corpus sizes, up to 10000000 (default: %(default)s)")
+    parser.add_argument("--baseline-file", default=DEFAULT_BASELINE_FILE,
+                        help="stored baselines (default: %(default)s)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed fractional regression (default: %(default)s)")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the baselines")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    args = parser.parse_args()
+
+    results = {}
+    print("{0:>10} {1:>7} {2:>14} {3:>12}".format("names", "mode", "names/s", "peak MB"))
+    for size in [int(float(size)) for size in args.sizes.split(",")]:
+        for mode, result in run_benchmark(size, memory=not args.no_memory).items():
+            results["{0}/{1}".format(mode, size)] = result
+            peak = "-" if result["peak_bytes"] is None else "{0:.1f}".format(result["peak_bytes"] / (1024 * 1024))
+            print("{0:>10} {1:>7} {2:>14.0f} {3:>12}".format(size, mode, result["names_per_s"], peak))
+
+    baselines = load_baselines(args.baseline_file)
+    regressions = [] if args.update_baseline else compare(results, baselines, args.tolerance)
+    new_keys = [key for key in results if key not in baselines]
+    if args.update_baseline or new_keys:
+        for key in (results if args.update_baseline else new_keys):
+            baselines[key] = results[key]
+        save_baselines(args.baseline_file, baselines)
+        print("Stored baselines for {0} results in {1}".format(
+            len(results) if args.update_baseline else len(new_keys), args.baseline_file))
+
+    for message in regressions:
+        print("REGRESSION", message)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+
+"""bench_populate.py: This script benchmarks the populate pass of populate_columns.py, with the
+synchronous deriva-py client against the asyncio client (async_catalog.py) at several
+concurrency levels, on the local stand-in server of local_deriva.py.
+
+The stand-in is seeded with synthetic Forecast rows, and a latency (and optionally a
+bandwidth limit) is injected into every request to mimic the link to the forecast server.
+Before each run the metadata columns are cleared, so every run does the same work, and
+afterwards every row is checked to hold its parsed metadata.
+
+Example:
+    python bench_populate.py --forecasts 20000 --latency-ms 20 --concurrency 4,16
+"""
+import os
+import sys
+import shutil
+import asyncio
+import argparse
+import tempfile
+from local_deriva import LocalDeriva, load_etas_model
+from bench_parse_names import synthetic_corpus
+from model_cache import SERVER_ENV, connect_catalog, load_model
+from async_catalog import AsyncCatalog
+from populate_columns import METADATA_COLUMNS, DEFAULT_PAGE_SIZE, DEFAULT_BATCH_BYTES, \
+    populate, populate_async, parse_forecast_name
+
+FORECAST = ("ETAS", "Forecast")
+
+def reset_metadata(local_catalog):
+    """
+    Clear the metadata columns of every Forecast row in the stand-in
+    :param local_catalog: LocalCatalog
+    :return:
+    """
+    with local_catalog.lock:
+        for row in local_catalog.rows[FORECAST].values():
+            for column in METADATA_COLUMNS:
+                row[column] = None
+
+def check_metadata(local_catalog):
+    """
+    :param local_catalog: LocalCatalog
+    :return: number of Forecast rows whose metadata columns do not match their parsed name
+    """
+    wrong = 0
+    with local_catalog.lock:
+        for row in local_catalog.rows[FORECAST].values():
+            mdata = parse_forecast_name(row["Forecast_Name"])
+            if any(row[column] != getattr(mdata, field) for column, field in METADATA_COLUMNS.items()):
+                wrong += 1
+    return wrong
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the sync and asyncio populate paths on the local stand-in")
+    parser.add_argument("--forecasts", type=int, default=20000, help="Forecast rows (default: %(default)s)")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="latency per request (default: %(default)s)")
+    parser.add_argument("--bandwidth-mbit", type=float, default=0.0, help="bandwidth limit, 0 for unlimited")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE,
+                        help="Forecast rows fetched per request (default: %(default)s)")
+    parser.add_argument("--batch-bytes", type=int, default=DEFAULT_BATCH_BYTES,
+                        help="maximum size of one update request body (default: %(default)s)")
+    parser.add_argument("--concurrency", default="4,16",
+                        help="comma separated concurrency levels for the asyncio path (default: %(default)s)")
+    args = parser.parse_args()
+
+    hostname = 'localhost'   # replaced by the stand-in's address through SCEC_DERIVA_SERVER
+    catalog_id = '5'
+    bandwidth = args.bandwidth_mbit * 1000000 / 8 if args.bandwidth_mbit else None
+    cache_dir = tempfile.mkdtemp(prefix="bench_populate")
+    results = []
+    with LocalDeriva(latency=args.latency_ms / 1000.0, bandwidth=bandwidth) as server:
+        os.environ[SERVER_ENV] = server.url
+        local_catalog = server.catalog(catalog_id)
+        load_etas_model(local_catalog)
+        local_catalog.insert(FORECAST, [{"Forecast_Name": name} for name in
+                                        synthetic_corpus(args.forecasts, malformed_every=0)], {})
+        print("Seeded {0} Forecast rows, {1} ms latency per request".format(args.forecasts, args.latency_ms))
+
+        catalog = connect_catalog(hostname, catalog_id)
+        model = load_model(catalog, cache_dir)
+        reset_metadata(local_catalog)
+        stats, _ = populate(catalog, model, args.page_size, args.batch_bytes)
+        results.append(("sync", 1, stats, check_metadata(local_catalog)))
+
+        for concurrency in [int(level) for level in args.concurrency.split(",")]:
+            reset_metadata(local_catalog)
+
+            async def run():
+                async with AsyncCatalog(hostname, catalog_id, concurrency) as async_catalog:
+                    return await populate_async(async_catalog, args.page_size, args.batch_bytes)
+            stats, _ = asyncio.run(run())
+            results.append(("async", concurrency, stats, check_metadata(local_catalog)))
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    base = results[0][2].elapsed
+    print("{0:>6} {1:>11} {2:>9} {3:>12} {4:>9} {5:>8} {6:>6}".format(
+        "mode", "concurrency", "seconds", "rows/s", "updates", "speedup", "wrong"))
+    for mode, concurrency, stats, wrong in results:
+        print("{0:>6} {1:>11} {2:>9.3f} {3:>12.1f} {4:>9} {5:>7.2f}x {6:>6}".format(
+            mode, concurrency, stats.elapsed, stats.rows_checked / stats.elapsed, stats.requests,
+            base / stats.elapsed, wrong))
+
+    sys.exit(1 if any(wrong for _, _, _, wrong in results) else 0)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+
+"""check_upload_resume.py: This script checks the resumable chunked upload path of
+hatrac_upload.py on the local stand-in server of local_deriva.py.
+
+A file larger than the chunk threshold is uploaded as a chunked Hatrac upload job, the
+transfer is interrupted after a few chunks, and a second uploader (as a later run would,
+with a fresh state object read from the same state file) resumes it. The check passes when
+the resumed run only sends the chunks that were not confirmed, the state entry is removed
+once the job is finalized, and the stored object has the file's MD5.
+
+Example:
+    python check_upload_resume.py --size-mb 120 --interrupt-after 2
+"""
+import os
+import sys
+import hashlib
+import argparse
+import tempfile
+from local_deriva import LocalDeriva
+from model_cache import SERVER_ENV
+from checksum_cache import md5_file
+from hatrac_upload import HatracUploader, UploadJobState, UploadTask, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_THRESHOLD
+
+HATRAC_PATH = "/hatrac/ETAS/check_upload_resume/large.bin"
+
+def write_test_file(path, size, block=1024 * 1024):
+    """
+    Write size bytes of random data
+    :return:
+    """
+    with open(path, "wb") as f:
+        for offset in range(0, size, block):
+            f.write(os.urandom(min(block, size - offset)))
+
+def interrupt_after(uploader, chunks):
+    """
+    Make the uploader's store (for the calling thread) fail on the chunk after the given number
+    :param uploader: HatracUploader
+    :param chunks: chunks that go through before the failure
+    :return:
+    """
+    store = uploader._store()
+    put = store.put
+    sent = []
+
+    def interrupted_put(url, *args, **kwargs):
+        if ";upload/" in url:
+            if len(sent) >= chunks:
+                raise ConnectionError("transfer interrupted after {0} chunks".format(len(sent)))
+            sent.append(url)
+        return put(url, *args, **kwargs)
+    store.put = interrupted_put
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that an interrupted chunked upload resumes on the local stand-in")
+    parser.add_argument("--size-mb", type=int, default=120, help="size of the test file (default: %(default)s)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="chunk size in bytes (default: %(default)s)")
+    parser.add_argument("--chunk-threshold", type=int, default=DEFAULT_CHUNK_THRESHOLD,
+                        help="files at least this large are sent in chunks (default: %(default)s)")
+    parser.add_argument("--interrupt-after", type=int, default=2,
+                        help="chunks sent before the transfer is interrupted (default: %(default)s)")
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    if size < args.chunk_threshold:
+        parser.error("--size-mb must be at least the chunk threshold")
+    workdir = tempfile.mkdtemp(prefix="check_upload_resume")
+    local_path = os.path.join(workdir, "large.bin")
+    state_file = os.path.join(workdir, "upload_jobs.json")
+    write_test_file(local_path, size)
+    md5, _ = md5_file(local_path)
+    task = UploadTask("large.bin", local_path, HATRAC_PATH, size, md5)
+
+    failures = []
+    with LocalDeriva() as server:
+        os.environ[SERVER_ENV] = server.url
+
+        # First run: interrupted after a few chunks, no retries
+        first = HatracUploader("localhost", 1, args.chunk_size, args.chunk_threshold, 0, UploadJobState(state_file))
+        interrupt_after(first, args.interrupt_after)
+        try:
+            first.upload_one(task)
+            failures.append("the first upload was not interrupted")
+        except ConnectionError as err:
+            print("First run: {0}, {1} bytes sent".format(err, first.stats.bytes_sent))
+        job = UploadJobState(state_file).get(HATRAC_PATH)
+        if job is None or job["confirmed"] != args.interrupt_after:
+            failures.append("state file does not record {0} confirmed chunks: {1}".format(args.interrupt_after, job))
+        chunk_size = job["chunk_size"] if job else args.chunk_size
+
+        # Second run: a new uploader reads the state file and resumes the job
+        second = HatracUploader("localhost", 1, args.chunk_size, args.chunk_threshold, 0, UploadJobState(state_file))
+        url = second.upload_one(task)
+        print("Second run: {0}, {1} bytes sent, {2} chunks skipped".format(url, second.stats.bytes_sent,
+                                                                          second.stats.resumed_chunks))
+        if second.stats.resumed_chunks != args.interrupt_after:
+            failures.append("resumed run skipped {0} chunks, expected {1}".format(second.stats.resumed_chunks,
+                                                                                 args.interrupt_after))
+        if second.stats.bytes_sent != size - args.interrupt_after * chunk_size:
+            failures.append("resumed run sent {0} bytes, expected {1}".format(
+                second.stats.bytes_sent, size - args.interrupt_after * chunk_size))
+        if UploadJobState(state_file).get(HATRAC_PATH) is not None:
+            failures.append("state entry was not removed after the job was finalized")
+        _, data, _, _ = server.hatrac._find(url)
+        if hashlib.md5(data).hexdigest() != md5:
+            failures.append("stored object does not match the file's MD5")
+
+    os.remove(local_path)
+    for failure in failures:
+        print("FAILED:", failure)
+    print("Chunked upload resume check {0}".format("failed" if failures else "passed"))
+    sys.exit(1 if failures else 0)
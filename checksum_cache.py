@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+
+"""checksum_cache.py: This script computes the MD5 checksums that the bulk upload asset
+mappings ask for (checksum_types: ["md5"]) and that the hatrac url_patterns embed (md5_hex).
+
+Files are hashed in parallel with large buffered reads. hashlib releases the GIL while it
+hashes large buffers, so a pool of threads keeps several cores busy without the cost of
+copying file data between processes.
+
+Results are kept in a persistent SQLite cache keyed by (device, inode, size, mtime_ns),
+so a file that has not changed since the last run is never hashed again, however many
+times an upload is retried. Cache hits, misses and the hashing rate in MB/s are reported.
+"""
+import os
+import sys
+import time
+import base64
+import sqlite3
+import hashlib
+import argparse
+import threading
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from forecast_scanner import read_manifest
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".scec_deriva", "checksums.sqlite")
+
+DEFAULT_WORKERS = os.cpu_count() or 4
+
+#
+# Size of the buffer each hashing thread reads into
+READ_BUFFER_BYTES = 8 * 1024 * 1024
+
+# read buffers are allocated once per hashing thread and reused for every file
+_buffers = threading.local()
+
+@dataclass
+class ChecksumStats:
+    hits: int = 0
+    misses: int = 0
+    bytes_hashed: int = 0
+    hash_time: float = 0.0
+
+    def report(self):
+        """
+        Print a one line summary of the cache hits and the hashing rate
+        :return:
+        """
+        mb = self.bytes_hashed / (1024 * 1024)
+        rate = mb / self.hash_time if self.hash_time > 0 else 0.0
+        print("Checksums: {0} cache hits, {1} misses, {2:.1f} MB hashed in {3:.3f} s ({4:.1f} MB/s)".format(
+            self.hits, self.misses, mb, self.hash_time, rate))
+
+def md5_file(path, buffer_size=READ_BUFFER_BYTES):
+    """
+    Compute the MD5 of one file
+    :param path:
+    :param buffer_size: size of each read
+    :return: tuple of (md5 hex digest, number of bytes read)
+    """
+    md5 = hashlib.md5()
+    buf = getattr(_buffers, "buf", None)
+    if buf is None or len(buf) != buffer_size:
+        buf = _buffers.buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    total = 0
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            md5.update(view[:n])
+            total += n
+    return md5.hexdigest(), total
+
+def md5_hex_to_base64(md5_hex):
+    """
+    Convert a hex MD5 to the base64 form used in Content-MD5 headers
+    :param md5_hex:
+    :return: string
+    """
+    return base64.b64encode(bytes.fromhex(md5_hex)).decode("ascii")
+
+class ChecksumCache:
+    """
+    Persistent MD5 cache. An entry is only used while the file's device, inode, size and
+    mtime_ns all still match, so any change to the file forces it to be hashed again.
+    """
+    def __init__(self, path=DEFAULT_CACHE_FILE, workers=DEFAULT_WORKERS):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS checksums ("
+                        "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, md5 TEXT, "
+                        "PRIMARY KEY (dev, ino))")
+        self.workers = workers
+        self.stats = ChecksumStats()
+
+    def close(self):
+        self.db.close()
+
+    def _lookup(self, st):
+        row = self.db.execute("SELECT md5 FROM checksums WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+                              (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def checksum_files(self, paths):
+        """
+        Return the MD5 of every file, hashing in parallel only the files the cache does not know
+        :param paths: iterable of file paths
+        :return: dict of path -> md5 hex digest
+        """
+        result = {}
+        todo = []
+        for path in paths:
+            st = os.stat(path)
+            md5 = self._lookup(st)
+            if md5 is not None:
+                self.stats.hits += 1
+                result[path] = md5
+            else:
+                todo.append((path, st))
+        self.stats.misses += len(todo)
+        if not todo:
+            return result
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            hashed = list(executor.map(lambda item: md5_file(item[0]), todo))
+        self.stats.hash_time += time.perf_counter() - start
+
+        rows = []
+        for (path, st), (md5, nbytes) in zip(todo, hashed):
+            result[path] = md5
+            self.stats.bytes_hashed += nbytes
+            rows.append((st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, md5))
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)", rows)
+        return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute (cached) MD5 checksums of upload files")
+    parser.add_argument("paths", nargs="*", help="files to checksum")
+    parser.add_argument("--manifest", help="checksum every file in a forecast_scanner.py manifest")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_FILE, help="checksum cache file (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of hashing threads (default: %(default)s)")
+    parser.add_argument("--list", action="store_true", help="print the checksum of every file")
+    args = parser.parse_args()
+
+    paths = list(args.paths)
+    if args.manifest:
+        root, records = read_manifest(args.manifest)
+        paths.extend(os.path.join(root, rec.path) for rec in records)
+
+    cache = ChecksumCache(args.cache, args.workers)
+    checksums = cache.checksum_files(paths)
+    cache.close()
+
+    if args.list:
+        for path in paths:
+            print(checksums[path], path)
+    cache.stats.report()
+
+    sys.exit(0)
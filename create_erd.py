@@ -3,31 +3,40 @@ Developer: Robert Schuler
 Modifications: Philip Maechling
 """
 """Minimal example of a possible rendering of the ETAS starter model.
+
+The tables are created in the ETAS_ERD schema, apart from the ETAS schema of scec_model.py. This
+script also replaces the catalog's bulk upload annotation with one for the ETAS_ERD tables, so run
+it against a sandbox catalog, not the one scec_model.py and scec_config.py set up.
 """
-from deriva.core import DerivaServer, get_credential
+import sys
+import argparse
 from deriva.chisel import Model, Schema, Table, Column, Key, ForeignKey, builtin_types, tag
+from model_cache import connect_catalog, load_model
+from schema_reconcile import plan_schema, print_plan, apply_changes
+
+parser = argparse.ArgumentParser(description="Create or update the ETAS ERD tables to match the definitions below")
+parser.add_argument("--dry-run", action="store_true", help="print the changes without applying them")
+args = parser.parse_args()
 
 # Connect to server and catalog ------------------------------------------------------------------#
 
 hostname = 'forecast.derivacloud.org'   # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
 catalog_id = '5'            # this was a throw-away catalog used to test this script (change to TBD)
 
-model = Model.from_catalog(
-    DerivaServer('https', hostname, credentials=get_credential(hostname)).connect_ermrest(catalog_id)
-)
-
-
-# Cleanup ----------------------------------------------------------------------------------------#
+catalog = connect_catalog(hostname, catalog_id)
+model = load_model(catalog)   # cached locally, revalidated with one request
 
-if 'ETAS' in model.schemas:
-    # Purge anything so we can "do over" repeatedly at this point
-    model.schemas['ETAS'].drop(cascade=True)
 
+# ETAS ERD schema --------------------------------------------------------------------------------#
 
-# ETAS schema ------------------------------------------------------------------------------------#
+# The ERD tables live in their own schema. scec_model.py owns the "ETAS" schema (Forecast,
+# Evaluation_Group, ...), and both scripts reconcile instead of dropping, so sharing it would leave
+# the ETAS_* tables next to the ones scec_model.py defines.
+ERD_SCHEMA = 'ETAS_ERD'
 
-# Create the "schema" to organize tables in the catalog "model"
-model.create_schema(Schema.define('ETAS'))
+# Desired state of the ERD schema that organizes the tables in the catalog "model". The live
+# catalog is reconciled against these definitions below, instead of being dropped and recreated.
+etas_table_defs = []
 
 
 # ETAS Forecast ----------------------------------------------------------------------------------#
@@ -35,7 +44,7 @@ model.create_schema(Schema.define('ETAS'))
 # Create the tables at the "Forecast" level of the table hierarchy
 
 # ETAS_Forecast
-model.schemas['ETAS'].create_table(Table.define(  # <--- 'Table.define(...)' defines a general-purpose table
+etas_table_defs.append(Table.define(  # <--- 'Table.define(...)' defines a general-purpose table
     'ETAS_Forecast',                                                        # table name
     column_defs=[                                                           # column definitions
         Column.define('Forecast_Name', builtin_types.text, nullok=False),   # column for the name of the forecast
@@ -54,15 +63,15 @@ model.schemas['ETAS'].create_table(Table.define(  # <--- 'Table.define(...)' def
 
 # ETAS_Forecast_File
 #  This is for storing the 'forecast_config.json', 'slurm_log', 'slurm_stdout', and 'slurm_stderr'
-model.schemas['ETAS'].create_table(Table.define_asset(  # <--- 'Table.define_asset(...)' defines a table for storing files
-    'ETAS', 'ETAS_Forecast_File',                                           # schema_name, table_name
+etas_table_defs.append(Table.define_asset(  # <--- 'Table.define_asset(...)' defines a table for storing files
+    ERD_SCHEMA, 'ETAS_Forecast_File',                                       # schema_name, table_name
     column_defs=[                                                           # column definitions
         Column.define('ETAS_Forecast', builtin_types.ermrest_rid)           # a key we will use as fkey column
     ],
     fkey_defs=[                                                             # foreign key definitions
         ForeignKey.define(                                                  # this FKey will reference ETAS_Forecast row
             ['ETAS_Forecast'],                                              # fkey columns: list of 1+ column(s) from this table
-            'ETAS', 'ETAS_Forecast', ['RID']                                # referenced key: schema name, table name, and list of 1+ key columns
+            ERD_SCHEMA, 'ETAS_Forecast', ['RID']                            # referenced key: schema name, table name, and list of 1+ key columns
         )
     ]
 ))
@@ -71,7 +80,7 @@ model.schemas['ETAS'].create_table(Table.define_asset(  # <--- 'Table.define_ass
 # Create the tables at the "Evaluation" level of the table hierarchy
 # ETAS_Evaluation
 
-model.schemas['ETAS'].create_table(Table.define(
+etas_table_defs.append(Table.define(
     'ETAS_Evaluation',
     column_defs=[
         Column.define('Evaluation_Description', builtin_types.text),        # free-text description
@@ -104,7 +113,7 @@ model.schemas['ETAS'].create_table(Table.define(
     fkey_defs=[
         ForeignKey.define(  # this FKey will reference the ETAS_Forecast table
             ['ETAS_Forecast'],                                              # foreign key column (list allows 1+)
-            'ETAS', 'ETAS_Forecast', ['RID']                                # referenced schema, table, columns
+            ERD_SCHEMA, 'ETAS_Forecast', ['RID']                            # referenced schema, table, columns
         )
     ]
 ))
@@ -112,15 +121,15 @@ model.schemas['ETAS'].create_table(Table.define(
 
 # # ETAS_Evaluation_File
 # #  This is to store the readme.md, meta.json, config.json, evaluation_catalog.json files (one file reference per row)
-# model.schemas['ETAS'].create_table(Table.define_asset(
-#     'ETAS', 'ETAS_Evaluation_File',
+# model.schemas[ERD_SCHEMA].create_table(Table.define_asset(
+#     ERD_SCHEMA, 'ETAS_Evaluation_File',
 #     column_defs=[
 #         Column.define('ETAS_Evaluation', builtin_types.ermrest_rid)         # foreign key column
 #     ],
 #     fkey_defs=[
 #         ForeignKey.define(  # This FKey will reference the ETAS_Evaluation table
 #             ['ETAS_Evaluation'],
-#             'ETAS', 'ETAS_Evaluation', ['RID']
+#             ERD_SCHEMA, 'ETAS_Evaluation', ['RID']
 #         )
 #     ]
 # ))
@@ -128,8 +137,8 @@ model.schemas['ETAS'].create_table(Table.define(
 
 # ETAS_Evaluation_Result
 #  This is for storing the result files (one file reference per row)
-model.schemas['ETAS'].create_table(Table.define_asset(
-    'ETAS', 'ETAS_Evaluation_Result',
+etas_table_defs.append(Table.define_asset(
+    ERD_SCHEMA, 'ETAS_Evaluation_Result',
     column_defs=[
         Column.define('ETAS_Evaluation', builtin_types.ermrest_rid),        # foreign key columns
         Column.define('Evaluation_Type', builtin_types.text)                # type of the evaluation
@@ -137,7 +146,7 @@ model.schemas['ETAS'].create_table(Table.define_asset(
     fkey_defs=[
         ForeignKey.define(  # This FKey will reference the ETAS_Evaluation table
             ['ETAS_Evaluation'],
-            'ETAS', 'ETAS_Evaluation', ['RID']
+            ERD_SCHEMA, 'ETAS_Evaluation', ['RID']
         )
     ]
 ))
@@ -145,20 +154,30 @@ model.schemas['ETAS'].create_table(Table.define_asset(
 
 # ETAS_Evaluation_Plot
 #  This is for storing the plot files (one file reference per row)
-model.schemas['ETAS'].create_table(Table.define_asset(
-    'ETAS', 'ETAS_Evaluation_Plot',
+etas_table_defs.append(Table.define_asset(
+    ERD_SCHEMA, 'ETAS_Evaluation_Plot',
     column_defs=[
         Column.define('ETAS_Evaluation_Result', builtin_types.ermrest_rid), # foreign key column
     ],
     fkey_defs=[
         ForeignKey.define(  # This FKey will reference the ETAS_Evaluation_Result table
             ['ETAS_Evaluation_Result'],
-            'ETAS', 'ETAS_Evaluation_Result', ['RID']
+            ERD_SCHEMA, 'ETAS_Evaluation_Result', ['RID']
         )
     ]
 ))
 
 
+# Reconcile --------------------------------------------------------------------------------------#
+
+# Only the missing tables, columns, keys and fkeys are created; existing rows are kept
+changes = plan_schema(model, ERD_SCHEMA, etas_table_defs)
+print_plan(changes)
+if args.dry_run:
+    sys.exit(0)
+apply_changes(changes)
+
+
 # Bulk Upload Annotation --------------------------------------------------------------------------#
 
 # NOTE: this is not really intended for you to absorb right not. This is one of the most complicated
@@ -174,7 +193,7 @@ model.annotations[tag.bulk_upload] = {
             },
             "file_pattern": "^.*/(?P<forecast_name>[^/]+)/config.json$",
             "target_table": [
-                "ETAS",
+                ERD_SCHEMA,
                 "ETAS_Forecast"
             ],
             "checksum_types": [
@@ -199,7 +218,7 @@ model.annotations[tag.bulk_upload] = {
             },
             "file_pattern": "^.*/(?P<forecast_name>[^/]+)/[^/]+[.](?P<ext>bin|slurm|slurm[.]e.*|slurm[.]o.*)$",
             "target_table": [
-                "ETAS",
+                ERD_SCHEMA,
                 "ETAS_Forecast_File"
             ],
             "checksum_types": [
@@ -213,7 +232,7 @@ model.annotations[tag.bulk_upload] = {
             },
             "record_query_template": "/entity/{target_table}/URL={URI_urlencoded}",
             "metadata_query_templates": [
-                "/attribute/ETAS:ETAS_Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1"
+                "/attribute/" + ERD_SCHEMA + ":ETAS_Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1"
             ],
             "create_record_before_upload": "False"
         }
@@ -237,6 +256,6 @@ model.apply()  # this applies the annotation change(s)
 # -----------------------------------------------------------------------------------------------#
 
 print('Congratulations! You have created a DERIVA catalog model.')
-print('https://{hostname}/chaise/recordset/#{catalog_id}/ETAS:ETAS_Forecast'.format(hostname=hostname, catalog_id=catalog_id))
+print('https://{hostname}/chaise/recordset/#{catalog_id}/{schema}:ETAS_Forecast'.format(hostname=hostname, catalog_id=catalog_id, schema=ERD_SCHEMA))
 """
 """
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+
+"""etas_mirror.py: This script keeps a local SQLite mirror of the ETAS tables (Forecast,
+Forecast_File, Evaluation_Group, Evaluation, Evaluation_Plot, ...), so that tools which ask
+many questions such as Forecast_Name -> RID or Evaluation_Group_Name -> RID can answer them
+locally, and only send their writes to the server.
+
+The SQLite tables follow the catalog model: one column per catalog column, RID as the
+primary key, and an index on every key and foreign key column. The first sync loads every
+row; later syncs read the catalog from a pinned snapshot and only fetch
+    - the rows whose RMT is newer than the newest RMT seen by the last sync, and
+    - the list of RIDs (RIDs only), to find the rows deleted since the last sync.
+When a table's columns change in the catalog, that table is reloaded.
+
+The mirror is a read cache: it is as current as its last sync, so sync before a batch of
+lookups (python etas_mirror.py, or EtasMirror.sync), and use the server for anything that
+must see concurrent changes.
+
+The default database is ~/.scec_deriva/etas_mirror/<hostname>_<catalog>.sqlite.
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from deriva.core import urlquote
+from model_cache import connect_catalog, load_model_doc
+
+DEFAULT_MIRROR_DIR = os.path.join(os.path.expanduser("~"), ".scec_deriva", "etas_mirror")
+
+MIRROR_SCHEMA = "ETAS"
+
+#
+# Rows fetched per request for changed rows, and RIDs per request for the deletion check
+DEFAULT_PAGE_SIZE = 5000
+RID_LIST_SIZE = 100000
+
+#
+# Rows per lookup query, below SQLite's limit on bound parameters
+LOOKUP_CHUNK = 500
+
+_INTEGER_TYPES = {"int2", "int4", "int8", "serial2", "serial4", "serial8", "boolean"}
+_REAL_TYPES = {"float4", "float8", "numeric"}
+
+def default_mirror_path(hostname, catalog_id):
+    return os.path.join(DEFAULT_MIRROR_DIR, "{0}_{1}.sqlite".format(hostname, catalog_id))
+
+def _quote(name):
+    return '"{0}"'.format(name.replace('"', '""'))
+
+def _affinity(typename):
+    if typename in _INTEGER_TYPES:
+        return "INTEGER"
+    if typename in _REAL_TYPES:
+        return "REAL"
+    return "TEXT"
+
+def _sqlite_value(value):
+    # json/jsonb values are kept as their JSON text
+    return json.dumps(value) if isinstance(value, (dict, list)) else value
+
+class EtasMirror:
+    """
+    Local SQLite copy of the tables of one catalog schema
+    """
+    def __init__(self, path, schema_name=MIRROR_SCHEMA):
+        """
+        :param path: SQLite database file, created if missing
+        :param schema_name: catalog schema to mirror
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.schema_name = schema_name
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS _mirror_state (table_name TEXT PRIMARY KEY, "
+                        "columns TEXT, watermark TEXT, snaptime TEXT, synced REAL)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def state(self, table_name):
+        """
+        :return: (column list, watermark, snaptime) recorded by the last sync, or None
+        """
+        row = self.db.execute("SELECT columns, watermark, snaptime FROM _mirror_state WHERE table_name=?",
+                              (table_name,)).fetchone()
+        return (json.loads(row[0]), row[1], row[2]) if row else None
+
+    def has_table(self, table_name):
+        return self.state(table_name) is not None
+
+    def _create_table(self, table_doc):
+        name = table_doc["table_name"]
+        columns = [column["name"] for column in table_doc["column_definitions"]]
+        self.db.execute("DROP TABLE IF EXISTS {0}".format(_quote(name)))
+        self.db.execute("CREATE TABLE {0} ({1})".format(_quote(name), ", ".join(
+            "{0} {1}{2}".format(_quote(column["name"]), _affinity(column["type"]["typename"]),
+                                " PRIMARY KEY" if column["name"] == "RID" else "")
+            for column in table_doc["column_definitions"])))
+        indexed = set()
+        for key in table_doc.get("keys", []):
+            indexed.add(tuple(key["unique_columns"]))
+        for fkey in table_doc.get("foreign_keys", []):
+            indexed.add(tuple(column["column_name"] for column in fkey["foreign_key_columns"]))
+        indexed.add(("RMT",))
+        for key_columns in sorted(indexed):
+            if key_columns == ("RID",) or not set(key_columns) <= set(columns):
+                continue
+            self.db.execute("CREATE INDEX {0} ON {1} ({2})".format(
+                _quote("{0}__{1}".format(name, "_".join(key_columns))), _quote(name),
+                ", ".join(_quote(column) for column in key_columns)))
+        return columns
+
+    def _upsert(self, table_name, columns, rows):
+        self.db.executemany("INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})".format(
+            _quote(table_name), ", ".join(_quote(column) for column in columns), ", ".join("?" * len(columns))),
+            [[_sqlite_value(row.get(column)) for column in columns] for row in rows])
+
+    def sync_table(self, snapshot, snaptime, table_doc, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Bring one table up to date with a pinned snapshot
+        :param snapshot: ErmrestSnapshot
+        :param snaptime: the snapshot's id
+        :param table_doc: table document from the catalog model
+        :param page_size: rows fetched per request
+        :return: dict with the counts of "fetched" and "deleted" rows, and "reloaded"
+        """
+        name = table_doc["table_name"]
+        columns = [column["name"] for column in table_doc["column_definitions"]]
+        previous = self.state(name)
+        watermark = None
+        reloaded = previous is None or previous[0] != columns
+        if reloaded:
+            self._create_table(table_doc)
+        else:
+            watermark = previous[1]
+            if previous[2] == snaptime:
+                return {"fetched": 0, "deleted": 0, "reloaded": False}
+
+        rows = snapshot.get("/aggregate/{0}:{1}/max_rmt:=max(RMT)".format(
+            urlquote(self.schema_name), urlquote(name))).json()
+        new_watermark = rows[0]["max_rmt"] if rows else None
+
+        base = "/entity/{0}:{1}".format(urlquote(self.schema_name), urlquote(name))
+        if watermark is not None:
+            base += "/RMT::gt::{0}".format(urlquote(watermark))
+        fetched = 0
+        for page in _iter_keyset(snapshot, base, page_size):
+            self._upsert(name, columns, page)
+            fetched += len(page)
+
+        deleted = 0
+        if not reloaded:
+            # rows deleted from the catalog leave no RMT behind, so compare the RID lists
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS _live_rids (RID TEXT PRIMARY KEY)")
+            self.db.execute("DELETE FROM _live_rids")
+            rid_url = "/attribute/{0}:{1}/RID".format(urlquote(self.schema_name), urlquote(name))
+            for page in _iter_keyset(snapshot, rid_url, RID_LIST_SIZE):
+                self.db.executemany("INSERT INTO _live_rids VALUES (?)", [(row["RID"],) for row in page])
+            deleted = self.db.execute("DELETE FROM {0} WHERE RID NOT IN (SELECT RID FROM _live_rids)".format(
+                _quote(name))).rowcount
+            self.db.execute("DELETE FROM _live_rids")
+
+        self.db.execute("INSERT OR REPLACE INTO _mirror_state VALUES (?, ?, ?, ?, ?)",
+                        (name, json.dumps(columns), new_watermark if new_watermark is not None else watermark,
+                         snaptime, time.time()))
+        self.db.commit()
+        return {"fetched": fetched, "deleted": deleted, "reloaded": reloaded}
+
+    def sync(self, catalog, tables=None, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Bring the mirror up to date with the latest snapshot of the catalog
+        :param catalog: ErmrestCatalog
+        :param tables: table names to sync, None for every table of the schema
+        :param page_size: rows fetched per request
+        :return: dict of table name -> counts from sync_table
+        """
+        model_doc = load_model_doc(catalog)
+        snapshot = catalog.latest_snapshot()
+        snaptime = snapshot.get("/").json()["snaptime"]
+        table_docs = model_doc["schemas"][self.schema_name]["tables"]
+        results = {}
+        for name in (tables or sorted(table_docs)):
+            results[name] = self.sync_table(snapshot, snaptime, table_docs[name], page_size)
+        return results
+
+    def lookup(self, table_name, column, values, result_column="RID"):
+        """
+        Map column values to RIDs (or another column), e.g. Forecast_Name -> RID
+        :param table_name:
+        :param column: column to match
+        :param values: iterable of values
+        :param result_column: column to return for each match
+        :return: dict of value -> result, for the values that have a row (first by RID)
+        """
+        values = list(values)
+        result = {}
+        query = "SELECT {0}, {1} FROM {2} WHERE {0} IN ({{0}}) ORDER BY RID".format(
+            _quote(column), _quote(result_column), _quote(table_name))
+        for i in range(0, len(values), LOOKUP_CHUNK):
+            chunk = values[i:i + LOOKUP_CHUNK]
+            for value, found in self.db.execute(query.format(",".join("?" * len(chunk))), chunk):
+                result.setdefault(value, found)
+        return result
+
+    def iter_rows(self, table_name, columns, where=None, params=(), page_size=DEFAULT_PAGE_SIZE):
+        """
+        Read rows of a mirrored table in RID order, one page at a time
+        :param table_name:
+        :param columns: columns to read
+        :param where: optional SQL condition
+        :param params: parameters of the condition
+        :param page_size: rows per page
+        :return: generator of lists of dicts
+        """
+        cursor = self.db.execute("SELECT {0} FROM {1}{2} ORDER BY RID".format(
+            ", ".join(_quote(column) for column in columns), _quote(table_name),
+            " WHERE " + where if where else ""), params)
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            yield [dict(zip(columns, row)) for row in rows]
+
+def _iter_keyset(snapshot, url, page_size):
+    """
+    Page through an entity or attribute URL in RID order
+    :return: generator of lists of rows
+    """
+    last_rid = None
+    while True:
+        after = "@after({0})".format(urlquote(last_rid)) if last_rid is not None else ""
+        page = snapshot.get("{0}@sort(RID){1}?limit={2}".format(url, after, page_size)).json()
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last_rid = page[-1]["RID"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync the local SQLite mirror of the ETAS tables")
+    parser.add_argument("--mirror", help="SQLite database (default: ~/.scec_deriva/etas_mirror/<host>_<catalog>.sqlite)")
+    parser.add_argument("--tables", help="comma separated tables to sync (default: all ETAS tables)")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE,
+                        help="rows fetched per request (default: %(default)s)")
+    args = parser.parse_args()
+
+    hostname = 'forecast.derivacloud.org'  # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
+    catalog_id = '5'  # this was a throw-away catalog used to test this script (change to TBD)
+
+    catalog = connect_catalog(hostname, catalog_id)
+    start = time.perf_counter()
+    with EtasMirror(args.mirror or default_mirror_path(hostname, catalog_id)) as mirror:
+        results = mirror.sync(catalog, args.tables.split(",") if args.tables else None, args.page_size)
+        for name, counts in results.items():
+            print("{0}: {1} rows fetched, {2} deleted{3}".format(
+                name, counts["fetched"], counts["deleted"], " (reloaded)" if counts["reloaded"] else ""))
+        print("Synced {0} in {1:.3f} s".format(mirror.path, time.perf_counter() - start))
+
+    sys.exit(0)
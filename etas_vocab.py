@@ -0,0 +1,15 @@
+"""etas_vocab.py: Names of the Forecast metadata vocabularies, shared by the scripts that use them.
+
+add_columns.py creates a vocabulary table per metadata field in the VOCAB_SCHEMA schema, and a
+<field>_Term column on Forecast that references the row's term. populate_columns.py,
+register_forecasts.py and scec_config.py only need these names, so they import this module
+instead of add_columns.py and its schema reconciliation stack.
+"""
+
+VOCAB_SCHEMA = 'Vocab'
+
+#
+# Metadata column -> Forecast column holding the RID of its term in the vocabulary
+# table of the same name
+vocabulary_columns = {column: column + '_Term' for column in
+                      ['Sim_Start_Time', 'Catalog_Mag', 'Event_ID', 'Post_Event_Date', 'Rupture_Definition']}
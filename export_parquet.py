@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+
+"""export_parquet.py: This script exports the ETAS Forecast, Evaluation_Group, Evaluation and
+Evaluation_Plot tables (with the metadata columns added by add_columns.py) into local Parquet
+files, so questions like "all forecasts for ci38457511 by Post_Event_Date" can be answered
+with local scans instead of repeated Chaise or ERMrest queries.
+
+Rows are streamed page by page (keyset paging on RID) from a pinned catalog snapshot and
+written as row groups, so memory stays bounded by the page size. Column types follow the
+catalog model; text columns are dictionary encoded, which suits the few distinct values of
+columns such as Event_ID, Catalog_Mag or Rupture_Definition.
+
+Repeat exports are incremental: the newest RMT of each table is kept in export_state.json
+in the output directory, and the next run only fetches rows modified after it, then merges
+them into the existing file by RID. Deleted rows are not visible to an RMT filter, so use
+--full now and then to rebuild the files from scratch.
+
+pyarrow is only needed by this script:
+    pip install pyarrow
+"""
+import os
+import sys
+import json
+import argparse
+from datetime import datetime, date
+from deriva.core import urlquote
+from model_cache import connect_catalog, load_model
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+EXPORT_TABLES = ["Forecast", "Evaluation_Group", "Evaluation", "Evaluation_Plot"]
+
+DEFAULT_OUTPUT_DIR = "etas_export"
+
+DEFAULT_PAGE_SIZE = 5000
+
+STATE_FILE = "export_state.json"
+
+_TIMESTAMP_TYPES = {"timestamptz", "timestamp", "ermrest_rct", "ermrest_rmt"}
+
+def arrow_type(typename):
+    """
+    :param typename: ERMrest column type name
+    :return: (arrow type, function converting one JSON value to the arrow value)
+    """
+    if typename in ("int2", "int4", "serial2", "serial4"):
+        return pa.int32(), None
+    if typename in ("int8", "serial8"):
+        return pa.int64(), None
+    if typename in ("float4", "float8", "numeric"):
+        return pa.float64(), None
+    if typename == "boolean":
+        return pa.bool_(), None
+    if typename == "date":
+        return pa.date32(), date.fromisoformat
+    if typename in _TIMESTAMP_TYPES:
+        return pa.timestamp("us", tz="UTC"), datetime.fromisoformat
+    if typename in ("json", "jsonb"):
+        return pa.string(), json.dumps
+    return pa.dictionary(pa.int32(), pa.string()), None
+
+def table_schema(table):
+    """
+    :param table: chisel Table
+    :return: (arrow schema, dict of column name -> value converter)
+    """
+    fields = []
+    converters = {}
+    for column in table.column_definitions:
+        atype, convert = arrow_type(column.type.typename)
+        fields.append(pa.field(column.name, atype))
+        if convert is not None:
+            converters[column.name] = convert
+    return pa.schema(fields), converters
+
+def page_to_batch(rows, schema, converters):
+    """
+    :param rows: list of entity rows
+    :param schema: arrow schema from table_schema
+    :param converters: value converters from table_schema
+    :return: arrow RecordBatch
+    """
+    arrays = []
+    for field in schema:
+        convert = converters.get(field.name)
+        values = [row.get(field.name) for row in rows]
+        if convert is not None:
+            values = [convert(v) if v is not None else None for v in values]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def iter_pages(snapshot, table_name, page_size=DEFAULT_PAGE_SIZE, after_rmt=None):
+    """
+    Stream the rows of an ETAS table in RID order, one page at a time
+    :param snapshot: pinned ErmrestSnapshot
+    :param table_name:
+    :param page_size: rows per request
+    :param after_rmt: only rows modified after this RMT, None for all rows
+    :return: generator of lists of rows
+    """
+    base = "/entity/ETAS:{0}".format(urlquote(table_name))
+    if after_rmt is not None:
+        base += "/RMT::gt::{0}".format(urlquote(after_rmt))
+    last_rid = None
+    while True:
+        after = "@after({0})".format(urlquote(last_rid)) if last_rid is not None else ""
+        page = snapshot.get("{0}@sort(RID){1}?limit={2}".format(base, after, page_size)).json()
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last_rid = page[-1]["RID"]
+
+def max_rmt(snapshot, table_name):
+    rows = snapshot.get("/aggregate/ETAS:{0}/max_rmt:=max(RMT)".format(urlquote(table_name))).json()
+    return rows[0]["max_rmt"] if rows else None
+
+def export_full(snapshot, table, path, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Write every row of a table to a new Parquet file, one row group per page
+    :return: number of rows written
+    """
+    schema, converters = table_schema(table)
+    tmp_path = path + ".tmp"
+    count = 0
+    with pq.ParquetWriter(tmp_path, schema, use_dictionary=True, compression="zstd") as writer:
+        for page in iter_pages(snapshot, table.name, page_size):
+            writer.write_batch(page_to_batch(page, schema, converters))
+            count += len(page)
+    os.replace(tmp_path, path)
+    return count
+
+def export_delta(snapshot, table, path, after_rmt, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Merge the rows modified after the watermark into an existing Parquet file, by RID
+    :return: number of rows fetched, or None when the file must be rebuilt (new columns)
+    """
+    schema, converters = table_schema(table)
+    existing = pq.read_table(path)
+    if existing.schema.names != schema.names:
+        return None
+    batches = [page_to_batch(page, schema, converters) for page in iter_pages(snapshot, table.name, page_size, after_rmt)]
+    if not batches:
+        return 0
+    delta = pa.Table.from_batches(batches, schema=schema)
+    kept = existing.filter(pc.invert(pc.is_in(existing["RID"].cast(pa.string()),
+                                              value_set=delta["RID"].cast(pa.string()))))
+    merged = pa.concat_tables([kept.cast(schema), delta]).combine_chunks()
+    tmp_path = path + ".tmp"
+    pq.write_table(merged, tmp_path, use_dictionary=True, compression="zstd", row_group_size=page_size)
+    os.replace(tmp_path, path)
+    return delta.num_rows
+
+def load_state(output_dir):
+    try:
+        with open(os.path.join(output_dir, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_state(output_dir, state):
+    path = os.path.join(output_dir, STATE_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the ETAS tables to local Parquet files")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR, help="where to write (default: %(default)s)")
+    parser.add_argument("--full", action="store_true", help="rebuild every file instead of merging changes")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE,
+                        help="rows fetched per request (default: %(default)s)")
+    parser.add_argument("--tables", default=",".join(EXPORT_TABLES),
+                        help="comma separated ETAS tables (default: %(default)s)")
+    args = parser.parse_args()
+
+    if pa is None:
+        print("export_parquet.py needs pyarrow: pip install pyarrow")
+        sys.exit(1)
+
+    hostname = 'forecast.derivacloud.org'  # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
+    catalog_id = '5'  # this was a throw-away catalog used to test this script (change to TBD)
+
+    catalog = connect_catalog(hostname, catalog_id)
+    model = load_model(catalog)
+    snapshot = catalog.latest_snapshot()   # every table is read from the same point in time
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    state = load_state(args.output_dir)
+    catalog_key = "{0}/{1}".format(hostname, catalog_id)
+    if state.get("catalog") != catalog_key:
+        state = {"catalog": catalog_key, "tables": {}}
+
+    for table_name in args.tables.split(","):
+        table = model.schemas["ETAS"].tables[table_name]
+        path = os.path.join(args.output_dir, table_name + ".parquet")
+        watermark = state["tables"].get(table_name)
+        new_watermark = max_rmt(snapshot, table_name)
+        count = None
+        if not args.full and watermark is not None and os.path.exists(path):
+            count = export_delta(snapshot, table, path, watermark, args.page_size)
+            if count is not None:
+                print("{0}: merged {1} changed rows into {2}".format(table_name, count, path))
+        if count is None:
+            count = export_full(snapshot, table, path, args.page_size)
+            print("{0}: wrote {1} rows to {2}".format(table_name, count, path))
+        state["tables"][table_name] = new_watermark
+        save_state(args.output_dir, state)
+
+    sys.exit(0)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+
+"""forecast_scanner.py: This script walks a directory of SCEC ETAS forecast output trees,
+laid out as <forecast_name>/<evaluation_group_name>/{results,plots}/..., and writes an
+upload manifest with one (path, size, mtime, mapping) record per file that matches one
+of the bulk upload asset mappings.
+
+The forecast directories are walked concurrently with os.scandir by a pool of worker
+threads, which keeps many metadata requests in flight on a parallel filesystem. Records
+are streamed to the manifest as they are found, so later stages (checksums, uploads)
+can run from the manifest without walking the tree again.
+
+Manifest format: a header line, then one tab separated record per line
+    path  size  mtime_ns  mapping
+where path is relative to the scanned root and mapping is the index of the asset mapping
+in the bulk_upload annotation. A manifest name ending in .gz is gzip compressed.
+"""
+import os
+import sys
+import gzip
+import time
+import queue
+import argparse
+import threading
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from upload_planner import AssetMatcher, PlanEntry, iter_tree, load_asset_mappings
+
+MANIFEST_HEADER = "#scec_deriva manifest v1"
+
+DEFAULT_WORKERS = 16
+
+#
+# Records are handed from the scanning threads to the manifest writer in batches of this size
+RECORD_BATCH = 1000
+
+@dataclass
+class ManifestRecord:
+    path: str
+    size: int
+    mtime_ns: int
+    mapping: int
+
+@dataclass
+class ScanStats:
+    files: int = 0
+    matched: int = 0
+    elapsed: float = 0.0
+
+    def report(self, label="Scanned"):
+        """
+        Print a one line summary of a scan
+        :param label:
+        :return:
+        """
+        rate = self.files / self.elapsed if self.elapsed > 0 else 0.0
+        print("{0} {1} files ({2} matched) in {3:.3f} s ({4:.0f} files/s)".format(
+            label, self.files, self.matched, self.elapsed, rate))
+
+def _scan_forecast_dir(root, rel_dir, matcher, emit, stop):
+    """
+    Walk one forecast directory with os.scandir, passing batches of ManifestRecord to emit
+    :param root: scanned root
+    :param rel_dir: forecast directory, relative to root
+    :param matcher: AssetMatcher
+    :param emit: callable that takes a list of records, returns False if the scan should stop
+    :param stop: threading.Event set when the consumer has gone away
+    :return: number of files seen
+    """
+    files = 0
+    batch = []
+    stack = [rel_dir]
+    while stack and not stop.is_set():
+        rel = stack.pop()
+        with os.scandir(os.path.join(root, rel)) as it:
+            for entry in it:
+                relpath = rel + "/" + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relpath)
+                elif entry.is_file():
+                    files += 1
+                    result = matcher.match(relpath)
+                    if result is None:
+                        continue
+                    st = entry.stat()
+                    batch.append(ManifestRecord(relpath, st.st_size, st.st_mtime_ns, result[0]))
+                    if len(batch) >= RECORD_BATCH:
+                        if not emit(batch):
+                            return files
+                        batch = []
+    if batch:
+        emit(batch)
+    return files
+
+def scan_tree(root, matcher, workers=DEFAULT_WORKERS, stats=None):
+    """
+    Scan the forecast directories under root concurrently
+    :param root: directory holding the <forecast_name> directories
+    :param matcher: AssetMatcher
+    :param workers: number of scanning threads
+    :param stats: ScanStats to fill in, optional
+    :return: generator of ManifestRecord, in no particular order
+    """
+    if stats is None:
+        stats = ScanStats()
+    start = time.perf_counter()
+    records = queue.Queue(maxsize=4 * workers)
+    stop = threading.Event()
+    done = object()
+
+    def emit(batch):
+        while not stop.is_set():
+            try:
+                records.put(batch, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def scan_one(name):
+        try:
+            return _scan_forecast_dir(root, name, matcher, emit, stop)
+        finally:
+            emit(done)
+
+    top_files = []
+    forecast_dirs = []
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                forecast_dirs.append(entry.name)
+            elif entry.is_file():
+                top_files.append(entry)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(scan_one, name) for name in forecast_dirs]
+        try:
+            for entry in top_files:
+                stats.files += 1
+                result = matcher.match(entry.name)
+                if result is not None:
+                    st = entry.stat()
+                    stats.matched += 1
+                    yield ManifestRecord(entry.name, st.st_size, st.st_mtime_ns, result[0])
+            remaining = len(futures)
+            while remaining:
+                batch = records.get()
+                if batch is done:
+                    remaining -= 1
+                    continue
+                stats.matched += len(batch)
+                yield from batch
+            for future in futures:
+                stats.files += future.result()
+        finally:
+            stop.set()
+    stats.elapsed = time.perf_counter() - start
+
+def serial_scan(root, matcher, stats=None):
+    """
+    Reference implementation: a serial os.walk plus os.stat of every matched file
+    :param root: directory holding the <forecast_name> directories
+    :param matcher: AssetMatcher
+    :param stats: ScanStats to fill in, optional
+    :return: generator of ManifestRecord
+    """
+    if stats is None:
+        stats = ScanStats()
+    start = time.perf_counter()
+    for relpath in iter_tree(root):
+        stats.files += 1
+        result = matcher.match(relpath)
+        if result is None:
+            continue
+        st = os.stat(os.path.join(root, relpath))
+        stats.matched += 1
+        yield ManifestRecord(relpath, st.st_size, st.st_mtime_ns, result[0])
+    stats.elapsed = time.perf_counter() - start
+
+def _open_manifest(path, mode, compressed):
+    if compressed:
+        return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=1)
+    return open(path, mode, encoding="utf-8")
+
+def write_manifest(path, root, records):
+    """
+    Stream records to a manifest file
+    :param path: manifest file, gzip compressed if it ends with .gz
+    :param root: scanned root, recorded in the header
+    :param records: iterable of ManifestRecord
+    :return: number of records written
+    """
+    count = 0
+    tmp_path = path + ".tmp"
+    with _open_manifest(tmp_path, "w", path.endswith(".gz")) as f:
+        f.write("{0}\t{1}\n".format(MANIFEST_HEADER, os.path.abspath(root)))
+        for rec in records:
+            f.write("{0}\t{1}\t{2}\t{3}\n".format(rec.path, rec.size, rec.mtime_ns, rec.mapping))
+            count += 1
+    os.replace(tmp_path, path)
+    return count
+
+def read_manifest(path):
+    """
+    Read a manifest written by write_manifest
+    :param path: manifest file
+    :return: tuple of (scanned root, generator of ManifestRecord)
+    """
+    f = _open_manifest(path, "r", path.endswith(".gz"))
+    header = f.readline().rstrip("\n").split("\t")
+    if header[0] != MANIFEST_HEADER:
+        f.close()
+        raise ValueError("{0} is not a scec_deriva manifest".format(path))
+
+    def records():
+        with f:
+            for line in f:
+                relpath, size, mtime_ns, mapping = line.rstrip("\n").split("\t")
+                yield ManifestRecord(relpath, int(size), int(mtime_ns), int(mapping))
+
+    return header[1], records()
+
+def manifest_plan(path, matcher):
+    """
+    Rebuild the upload plan from a manifest. The captured groups are not stored in the
+    manifest, so each path is matched again, which is cheap next to walking the tree.
+    :param path: manifest file
+    :param matcher: AssetMatcher built from the same asset mappings as the manifest
+    :return: tuple of (scanned root, list of ManifestRecord, list of PlanEntry in the same order)
+    """
+    root, records = read_manifest(path)
+    records = list(records)
+    plan = []
+    for rec in records:
+        result = matcher.match(rec.path)
+        if result is None:
+            raise ValueError("{0} in {1} matches no asset mapping".format(rec.path, path))
+        plan.append(PlanEntry(rec.path, result[0], result[1]))
+    return root, records, plan
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan forecast output trees into an upload manifest")
+    parser.add_argument("root", help="directory holding the <forecast_name> directories")
+    parser.add_argument("manifest", nargs="?", help="manifest file to write (.gz for compressed)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of scanning threads (default: %(default)s)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="compare the parallel scan with a serial os.walk of the same tree")
+    args = parser.parse_args()
+
+    matcher = AssetMatcher(load_asset_mappings())
+
+    if args.benchmark:
+        serial_stats = ScanStats()
+        serial = sorted(rec.path for rec in serial_scan(args.root, matcher, serial_stats))
+        serial_stats.report("Serial walk:")
+        parallel_stats = ScanStats()
+        parallel = sorted(rec.path for rec in scan_tree(args.root, matcher, args.workers, parallel_stats))
+        parallel_stats.report("Parallel scan ({0} workers):".format(args.workers))
+        if serial != parallel:
+            print("Error: the serial and parallel scans found different files")
+            sys.exit(1)
+        if parallel_stats.elapsed > 0:
+            print("Speedup: {0:.2f}x".format(serial_stats.elapsed / parallel_stats.elapsed))
+
+    if args.manifest:
+        stats = ScanStats()
+        count = write_manifest(args.manifest, args.root, scan_tree(args.root, matcher, args.workers, stats))
+        stats.report()
+        print("Wrote {0} records to {1}".format(count, args.manifest))
+
+    sys.exit(0)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+
+"""hatrac_upload.py: This script uploads the files of an upload plan (a forecast_scanner.py
+manifest) to Hatrac, at the hatrac_uri given by each asset mapping's hatrac_templates.
+These are the assets of the Forecast_File, Evaluation and Evaluation_Plot tables defined
+with Table.define_asset in scec_model.py.
+
+Transfers run on a bounded pool of worker threads. Each worker keeps its own HatracStore,
+so its HTTP session and keep-alive connection are reused for every file it sends.
+
+Files larger than the chunk threshold are sent as chunked Hatrac upload jobs. The job id,
+the chunk size the job uses and the number of confirmed chunks are recorded in a local
+state file after every chunk, so after a failure (in this run or a later one) the transfer
+resumes from the last confirmed chunk instead of from zero.
+
+Files whose MD5 and length are already recorded in their asset table are dropped from the
+plan first (see upload_dedup.py), unless --no-dedup is given.
+
+The results (path, URL, MD5, size) are written as a tab separated file for registration,
+and aggregate throughput and per-file latency are reported so concurrency can be tuned.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests import HTTPError
+from deriva.core import urlquote
+from model_cache import connect_catalog, connect_hatrac
+from upload_planner import AssetMatcher, load_asset_mappings
+from forecast_scanner import manifest_plan
+from checksum_cache import ChecksumCache, DEFAULT_CACHE_FILE, md5_hex_to_base64
+from upload_dedup import DedupStats, fetch_existing_assets, dedup_plan
+
+DEFAULT_WORKERS = 4
+
+DEFAULT_CHUNK_SIZE = 25 * 1024 * 1024
+
+#
+# Files at least this large are sent as resumable chunked upload jobs
+DEFAULT_CHUNK_THRESHOLD = 100 * 1024 * 1024
+
+DEFAULT_RETRIES = 3
+
+DEFAULT_STATE_FILE = os.path.join(os.path.expanduser("~"), ".scec_deriva", "upload_jobs.json")
+
+@dataclass
+class UploadTask:
+    path: str
+    local_path: str
+    hatrac_path: str
+    size: int
+    md5: str
+
+@dataclass
+class UploadStats:
+    files: int = 0
+    failed: int = 0
+    bytes_sent: int = 0
+    resumed_chunks: int = 0
+    elapsed: float = 0.0
+    latencies: list = field(default_factory=list)
+
+    def report(self):
+        """
+        Print aggregate throughput and the per-file latency distribution
+        :return:
+        """
+        mb = self.bytes_sent / (1024 * 1024)
+        rate = mb / self.elapsed if self.elapsed > 0 else 0.0
+        print("Uploaded {0} files ({1} failed), {2:.1f} MB in {3:.3f} s ({4:.1f} MB/s), "
+              "{5} chunks skipped on resume".format(self.files, self.failed, mb, self.elapsed, rate,
+                                                    self.resumed_chunks))
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+            print("Per-file latency: p50 {0:.3f} s, p90 {1:.3f} s, p99 {2:.3f} s, max {3:.3f} s".format(
+                pick(0.5), pick(0.9), pick(0.99), latencies[-1]))
+
+class UploadJobState:
+    """
+    Chunked upload jobs in progress, saved to disk so an interrupted transfer can resume
+    """
+    def __init__(self, path=DEFAULT_STATE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.jobs = json.load(f)
+        except FileNotFoundError:
+            self.jobs = {}
+
+    def get(self, hatrac_path):
+        with self.lock:
+            return self.jobs.get(hatrac_path)
+
+    def set(self, hatrac_path, job):
+        with self.lock:
+            if job is None:
+                self.jobs.pop(hatrac_path, None)
+            else:
+                self.jobs[hatrac_path] = job
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.jobs, f)
+        os.replace(tmp_path, self.path)
+
+def hatrac_path_for(mapping, groups, file_name):
+    """
+    Fill in a mapping's hatrac_uri template
+    :param mapping: asset mapping dict
+    :param groups: captured groups of the plan entry
+    :param file_name: base name of the file
+    :return: hatrac path, e.g. /hatrac/ETAS/Forecast/<forecast_name>/<file_name>
+    """
+    values = {name: urlquote(value) for name, value in groups.items()}
+    values["file_name"] = urlquote(file_name)
+    return mapping["hatrac_templates"]["hatrac_uri"].format(**values)
+
+class HatracUploader:
+    """
+    Bounded pool of concurrent transfers, one HatracStore (and keep-alive session) per worker
+    """
+    def __init__(self, hostname, workers=DEFAULT_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE,
+                 chunk_threshold=DEFAULT_CHUNK_THRESHOLD, retries=DEFAULT_RETRIES, state=None):
+        self.hostname = hostname
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.chunk_threshold = chunk_threshold
+        self.retries = retries
+        self.state = state if state is not None else UploadJobState()
+        self.stats = UploadStats()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+
+    def _store(self):
+        store = getattr(self._local, "store", None)
+        if store is None:
+            store = self._local.store = connect_hatrac(self.hostname)
+        return store
+
+    def _count_bytes(self, nbytes):
+        with self._stats_lock:
+            self.stats.bytes_sent += nbytes
+
+    def _put_small(self, task):
+        url = self._store().put_loc(task.hatrac_path, task.local_path, md5=md5_hex_to_base64(task.md5),
+                                    chunked=False, create_parents=True)
+        self._count_bytes(task.size)
+        return url
+
+    def _put_chunked(self, task):
+        store = self._store()
+        job = self.state.get(task.hatrac_path)
+        if job is not None and (job.get("md5") != task.md5 or job.get("size") != task.size or "job_id" not in job):
+            job = None   # the local file changed since the job was started (or an old state entry)
+        if job is not None:
+            try:
+                store.get_upload_job(task.hatrac_path, job["job_id"])   # is the job still open on the server?
+            except HTTPError as err:
+                if err.response is None or err.response.status_code not in (404, 409):
+                    raise
+                job = None
+        if job is None:
+            job_id = store.create_upload_job(task.hatrac_path, task.local_path, md5_hex_to_base64(task.md5), None,
+                                             create_parents=True, chunk_size=self.chunk_size)
+            # the client may lower the requested chunk size to its limits, keep the one the job uses
+            chunk_size = store.get_upload_job(task.hatrac_path, job_id).json()["chunk-length"]
+            job = {"job_id": job_id, "md5": task.md5, "size": task.size,
+                   "chunk_size": chunk_size, "confirmed": 0}
+            self.state.set(task.hatrac_path, job)
+        else:
+            with self._stats_lock:
+                self.stats.resumed_chunks += job["confirmed"]
+
+        chunk_size = job["chunk_size"]
+        nchunks = (task.size + chunk_size - 1) // chunk_size
+        with open(task.local_path, "rb") as f:
+            f.seek(job["confirmed"] * chunk_size)
+            for position in range(job["confirmed"], nchunks):
+                data = f.read(chunk_size)
+                store.put("{0};upload/{1}/{2}".format(task.hatrac_path, job["job_id"], position), data=data,
+                          headers={"Content-Type": "application/octet-stream"})
+                self._count_bytes(len(data))
+                job["confirmed"] = position + 1
+                self.state.set(task.hatrac_path, job)
+        url = store.finalize_upload_job(task.hatrac_path, job["job_id"])
+        self.state.set(task.hatrac_path, None)
+        return url
+
+    def upload_one(self, task):
+        """
+        Upload one file, retrying (and resuming chunked transfers) on failure
+        :param task: UploadTask
+        :return: versioned hatrac URL
+        """
+        start = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            try:
+                if task.size >= self.chunk_threshold:
+                    url = self._put_chunked(task)
+                else:
+                    url = self._put_small(task)
+                break
+            except Exception as err:
+                if attempt == self.retries:
+                    raise
+                print("Retrying {0} after error: {1}".format(task.path, err))
+                time.sleep(2 ** attempt)
+        with self._stats_lock:
+            self.stats.latencies.append(time.perf_counter() - start)
+        return url
+
+    def upload(self, tasks):
+        """
+        Upload all tasks on the worker pool
+        :param tasks: list of UploadTask
+        :return: list of (UploadTask, URL) for the files that were uploaded
+        """
+        results = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.upload_one, task): task for task in tasks}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    results.append((task, future.result()))
+                    self.stats.files += 1
+                except Exception as err:
+                    self.stats.failed += 1
+                    print("Error uploading {0}: {1}".format(task.path, err))
+        self.stats.elapsed = time.perf_counter() - start
+        return results
+
+def build_tasks(root, records, plan, asset_mappings, checksums):
+    """
+    Turn a manifest plan into upload tasks
+    :param root: scanned root of the manifest
+    :param records: list of ManifestRecord
+    :param plan: list of PlanEntry, in the same order as records
+    :param asset_mappings: list of asset mapping dicts
+    :param checksums: dict of local path -> md5 hex
+    :return: list of UploadTask
+    """
+    tasks = []
+    for rec, entry in zip(records, plan):
+        local_path = os.path.join(root, rec.path)
+        file_name = rec.path.rsplit("/", 1)[-1]
+        hatrac_path = hatrac_path_for(asset_mappings[entry.mapping], entry.groups, file_name)
+        tasks.append(UploadTask(rec.path, local_path, hatrac_path, rec.size, checksums[local_path]))
+    return tasks
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload the files of a forecast_scanner.py manifest to Hatrac")
+    parser.add_argument("manifest", help="manifest written by forecast_scanner.py")
+    parser.add_argument("--results", help="write the (path, URL, MD5, size) of each uploaded file here")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of concurrent transfers (default: %(default)s)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="chunk size for chunked uploads in bytes (default: %(default)s)")
+    parser.add_argument("--chunk-threshold", type=int, default=DEFAULT_CHUNK_THRESHOLD,
+                        help="files at least this large are sent in chunks (default: %(default)s)")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                        help="attempts per file after the first (default: %(default)s)")
+    parser.add_argument("--state-file", default=DEFAULT_STATE_FILE,
+                        help="chunked upload jobs in progress (default: %(default)s)")
+    parser.add_argument("--checksum-cache", default=DEFAULT_CACHE_FILE,
+                        help="checksum cache file (default: %(default)s)")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="upload every file, even if the catalog already has its MD5 and length")
+    args = parser.parse_args()
+
+    hostname = 'forecast.derivacloud.org'  # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
+    catalog_id = '5'  # this was a throw-away catalog used to test this script (change to TBD)
+
+    asset_mappings = load_asset_mappings()
+    root, records, plan = manifest_plan(args.manifest, AssetMatcher(asset_mappings))
+
+    cache = ChecksumCache(args.checksum_cache)
+    checksums = cache.checksum_files(os.path.join(root, rec.path) for rec in records)
+    cache.close()
+    cache.stats.report()
+
+    #
+    # Drop the files the catalog already holds before any bytes move
+    if not args.no_dedup:
+        catalog = connect_catalog(hostname, catalog_id)
+        dedup_stats = DedupStats()
+        existing = fetch_existing_assets(catalog, {entry.groups["forecast_name"] for entry in plan}, dedup_stats)
+        records, plan = dedup_plan(records, plan, asset_mappings, checksums, existing, root, dedup_stats)
+        dedup_stats.report()
+
+    tasks = build_tasks(root, records, plan, asset_mappings, checksums)
+    uploader = HatracUploader(hostname, args.workers, args.chunk_size, args.chunk_threshold,
+                              args.retries, UploadJobState(args.state_file))
+    results = uploader.upload(tasks)
+    uploader.stats.report()
+
+    if args.results:
+        with open(args.results, "w") as f:
+            for task, url in results:
+                f.write("{0}\t{1}\t{2}\t{3}\n".format(task.path, url, task.md5, task.size))
+
+    sys.exit(1 if uploader.stats.failed else 0)
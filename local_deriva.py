@@ -0,0 +1,1138 @@
+#!/usr/bin/env python
+
+
+"""local_deriva.py: This script runs an in-process, in-memory stand-in for the parts of
+ERMrest and Hatrac that the scripts in this repo use, so that populate, schema creation
+and upload pipelines can be run and benchmarked reproducibly on a laptop, without
+touching the shared dev server.
+
+Supported (enough for deriva-py's ErmrestCatalog, chisel, the datapath and HatracStore):
+  * catalog info (with a snaptime, so latest_snapshot() works; snapshots read the live data)
+  * /schema introspection with an ETag (so model_cache.py revalidates with a 304), schema,
+    table, column, key and foreign key creation, column alter, drop, and PUT of annotations,
+    ACLs, ACL bindings and comments
+  * entity, attribute, aggregate and attributegroup reads with filters (=, ::op::, ::null::,
+    & ; ! and parentheses), implicit foreign key joins, @sort, @after/@before and ?limit=
+  * entity POST (insert, with ?onconflict=skip), attributegroup PUT (update), entity DELETE
+  * Hatrac object PUT/GET/HEAD/DELETE with Content-MD5 checks, and chunked upload jobs
+
+Every request can be slowed down by a fixed latency, and by a bandwidth limit applied to
+the request plus response body sizes, to mimic a remote server.
+
+Point the scripts at it with the SCEC_DERIVA_SERVER environment variable (see model_cache.py):
+    python local_deriva.py --port 8080 --latency-ms 20 --bandwidth-mbit 100 --forecasts 10000
+    SCEC_DERIVA_SERVER=http://127.0.0.1:8080 python populate_columns.py
+
+Or in-process:
+    with LocalDeriva(latency=0.02) as server:
+        os.environ["SCEC_DERIVA_SERVER"] = server.url
+        ...
+"""
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import hashlib
+import argparse
+import threading
+import functools
+from datetime import datetime, timezone
+from urllib.parse import unquote, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#
+# System columns ERMrest adds to every table: name, type, nullok
+SYSTEM_COLUMNS = [
+    ("RID", "ermrest_rid", False),
+    ("RCT", "ermrest_rct", False),
+    ("RMT", "ermrest_rmt", False),
+    ("RCB", "ermrest_rcb", True),
+    ("RMB", "ermrest_rmb", True),
+]
+
+#
+# Catalog ACL names, all empty in a fresh catalog except for the owner (the stand-in has no
+# authenticated clients, so it has no owner either)
+CATALOG_ACLS = ["owner", "create", "select", "insert", "update", "delete", "write", "enumerate"]
+
+#
+# The "public" schema of a fresh ERMrest catalog, holding the client and group tables that the
+# RCB/RMB foreign keys of chisel-defined tables reference
+PUBLIC_TABLES = [
+    {"table_name": "ERMrest_Client",
+     "column_definitions": [
+         {"name": "ID", "type": {"typename": "text"}, "nullok": False},
+         {"name": "Display_Name", "type": {"typename": "text"}},
+         {"name": "Full_Name", "type": {"typename": "text"}},
+         {"name": "Email", "type": {"typename": "text"}},
+         {"name": "Client_Object", "type": {"typename": "jsonb"}, "nullok": False},
+     ],
+     "keys": [{"unique_columns": ["ID"], "names": [["public", "ERMrest_Client_ID_key"]]}]},
+    {"table_name": "ERMrest_Group",
+     "column_definitions": [
+         {"name": "ID", "type": {"typename": "text"}, "nullok": False},
+         {"name": "URL", "type": {"typename": "text"}},
+         {"name": "Display_Name", "type": {"typename": "text"}},
+         {"name": "Description", "type": {"typename": "text"}},
+     ],
+     "keys": [{"unique_columns": ["ID"], "names": [["public", "ERMrest_Group_ID_key"]]}]},
+]
+
+_INT_TYPES = {"int2", "int4", "int8", "serial2", "serial4", "serial8"}
+_FLOAT_TYPES = {"float4", "float8", "numeric"}
+
+class RequestError(Exception):
+    """
+    Turned into an HTTP error response by the request handler
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _json_body(body):
+    try:
+        return json.loads(body.decode("utf-8")) if body else None
+    except ValueError:
+        raise RequestError(400, "Request body is not valid JSON")
+
+def _coerce(value, typename):
+    """
+    Convert a URL value to the Python type stored for a column of the given type
+    """
+    if value is None:
+        return None
+    try:
+        if typename in _INT_TYPES:
+            return int(value)
+        if typename in _FLOAT_TYPES:
+            return float(value)
+        if typename == "boolean":
+            return value if isinstance(value, bool) else value.lower() in ("true", "t", "1")
+    except ValueError:
+        raise RequestError(400, "Invalid {0} value: {1}".format(typename, value))
+    return value
+
+def _split_top(text, sep):
+    """
+    Split text on sep, ignoring separators inside parentheses
+    """
+    parts = []
+    depth = 0
+    start = 0
+    for i, ch in enumerate(text):
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == sep and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+# Filters ------------------------------------------------------------------------------------------#
+
+class _FilterParser:
+    """
+    Parses an ERMrest filter path element into a predicate: row -> bool
+    """
+    def __init__(self, text, columns):
+        self.text = text
+        self.pos = 0
+        self.columns = columns   # column name -> typename of the table being filtered
+
+    def parse(self):
+        predicate = self._disjunction()
+        if self.pos != len(self.text):
+            raise RequestError(400, "Invalid filter: {0}".format(self.text))
+        return predicate
+
+    def _peek(self):
+        return self.text[self.pos] if self.pos < len(self.text) else ""
+
+    def _disjunction(self):
+        terms = [self._conjunction()]
+        while self._peek() == ";":
+            self.pos += 1
+            terms.append(self._conjunction())
+        return terms[0] if len(terms) == 1 else (lambda row: any(term(row) for term in terms))
+
+    def _conjunction(self):
+        terms = [self._unary()]
+        while self._peek() == "&":
+            self.pos += 1
+            terms.append(self._unary())
+        return terms[0] if len(terms) == 1 else (lambda row: all(term(row) for term in terms))
+
+    def _unary(self):
+        if self._peek() == "!":
+            self.pos += 1
+            term = self._unary()
+            return lambda row: not term(row)
+        if self._peek() == "(":
+            self.pos += 1
+            term = self._disjunction()
+            if self._peek() != ")":
+                raise RequestError(400, "Unbalanced parentheses in filter: {0}".format(self.text))
+            self.pos += 1
+            return term
+        end = self.pos
+        while end < len(self.text) and self.text[end] not in "();&":
+            end += 1
+        atom = self.text[self.pos:end]
+        self.pos = end
+        return self._predicate(atom)
+
+    def _predicate(self, atom):
+        if "::" in atom:
+            column, rest = atom.split("::", 1)
+            op, _, value = rest.partition("::")
+        elif "=" in atom:
+            column, value = atom.split("=", 1)
+            op = "eq"
+        else:
+            raise RequestError(400, "Invalid filter: {0}".format(atom))
+        column = unquote(column.rsplit(":", 1)[-1])
+        if column not in self.columns:
+            raise RequestError(409, "Column {0} does not exist".format(column))
+        if op == "null":
+            return lambda row: row.get(column) is None
+        value = _coerce(unquote(value), self.columns[column])
+        if op == "eq":
+            return lambda row: row.get(column) == value
+        if op in ("gt", "lt", "geq", "leq"):
+            compare = {"gt": lambda a, b: a > b, "lt": lambda a, b: a < b,
+                       "geq": lambda a, b: a >= b, "leq": lambda a, b: a <= b}[op]
+            return lambda row: row.get(column) is not None and compare(row[column], value)
+        if op in ("regexp", "ciregexp"):
+            pattern = re.compile(value, re.IGNORECASE if op == "ciregexp" else 0)
+            return lambda row: row.get(column) is not None and pattern.search(str(row[column])) is not None
+        if op == "ts":
+            words = value.lower().split()
+            return lambda row: row.get(column) is not None and all(w in str(row[column]).lower() for w in words)
+        raise RequestError(400, "Unsupported filter operator: {0}".format(op))
+
+# Catalog ------------------------------------------------------------------------------------------#
+
+class LocalCatalog:
+    """
+    One in-memory ERMrest catalog: a model document plus the rows of every table
+    """
+    def __init__(self, catalog_id):
+        self.id = catalog_id
+        self.lock = threading.RLock()
+        self.model = {"schemas": {}, "acls": {name: [] for name in CATALOG_ACLS}, "annotations": {}}
+        self.version = 0
+        self.data_version = 0   # with version, advances the snaptime on every write
+        self.token = uuid.uuid4().hex[:8]
+        self.rows = {}       # (schema, table) -> dict of RID -> row
+        self.indexes = {}    # (schema, table) -> dict of key columns tuple -> dict of values -> RID
+        self._next_rid = 0
+        self._last_time = 0.0
+        self.create_schema({"schema_name": "public",
+                            "tables": {t["table_name"]: t for t in json.loads(json.dumps(PUBLIC_TABLES))}})
+
+    @property
+    def etag(self):
+        return '"{0}-{1}"'.format(self.token, self.version)
+
+    def _changed(self):
+        self.version += 1
+
+    def _new_rid(self):
+        self._next_rid += 1
+        digits = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+        n = self._next_rid
+        rid = ""
+        for _ in range(6):
+            rid = digits[n % 32] + rid
+            n //= 32
+        return "1-" + rid
+
+    def _now(self):
+        # strictly increasing, so RMT watermarks never miss a row
+        now = max(time.time(), self._last_time + 1e-6)
+        self._last_time = now
+        return datetime.fromtimestamp(now, timezone.utc).isoformat(timespec="microseconds")
+
+    def snaptime(self):
+        return "2TA-{0:X}".format(self.version + self.data_version)
+
+    # Model ------------------------------------------------------------------------------------#
+
+    def schema_doc(self, sname):
+        try:
+            return self.model["schemas"][sname]
+        except KeyError:
+            raise RequestError(404, "Schema {0} does not exist".format(sname))
+
+    def table_doc(self, sname, tname):
+        try:
+            return self.schema_doc(sname)["tables"][tname]
+        except KeyError:
+            raise RequestError(404, "Table {0}:{1} does not exist".format(sname, tname))
+
+    def column_types(self, sname, tname):
+        return {c["name"]: c["type"]["typename"] for c in self.table_doc(sname, tname)["column_definitions"]}
+
+    def create_schema(self, doc):
+        sname = doc["schema_name"]
+        if sname in self.model["schemas"]:
+            raise RequestError(409, "Schema {0} already exists".format(sname))
+        schema = {"schema_name": sname, "comment": doc.get("comment"), "annotations": doc.get("annotations", {}),
+                  "acls": doc.get("acls", {}), "tables": {}}
+        self.model["schemas"][sname] = schema
+        for tdoc in (doc.get("tables") or {}).values():
+            self.create_table(sname, tdoc)
+        self._changed()
+        return schema
+
+    def drop_schema(self, sname):
+        for tname in list(self.schema_doc(sname)["tables"]):
+            self.drop_table(sname, tname)
+        del self.model["schemas"][sname]
+        self._changed()
+
+    @staticmethod
+    def _column_doc(doc):
+        return {"name": doc["name"], "type": doc["type"], "nullok": doc.get("nullok", True),
+                "default": doc.get("default"), "comment": doc.get("comment"),
+                "annotations": doc.get("annotations", {}), "acls": doc.get("acls", {}),
+                "acl_bindings": doc.get("acl_bindings", {})}
+
+    def create_table(self, sname, doc):
+        schema = self.schema_doc(sname)
+        tname = doc["table_name"]
+        if tname in schema["tables"]:
+            raise RequestError(409, "Table {0}:{1} already exists".format(sname, tname))
+        columns = [self._column_doc(c) for c in doc.get("column_definitions", [])]
+        names = {c["name"] for c in columns}
+        system = [self._column_doc({"name": name, "type": {"typename": typename}, "nullok": nullok})
+                  for name, typename, nullok in SYSTEM_COLUMNS if name not in names]
+        table = {"schema_name": sname, "table_name": tname, "kind": "table", "comment": doc.get("comment"),
+                 "annotations": doc.get("annotations", {}), "acls": doc.get("acls", {}),
+                 "acl_bindings": doc.get("acl_bindings", {}), "column_definitions": system + columns,
+                 "keys": [], "foreign_keys": []}
+        schema["tables"][tname] = table
+        self.rows[(sname, tname)] = {}
+        self.indexes[(sname, tname)] = {}
+        keys = list(doc.get("keys", []))
+        if not any(k["unique_columns"] == ["RID"] for k in keys):
+            keys.insert(0, {"unique_columns": ["RID"], "names": [[sname, tname + "_RIDkey1"]]})
+        for kdoc in keys:
+            self.create_key(sname, tname, kdoc)
+        for fkdoc in doc.get("foreign_keys", []):
+            self.create_fkey(sname, tname, fkdoc)
+        self._changed()
+        return table
+
+    def drop_table(self, sname, tname):
+        self.table_doc(sname, tname)
+        del self.model["schemas"][sname]["tables"][tname]
+        self.rows.pop((sname, tname), None)
+        self.indexes.pop((sname, tname), None)
+        self._changed()
+
+    def create_column(self, sname, tname, doc):
+        table = self.table_doc(sname, tname)
+        if doc["name"] in self.column_types(sname, tname):
+            raise RequestError(409, "Column {0} already exists".format(doc["name"]))
+        column = self._column_doc(doc)
+        table["column_definitions"].append(column)
+        for row in self.rows[(sname, tname)].values():
+            row[column["name"]] = column["default"]
+        self._changed()
+        return column
+
+    def alter_column(self, sname, tname, cname, changes):
+        column = self.element(["schema", sname, "table", tname, "column", cname])
+        for attr in ("nullok", "default", "comment", "type"):
+            if attr in changes:
+                column[attr] = changes[attr]
+        if changes.get("name", cname) != cname:
+            column["name"] = changes["name"]
+            for row in self.rows[(sname, tname)].values():
+                row[changes["name"]] = row.pop(cname)
+        self._changed()
+        return column
+
+    def drop_column(self, sname, tname, cname):
+        table = self.table_doc(sname, tname)
+        table["column_definitions"] = [c for c in table["column_definitions"] if c["name"] != cname]
+        for row in self.rows[(sname, tname)].values():
+            row.pop(cname, None)
+        self._changed()
+
+    def create_key(self, sname, tname, doc):
+        table = self.table_doc(sname, tname)
+        columns = tuple(doc["unique_columns"])
+        key = {"unique_columns": list(columns), "comment": doc.get("comment"),
+               "annotations": doc.get("annotations", {}),
+               "names": doc.get("names") or [[sname, "{0}_{1}_key".format(tname, "_".join(columns))]]}
+        table["keys"].append(key)
+        index = self.indexes[(sname, tname)][columns] = {}
+        for rid, row in self.rows[(sname, tname)].items():
+            values = tuple(row.get(c) for c in columns)
+            if None not in values:
+                if values in index:
+                    raise RequestError(409, "Duplicate values for key {0}".format(list(columns)))
+                index[values] = rid
+        self._changed()
+        return key
+
+    def create_fkey(self, sname, tname, doc):
+        table = self.table_doc(sname, tname)
+        fk_columns = [{"schema_name": sname, "table_name": tname, "column_name": c["column_name"]}
+                      for c in doc["foreign_key_columns"]]
+        ref_columns = [{"schema_name": c["schema_name"], "table_name": c["table_name"],
+                        "column_name": c["column_name"]} for c in doc["referenced_columns"]]
+        names = [c["column_name"] for c in fk_columns]
+        fkey = {"foreign_key_columns": fk_columns, "referenced_columns": ref_columns,
+                "comment": doc.get("comment"), "annotations": doc.get("annotations", {}),
+                "acls": doc.get("acls", {}), "acl_bindings": doc.get("acl_bindings", {}),
+                "on_update": doc.get("on_update", "NO ACTION"), "on_delete": doc.get("on_delete", "NO ACTION"),
+                "names": doc.get("names") or [[sname, "{0}_{1}_fkey".format(tname, "_".join(names))]]}
+        table["foreign_keys"].append(fkey)
+        self._changed()
+        return [fkey]
+
+    def element(self, segments):
+        """
+        Find the model document addressed by a /schema/... path
+        :param segments: unquoted path segments after /schema, e.g. ['schema', 'ETAS', 'table', 'Forecast']
+        :return: model document (dict)
+        """
+        if not segments:
+            return self.model
+        element = self.schema_doc(segments[1]) if len(segments) > 1 else None
+        if element is None:
+            raise RequestError(400, "Invalid model path")
+        rest = segments[2:]
+        if rest[:1] == ["table"] and len(rest) > 1:
+            element = self.table_doc(segments[1], rest[1])
+            rest = rest[2:]
+            if rest[:1] == ["column"] and len(rest) > 1:
+                matches = [c for c in element["column_definitions"] if c["name"] == rest[1]]
+                if not matches:
+                    raise RequestError(404, "Column {0} does not exist".format(rest[1]))
+                element, rest = matches[0], rest[2:]
+            elif rest[:1] == ["key"] and len(rest) > 1:
+                columns = rest[1].split(",")
+                matches = [k for k in element["keys"] if sorted(k["unique_columns"]) == sorted(columns)]
+                if not matches:
+                    raise RequestError(404, "Key {0} does not exist".format(columns))
+                element, rest = matches[0], rest[2:]
+            elif rest[:1] == ["foreignkey"] and len(rest) > 4:
+                columns = rest[1].split(",")
+                ref_schema, ref_table = rest[3].split(":", 1)
+                ref_columns = rest[4].split(",")
+                matches = [fk for fk in element["foreign_keys"]
+                           if [c["column_name"] for c in fk["foreign_key_columns"]] == columns
+                           and [c["column_name"] for c in fk["referenced_columns"]] == ref_columns
+                           and fk["referenced_columns"][0]["schema_name"] == ref_schema
+                           and fk["referenced_columns"][0]["table_name"] == ref_table]
+                if not matches:
+                    raise RequestError(404, "Foreign key {0} does not exist".format(columns))
+                element, rest = matches[0], rest[5:]
+        if rest:
+            raise RequestError(400, "Invalid model path: {0}".format("/".join(segments)))
+        return element
+
+    def handle_model(self, method, segments, body):
+        """
+        :param method:
+        :param segments: unquoted path segments after the catalog, starting at 'schema' (or a
+                         catalog level 'annotation', 'acl' or 'comment')
+        :param body: request body bytes
+        :return: (status, response document or None)
+        """
+        # split off a trailing /annotation[/tag], /acl[/name], /acl_binding[/name] or /comment
+        for i, segment in enumerate(segments):
+            if segment in ("annotation", "acl", "acl_binding", "comment") and \
+                    (i == 0 or segments[i - 1] not in ("column", "table", "key", "schema")):
+                return self._handle_resource(method, segments[:i], segment, segments[i + 1:], body)
+
+        if segments == ["schema"]:
+            if method == "GET":
+                return 200, self.model
+            if method == "POST":
+                doc = _json_body(body)
+                docs = list(doc["schemas"].values()) if isinstance(doc, dict) else doc
+                created = []
+                for item in docs:
+                    if "table_name" in item:
+                        created.append(self.create_table(item["schema_name"], item))
+                    else:
+                        created.append(self.create_schema(item))
+                return 201, created
+        elif len(segments) == 2:
+            if method == "GET":
+                return 200, self.schema_doc(segments[1])
+            if method == "POST":
+                doc = _json_body(body) or {}
+                doc["schema_name"] = segments[1]
+                return 201, self.create_schema(doc)
+            if method == "DELETE":
+                self.drop_schema(segments[1])
+                return 204, None
+        elif len(segments) == 3 and segments[2] == "table" and method == "POST":
+            return 201, self.create_table(segments[1], _json_body(body))
+        elif len(segments) == 5 and method == "POST":
+            sname, tname, kind = segments[1], segments[3], segments[4]
+            if kind == "column":
+                return 201, self.create_column(sname, tname, _json_body(body))
+            if kind == "key":
+                return 201, self.create_key(sname, tname, _json_body(body))
+            if kind == "foreignkey":
+                return 201, self.create_fkey(sname, tname, _json_body(body))
+        elif len(segments) == 4 and method == "DELETE":
+            self.drop_table(segments[1], segments[3])
+            return 204, None
+        elif len(segments) == 6 and segments[4] == "column" and method == "PUT":
+            return 200, self.alter_column(segments[1], segments[3], segments[5], _json_body(body))
+        elif len(segments) == 6 and segments[4] == "column" and method == "DELETE":
+            self.drop_column(segments[1], segments[3], segments[5])
+            return 204, None
+        if method == "GET":
+            return 200, self.element(segments)
+        raise RequestError(405, "Unsupported model request: {0} /{1}".format(method, "/".join(segments)))
+
+    def _handle_resource(self, method, element_path, resource, rest, body):
+        element = self.element(element_path)
+        if resource == "comment":
+            if method == "GET":
+                return 200, element.get("comment")
+            element["comment"] = body.decode("utf-8") if method == "PUT" else None
+            self._changed()
+            return 204, None
+        attr = {"annotation": "annotations", "acl": "acls", "acl_binding": "acl_bindings"}[resource]
+        values = element.setdefault(attr, {})
+        if method == "GET":
+            return 200, values.get(rest[0]) if rest else values
+        if method == "PUT":
+            if rest:
+                values[rest[0]] = _json_body(body)
+            else:
+                values.clear()
+                values.update(_json_body(body) or {})
+        elif method == "DELETE":
+            if rest:
+                values.pop(rest[0], None)
+            else:
+                values.clear()
+        else:
+            raise RequestError(405, "Unsupported method {0} on {1}".format(method, resource))
+        self._changed()
+        return 204, None
+
+    # Data -------------------------------------------------------------------------------------#
+
+    def _table_ref(self, segment):
+        """
+        :param segment: raw path element such as ETAS:Forecast or M:=ETAS:Forecast
+        :return: (schema, table), or None if the element is not a table reference
+        """
+        if "=" in segment.replace(":=", "") or "::" in segment or "(" in segment:
+            return None
+        if ":=" in segment:
+            segment = segment.split(":=", 1)[1]
+        parts = [unquote(p) for p in segment.split(":")]
+        if len(parts) == 2:
+            return parts[0], parts[1]
+        if len(parts) == 1:
+            for sname, schema in self.model["schemas"].items():
+                if parts[0] in schema["tables"]:
+                    return sname, parts[0]
+        return None
+
+    def _join(self, current, rows, target):
+        """
+        Follow the foreign key between the current table and the target table
+        :return: list of target rows related to the current rows
+        """
+        target_rows = list(self.rows[target].values())
+        for src, dst, outbound in ((current, target, True), (target, current, False)):
+            for fkey in self.table_doc(*src)["foreign_keys"]:
+                ref = fkey["referenced_columns"][0]
+                if (ref["schema_name"], ref["table_name"]) != dst:
+                    continue
+                fk_columns = [c["column_name"] for c in fkey["foreign_key_columns"]]
+                ref_columns = [c["column_name"] for c in fkey["referenced_columns"]]
+                if outbound:
+                    wanted = {tuple(row.get(c) for c in fk_columns) for row in rows}
+                    return [row for row in target_rows if tuple(row.get(c) for c in ref_columns) in wanted]
+                wanted = {tuple(row.get(c) for c in ref_columns) for row in rows}
+                return [row for row in target_rows if tuple(row.get(c) for c in fk_columns) in wanted]
+        raise RequestError(409, "No foreign key between {0}:{1} and {2}:{3}".format(*(current + target)))
+
+    def _resolve_path(self, segments):
+        """
+        Evaluate a data path: a table, then filters and implicit joins
+        :param segments: raw path elements
+        :return: ((schema, table), list of rows of the last table)
+        """
+        current = self._table_ref(segments[0])
+        if current is None or current not in self.rows:
+            raise RequestError(404, "Table {0} does not exist".format(unquote(segments[0])))
+        rows = list(self.rows[current].values())
+        for segment in segments[1:]:
+            target = self._table_ref(segment)
+            if target is not None:
+                if target not in self.rows:
+                    raise RequestError(404, "Table {0}:{1} does not exist".format(*target))
+                rows = self._join(current, rows, target)
+                current = target
+            else:
+                predicate = _FilterParser(segment, self.column_types(*current)).parse()
+                rows = [row for row in rows if predicate(row)]
+        return current, rows
+
+    @staticmethod
+    def _projection_item(item):
+        """
+        :param item: raw projection item, e.g. RID, M:RID, name:=M:Forecast_Name, max_rmt:=max(RMT)
+        :return: (output name, function or None, column name)
+        """
+        out = None
+        if ":=" in item:
+            out, item = item.split(":=", 1)
+            out = unquote(out)
+        m = re.match(r"^(\w+)\((.*)\)$", item)
+        function = None
+        if m is not None:
+            function, item = m.group(1), m.group(2)
+        column = unquote(item.rsplit(":", 1)[-1])
+        return out or column, function, column
+
+    @staticmethod
+    def _aggregate(function, column, rows):
+        values = [row.get(column) for row in rows] if column != "*" else list(rows)
+        present = [v for v in values if v is not None]
+        if function == "cnt":
+            return len(present)
+        if function == "cnt_d":
+            return len({json.dumps(v, sort_keys=True) for v in present})
+        if function == "min":
+            return min(present) if present else None
+        if function == "max":
+            return max(present) if present else None
+        if function == "sum":
+            return sum(present) if present else None
+        if function == "avg":
+            return sum(present) / len(present) if present else None
+        if function == "array":
+            return values
+        if function == "array_d":
+            unique = []
+            for v in values:
+                if v not in unique:
+                    unique.append(v)
+            return unique
+        raise RequestError(400, "Unsupported aggregate function: {0}".format(function))
+
+    @staticmethod
+    def _project(rows, items):
+        output = []
+        for row in rows:
+            result = {}
+            for out, function, column in items:
+                if column == "*":
+                    result.update(row)
+                else:
+                    result[out] = row.get(column)
+            output.append(result)
+        return output
+
+    def handle_data(self, method, api, raw_path, query, body):
+        """
+        :param method:
+        :param api: entity, attribute, aggregate or attributegroup
+        :param raw_path: path after the api name, still url encoded
+        :param query: parsed query string
+        :param body: request body bytes
+        :return: (status, response document or None)
+        """
+        m = re.match(r"^(?P<path>.*?)(?:@sort\((?P<sort>[^)]*)\))?(?:@before\((?P<before>[^)]*)\))?"
+                     r"(?:@after\((?P<after>[^)]*)\))?$", raw_path)
+        segments = [s for s in m.group("path").split("/") if s]
+        if not segments:
+            raise RequestError(400, "Missing table in data path")
+
+        if method == "POST" and api == "entity":
+            return 200, self.insert(self._table_ref(segments[0]), _json_body(body) or [], query)
+        if method == "PUT" and api == "attributegroup":
+            return 200, self.update(self._table_ref(segments[0]), segments[1], _json_body(body) or [])
+        if method == "DELETE" and api == "entity":
+            table, rows = self._resolve_path(segments)
+            self.delete(table, rows)
+            return 204, None
+        if method != "GET":
+            raise RequestError(405, "Unsupported data request: {0} {1}".format(method, api))
+
+        if api == "entity":
+            table, rows = self._resolve_path(segments)
+            types = self.column_types(*table)
+            output = [dict(row) for row in rows]
+        else:
+            table, rows = self._resolve_path(segments[:-1])
+            group_part, _, agg_part = segments[-1].partition(";")
+            groups = [self._projection_item(item) for item in _split_top(group_part, ",")]
+            aggs = [self._projection_item(item) for item in _split_top(agg_part, ",") if item]
+            if api == "attribute":
+                output = self._project(rows, groups)
+            elif api == "aggregate":
+                output = [{out: self._aggregate(function, column, rows) for out, function, column in groups}]
+            elif api == "attributegroup":
+                grouped = {}
+                for row in rows:
+                    grouped.setdefault(tuple(row.get(column) for _, _, column in groups), []).append(row)
+                output = []
+                for values, members in grouped.items():
+                    result = {out: value for (out, _, _), value in zip(groups, values)}
+                    for out, function, column in aggs:
+                        result[out] = self._aggregate(function, column, members) if function \
+                            else members[0].get(column)
+                    output.append(result)
+            else:
+                raise RequestError(404, "Unknown API: {0}".format(api))
+            # sort and paging keys refer to the output names
+            types = self.column_types(*table)
+            types.update({out: types.get(column) for out, _, column in groups + aggs})
+
+        if m.group("sort"):
+            output = self._sort(output, m.group("sort"), types, m.group("after"), m.group("before"))
+        if "limit" in query:
+            output = output[:int(query["limit"][0])]
+        return 200, output
+
+    @staticmethod
+    def _sort(rows, sort_spec, types, after, before):
+        keys = []
+        for item in sort_spec.split(","):
+            descending = item.endswith("::desc::")
+            keys.append((unquote(item[:-len("::desc::")] if descending else item), descending))
+
+        def compare(a, b):
+            for name, descending in keys:
+                x, y = a.get(name), b.get(name)
+                if x == y:
+                    continue
+                # nulls sort last, as in ERMrest
+                if x is None or y is None:
+                    result = 1 if x is None else -1
+                else:
+                    result = -1 if x < y else 1
+                return -result if descending else result
+            return 0
+
+        rows = sorted(rows, key=functools.cmp_to_key(compare))
+
+        def bound(spec):
+            values = [None if v == "::null::" else unquote(v) for v in spec.split(",")]
+            return {name: _coerce(value, types.get(name)) for (name, _), value in zip(keys, values)}
+
+        if after is not None:
+            limit = bound(after)
+            rows = [row for row in rows if compare(row, limit) > 0]
+        if before is not None:
+            limit = bound(before)
+            rows = [row for row in rows if compare(row, limit) < 0]
+        return rows
+
+    def _index_add(self, table, rid, row, skip_conflicts):
+        indexes = self.indexes[table]
+        entries = []
+        for columns, index in indexes.items():
+            values = tuple(row.get(c) for c in columns)
+            if None in values:
+                continue
+            if index.get(values, rid) != rid:
+                if skip_conflicts:
+                    return False
+                raise RequestError(409, "Duplicate values {0} for key {1} of {2}:{3}".format(
+                    list(values), list(columns), *table))
+            entries.append((index, values))
+        for index, values in entries:
+            index[values] = rid
+        return True
+
+    def _index_remove(self, table, row):
+        for columns, index in self.indexes[table].items():
+            index.pop(tuple(row.get(c) for c in columns), None)
+
+    def insert(self, table, rows, query):
+        if table is None or table not in self.rows:
+            raise RequestError(404, "Table does not exist")
+        tdoc = self.table_doc(*table)
+        skip = query.get("onconflict", [""])[0] == "skip"
+        nondefaults = set(query.get("nondefaults", [""])[0].split(","))
+        defaults = set(query.get("defaults", [""])[0].split(","))
+        inserted = []
+        for given in rows:
+            now = self._now()
+            row = {}
+            for column in tdoc["column_definitions"]:
+                name = column["name"]
+                if name in ("RID", "RCT", "RMT") and not (name in nondefaults and name in given):
+                    row[name] = self._new_rid() if name == "RID" else now
+                elif name in given and name not in defaults:
+                    row[name] = given[name]
+                else:
+                    row[name] = column["default"]
+                    if column["type"]["typename"] in ("ermrest_curie", "ermrest_uri") and row[name]:
+                        row[name] = row[name].format(RID=row["RID"])   # e.g. 'SCEC:{RID}'
+                if row[name] is None and not column["nullok"]:
+                    raise RequestError(409, "Column {0} of {1}:{2} may not be null".format(name, *table))
+            if not self._index_add(table, row["RID"], row, skip):
+                continue
+            self.rows[table][row["RID"]] = row
+            inserted.append(dict(row))
+        if inserted:
+            self.data_version += 1
+        return inserted
+
+    def update(self, table, spec, rows):
+        """
+        attributegroup update: spec is 'K1,K2;T1,T2' (correlation columns; target columns)
+        """
+        if table is None or table not in self.rows:
+            raise RequestError(404, "Table does not exist")
+        key_part, _, target_part = spec.partition(";")
+        keys = [self._projection_item(item) for item in key_part.split(",")]
+        targets = [self._projection_item(item) for item in target_part.split(",") if item]
+        key_columns = tuple(column for _, _, column in keys)
+        index = self.indexes[table].get(key_columns)
+        updated = []
+        for given in rows:
+            values = tuple(given.get(out) for out, _, _ in keys)
+            if index is not None:
+                rid = index.get(values)
+                matches = [self.rows[table][rid]] if rid is not None else []
+            else:
+                matches = [row for row in self.rows[table].values()
+                           if tuple(row.get(c) for c in key_columns) == values]
+            for row in matches:
+                self._index_remove(table, row)
+                for out, _, column in targets:
+                    row[column] = given.get(out)
+                row["RMT"] = self._now()
+                self._index_add(table, row["RID"], row, False)
+            if matches:
+                updated.append(given)
+        if updated:
+            self.data_version += 1
+        return updated
+
+    def delete(self, table, rows):
+        for row in rows:
+            self._index_remove(table, row)
+            self.rows[table].pop(row["RID"], None)
+        if rows:
+            self.data_version += 1
+
+    def handle(self, method, segments, raw_rest, query, headers, body):
+        """
+        Handle one request below /ermrest/catalog/<id>
+        :return: (status, extra headers, response document or None)
+        """
+        with self.lock:
+            if not segments:
+                if method == "GET":
+                    return 200, {}, {"id": self.id, "snaptime": self.snaptime(), "annotations": self.model["annotations"]}
+                raise RequestError(405, "Unsupported catalog request")
+            api = segments[0]
+            if api in ("entity", "attribute", "aggregate", "attributegroup"):
+                status, doc = self.handle_data(method, api, raw_rest.split("/", 1)[1] if "/" in raw_rest else "",
+                                               query, body)
+                return status, {}, doc
+            if api in ("schema", "annotation", "acl", "comment"):
+                if method == "GET" and segments == ["schema"] and headers.get("If-None-Match") == self.etag:
+                    return 304, {"ETag": self.etag}, None
+                status, doc = self.handle_model(method, segments, body)
+                return status, ({"ETag": self.etag} if segments == ["schema"] else {}), doc
+            raise RequestError(404, "Unknown catalog resource: {0}".format(api))
+
+# Hatrac -------------------------------------------------------------------------------------------#
+
+class LocalHatrac:
+    """
+    In-memory Hatrac object store: versioned objects and chunked upload jobs
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}   # path -> list of (version, data, md5 base64, content type)
+        self.jobs = {}      # job id -> dict
+        self._next_id = 0
+
+    def _new_id(self):
+        self._next_id += 1
+        return "{0:08X}".format(self._next_id)
+
+    def _store(self, path, data, content_type, md5=None):
+        digest = base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+        if md5 is not None and md5 != digest:
+            raise RequestError(409, "Content-MD5 mismatch for {0}".format(path))
+        version = self._new_id()
+        self.objects.setdefault(path, []).append((version, data, digest, content_type))
+        return "{0}:{1}".format(path, version)
+
+    def _find(self, path):
+        name, _, version = path.partition(":")
+        versions = self.objects.get(name)
+        if not versions:
+            raise RequestError(404, "Object {0} does not exist".format(name))
+        if version:
+            for entry in versions:
+                if entry[0] == version:
+                    return entry
+            raise RequestError(404, "Version {0} does not exist".format(path))
+        return versions[-1]
+
+    def handle(self, method, path, headers, body):
+        """
+        :param path: request path starting with /hatrac, without the query
+        :return: (status, extra headers, body bytes or document)
+        """
+        with self.lock:
+            if ";upload" in path:
+                name, _, rest = path.partition(";upload")
+                parts = [p for p in rest.split("/") if p]
+                if method == "POST" and not parts:
+                    job = _json_body(body) or {}
+                    job_id = self._new_id()
+                    self.jobs[job_id] = {"path": name, "chunk-length": int(job.get("chunk-length", 0)),
+                                         "content-length": int(job.get("content-length", 0)),
+                                         "content-md5": job.get("content-md5"),
+                                         "content-type": job.get("content-type", "application/octet-stream"),
+                                         "chunks": {}}
+                    url = "{0};upload/{1}".format(name, job_id)
+                    return 201, {"Location": url, "Content-Type": "text/uri-list"}, (url + "\n").encode("utf-8")
+                job = self.jobs.get(parts[0]) if parts else None
+                if job is None:
+                    raise RequestError(404, "Upload job does not exist")
+                if method == "PUT" and len(parts) == 2:
+                    job["chunks"][int(parts[1])] = body
+                    return 204, {}, b""
+                if method == "POST" and len(parts) == 1:
+                    data = b"".join(job["chunks"][i] for i in sorted(job["chunks"]))
+                    if len(data) != job["content-length"]:
+                        raise RequestError(409, "Upload job is missing chunks")
+                    url = self._store(name, data, job["content-type"], job["content-md5"])
+                    del self.jobs[parts[0]]
+                    return 201, {"Location": url, "Content-Type": "text/uri-list"}, (url + "\n").encode("utf-8")
+                if method == "GET":
+                    return 200, {}, {"url": "{0};upload/{1}".format(name, parts[0]), "target": name,
+                                     "chunk-length": job["chunk-length"], "content-length": job["content-length"],
+                                     "content-md5": job["content-md5"]}
+                if method == "DELETE":
+                    del self.jobs[parts[0]]
+                    return 204, {}, b""
+                raise RequestError(405, "Unsupported upload job request")
+
+            if ";" in path:
+                return 204, {}, b""   # ;acl and other sub-resources are accepted and ignored
+            if method == "PUT":
+                if headers.get("Content-Type", "").startswith("application/x-hatrac-namespace"):
+                    return 201, {}, b""
+                url = self._store(path, body, headers.get("Content-Type", "application/octet-stream"),
+                                  headers.get("Content-MD5"))
+                return 201, {"Location": url, "Content-Type": "text/uri-list"}, (url + "\n").encode("utf-8")
+            if method in ("GET", "HEAD"):
+                version, data, md5, content_type = self._find(path)
+                return 200, {"Content-Type": content_type, "Content-MD5": md5,
+                             "Content-Location": "{0}:{1}".format(path.partition(":")[0], version)}, data
+            if method == "DELETE":
+                self._find(path)
+                name, _, version = path.partition(":")
+                if version:
+                    self.objects[name] = [e for e in self.objects[name] if e[0] != version]
+                else:
+                    del self.objects[name]
+                return 204, {}, b""
+            raise RequestError(405, "Unsupported hatrac request")
+
+# Server -------------------------------------------------------------------------------------------#
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _dispatch(self, method):
+        body = self._read_body()
+        try:
+            status, headers, payload = self.server.deriva.handle(method, self.path, self.headers, body)
+        except RequestError as err:
+            status, headers, payload = err.status, {"Content-Type": "text/plain"}, str(err).encode("utf-8")
+        if not isinstance(payload, bytes):
+            payload = b"" if payload is None and status in (204, 304) else json.dumps(payload).encode("utf-8")
+            headers.setdefault("Content-Type", "application/json")
+        self.server.deriva.delay(len(body) + len(payload))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if method == "HEAD":
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            return
+        if status in (204, 304):
+            payload = b""
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_HEAD(self):
+        self._dispatch("HEAD")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+class LocalDeriva:
+    """
+    Local ERMrest and Hatrac stand-in, served over HTTP from a background thread
+    """
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, bandwidth=None):
+        """
+        :param host:
+        :param port: 0 picks a free port
+        :param latency: seconds added to every request
+        :param bandwidth: bytes per second for request plus response bodies, None for unlimited
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.catalogs = {}
+        self.hatrac = LocalHatrac()
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.deriva = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+    def catalog(self, catalog_id):
+        """
+        :param catalog_id: catalog id, any snapshot suffix is ignored
+        :return: LocalCatalog, created empty on first use
+        """
+        catalog_id = str(catalog_id).split("@", 1)[0]
+        with self._lock:
+            if catalog_id not in self.catalogs:
+                self.catalogs[catalog_id] = LocalCatalog(catalog_id)
+            return self.catalogs[catalog_id]
+
+    def delay(self, nbytes):
+        seconds = self.latency
+        if self.bandwidth:
+            seconds += nbytes / self.bandwidth
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def handle(self, method, raw_url, headers, body):
+        raw_path, _, raw_query = raw_url.partition("?")
+        query = parse_qs(raw_query)
+        if raw_path.startswith("/hatrac/") or raw_path == "/hatrac":
+            return self.hatrac.handle(method, unquote(raw_path), headers, body)
+        m = re.match(r"^/ermrest/catalog/(?P<id>[^/]+)/?(?P<rest>.*)$", raw_path)
+        if m is None:
+            raise RequestError(404, "Not found: {0}".format(raw_path))
+        rest = m.group("rest")
+        segments = [unquote(s) for s in rest.split("/") if s]
+        return self.catalog(unquote(m.group("id"))).handle(method, segments, rest, query, headers, body)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def load_etas_model(catalog):
+    """
+    Create the ETAS schema from scec_model.py's table definitions, plus the vocabularies and
+    the metadata, typed and Term columns of add_columns.py, directly in a local catalog
+    :param catalog: LocalCatalog
+    :return:
+    """
+    from scec_model import etas_table_defs
+    from add_columns import (VOCAB_SCHEMA, forecast_metadata_columns, typed_column_defs, term_column_defs,
+                             term_fkey_defs, vocabulary_table_defs)
+    with catalog.lock:
+        catalog.create_schema({"schema_name": "ETAS"})
+        for tdef in etas_table_defs:
+            catalog.create_table("ETAS", json.loads(json.dumps(tdef)))
+        catalog.create_schema({"schema_name": VOCAB_SCHEMA})
+        for tdef in vocabulary_table_defs:
+            catalog.create_table(VOCAB_SCHEMA, json.loads(json.dumps(tdef)))
+        for cdef in forecast_metadata_columns + typed_column_defs + term_column_defs:
+            catalog.create_column("ETAS", "Forecast", json.loads(json.dumps(cdef)))
+        for fkdef in term_fkey_defs:
+            catalog.create_fkey("ETAS", "Forecast", json.loads(json.dumps(fkdef)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local ERMrest/Hatrac stand-in for offline benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--catalog-id", default="5", help="catalog to prepare (default: %(default)s)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency added to every request")
+    parser.add_argument("--bandwidth-mbit", type=float, default=0.0,
+                        help="bandwidth limit for request and response bodies, 0 for unlimited")
+    parser.add_argument("--etas", action="store_true", help="create the ETAS schema of scec_model.py")
+    parser.add_argument("--forecasts", type=int, default=0,
+                        help="insert this many synthetic Forecast rows (implies --etas)")
+    args = parser.parse_args()
+
+    bandwidth = args.bandwidth_mbit * 1000000 / 8 if args.bandwidth_mbit else None
+    server = LocalDeriva(args.host, args.port, args.latency_ms / 1000.0, bandwidth)
+    catalog = server.catalog(args.catalog_id)
+    if args.etas or args.forecasts:
+        load_etas_model(catalog)
+    if args.forecasts:
+        from bench_parse_names import synthetic_corpus
+        rows = [{"Forecast_Name": name} for name in synthetic_corpus(args.forecasts, malformed_every=0)]
+        catalog.insert(("ETAS", "Forecast"), rows, {})
+        print("Inserted {0} Forecast rows".format(args.forecasts))
+
+    print("Serving catalog {0} at {1} (export SCEC_DERIVA_SERVER={1})".format(args.catalog_id, server.url))
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
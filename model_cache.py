@@ -0,0 +1,135 @@
+"""model_cache.py: On-disk cache of the introspected catalog model, shared by the scripts in this repo.
+
+Model.from_catalog(...) downloads and builds the full schema document before any work starts.
+Here the schema document is kept locally in pickle form, keyed by the catalog URI (host,
+catalog id and snapshot, if any), together with the ETag ERMrest returned for it. A later
+run revalidates it with one conditional GET of /schema, which comes back 304 Not Modified
+with an empty body when the model has not changed. Snapshot catalogs are immutable, so
+their cached model is used without any request at all.
+
+The same Model is handed to the pathbuilder, so a script builds one model per run instead
+of one for chisel and another for getPathBuilder().
+
+Typical use:
+    catalog = connect_catalog(hostname, catalog_id)
+    model = load_model(catalog)
+    pb = path_builder(catalog, model)
+
+Setting SCEC_DERIVA_SERVER (e.g. http://127.0.0.1:8080) sends every connection made through
+connect_catalog and connect_hatrac to that server instead of the hardcoded hostname, which is
+how the scripts are pointed at the local stand-in server in local_deriva.py.
+
+Connections are instrumented (see request_metrics.py), so every script that connects
+through here reports its request counts, latencies and bytes moved at exit.
+"""
+import os
+import pickle
+import hashlib
+from urllib.parse import urlsplit
+from deriva.core import ErmrestCatalog, HatracStore, get_credential
+from request_metrics import instrument
+from deriva.chisel import Model
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".scec_deriva", "model_cache")
+
+SERVER_ENV = "SCEC_DERIVA_SERVER"
+
+def server_override(hostname, scheme='https'):
+    """
+    Apply the SCEC_DERIVA_SERVER override, if it is set
+    :param hostname:
+    :param scheme:
+    :return: tuple of (scheme, hostname) to connect to
+    """
+    server = os.environ.get(SERVER_ENV)
+    if not server:
+        return scheme, hostname
+    parts = urlsplit(server if "://" in server else "http://" + server)
+    return parts.scheme, parts.netloc
+
+def connect_catalog(hostname, catalog_id, scheme='https'):
+    """
+    Connect to an ERMrest catalog with the stored credential for the host
+    :param hostname:
+    :param catalog_id: catalog id, optionally with an @snapshot suffix
+    :param scheme:
+    :return: ErmrestCatalog
+    """
+    scheme, hostname = server_override(hostname, scheme)
+    return instrument(ErmrestCatalog(scheme, hostname, catalog_id, credentials=get_credential(hostname)))
+
+def connect_hatrac(hostname, scheme='https'):
+    """
+    Connect to the Hatrac object store of a host with the stored credential for the host
+    :param hostname:
+    :param scheme:
+    :return: HatracStore
+    """
+    scheme, hostname = server_override(hostname, scheme)
+    return instrument(HatracStore(scheme, hostname, credentials=get_credential(hostname)))
+
+def _cache_file(catalog, cache_dir):
+    key = hashlib.sha1(catalog.get_server_uri().encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, key + ".pickle")
+
+def _read_cache(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+
+def _write_cache(path, entry):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def load_model_doc(catalog, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Return the catalog's schema document, from the local cache when it is still current
+    :param catalog: ErmrestCatalog (or ErmrestSnapshot)
+    :param cache_dir: where cached models are kept
+    :return: schema document (dict)
+    """
+    path = _cache_file(catalog, cache_dir)
+    entry = _read_cache(path)
+    if entry is not None and entry["server_uri"] == catalog.get_server_uri():
+        if "@" in entry["server_uri"].rsplit("/", 1)[-1]:
+            return entry["model_doc"]   # snapshots never change
+        if entry.get("etag"):
+            r = catalog.get("/schema", headers={"Accept": "application/json", "If-None-Match": entry["etag"]})
+            if r.status_code == 304:
+                return entry["model_doc"]
+            model_doc = r.json()
+            _write_cache(path, {"server_uri": catalog.get_server_uri(),
+                                "etag": r.headers.get("ETag"), "model_doc": model_doc})
+            return model_doc
+
+    r = catalog.get("/schema")
+    model_doc = r.json()
+    _write_cache(path, {"server_uri": catalog.get_server_uri(),
+                        "etag": r.headers.get("ETag"), "model_doc": model_doc})
+    return model_doc
+
+def load_model(catalog, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Build the chisel Model of a catalog from the cached schema document
+    :param catalog: ErmrestCatalog (or ErmrestSnapshot)
+    :param cache_dir: where cached models are kept
+    :return: Model
+    """
+    return Model(catalog, load_model_doc(catalog, cache_dir))
+
+def path_builder(catalog, model):
+    """
+    Build a pathbuilder over an already loaded model, instead of letting
+    getPathBuilder() download the schema again
+    :param catalog: ErmrestCatalog (or ErmrestSnapshot)
+    :param model: Model from load_model
+    :return: pathbuilder
+    """
+    # getPathBuilder() asks the catalog for its model; answer with the one we have
+    catalog.getCatalogModel = lambda: model
+    return catalog.getPathBuilder()
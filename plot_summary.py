@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+
+"""plot_summary.py: This script maintains the plot summary columns of the Evaluation table,
+Plot_Count (number of plots) and Plot_Previews (Filename, URL and Thumbnail_URL of the
+first MAX_PREVIEWS plots, by Filename), from the Evaluation_Plot rows.
+
+The compact Evaluation view in scec_config.py reads Plot_Previews, so a recordset page
+reads one plain column instead of having Chaise run an inbound Evaluation_Plot aggregate
+for every row on the page.
+
+Run it after plots are added or changed. The catalog is read from a pinned snapshot and
+only the Evaluations whose summary may have changed are recomputed:
+    - the Evaluations of the Evaluation_Plot rows modified after the RMT watermark of the
+      last run (kept in ~/.scec_deriva/plot_summary_watermark.json), and
+    - the Evaluations whose Plot_Count differs from their current number of plots, which
+      covers deleted plots and Evaluations never summarized.
+--full recomputes every Evaluation.
+"""
+import os
+import sys
+import time
+import argparse
+from dataclasses import dataclass
+from deriva.core import urlquote
+from model_cache import connect_catalog
+from populate_columns import load_watermark, save_watermark
+
+#
+# Plots listed in Plot_Previews; Plot_Count still counts all of them
+MAX_PREVIEWS = 8
+
+DEFAULT_WATERMARK_FILE = os.path.join(os.path.expanduser("~"), ".scec_deriva", "plot_summary_watermark.json")
+
+PLOT_URL = "/attribute/ETAS:Evaluation_Plot"
+
+PREVIEW_COLUMNS = ["Filename", "URL", "Thumbnail_URL"]
+
+#
+# Keep the filter URLs well under common server and proxy limits
+MAX_URL_LENGTH = 4000
+
+#
+# Rows per request when listing, and per summary update request
+PAGE_SIZE = 10000
+UPDATE_BATCH = 500
+
+@dataclass
+class SummaryStats:
+    evaluations: int = 0
+    changed_plots: int = 0
+    recounted: int = 0
+    updated: int = 0
+    requests: int = 0
+    elapsed: float = 0.0
+
+    def report(self):
+        """
+        Print a one line summary of the sync
+        :return:
+        """
+        print("Plot summary: {0} Evaluations, {1} from changed plots, {2} from count differences, "
+              "{3} updated, {4} requests, {5:.3f} s".format(self.evaluations, self.changed_plots,
+                                                              self.recounted, self.updated, self.requests,
+                                                              self.elapsed))
+
+def _iter_keyset(catalog, url, stats, page_size=PAGE_SIZE):
+    last_rid = None
+    while True:
+        after = "@after({0})".format(urlquote(last_rid)) if last_rid is not None else ""
+        page = catalog.get("{0}@sort(RID){1}?limit={2}".format(url, after, page_size)).json()
+        stats.requests += 1
+        yield from page
+        if len(page) < page_size:
+            return
+        last_rid = page[-1]["RID"]
+
+def _filter_urls(column, values, suffix):
+    """
+    Split a disjunction of column=value filters into URLs under MAX_URL_LENGTH
+    :return: generator of URLs
+    """
+    filters = []
+    length = len(PLOT_URL) + len(suffix)
+    for value in sorted(values):
+        term = "{0}={1}".format(urlquote(column), urlquote(value))
+        if filters and length + len(term) + 1 > MAX_URL_LENGTH:
+            yield "{0}/{1}{2}".format(PLOT_URL, ";".join(filters), suffix)
+            filters = []
+            length = len(PLOT_URL) + len(suffix)
+        filters.append(term)
+        length += len(term) + 1
+    if filters:
+        yield "{0}/{1}{2}".format(PLOT_URL, ";".join(filters), suffix)
+
+def changed_evaluations(snapshot, watermark, stats):
+    """
+    :return: set of Evaluation RIDs with a plot modified after the watermark
+    """
+    url = "/attributegroup/ETAS:Evaluation_Plot/RMT::gt::{0}/Evaluation".format(urlquote(watermark))
+    stats.requests += 1
+    return {row["Evaluation"] for row in snapshot.get(url).json() if row["Evaluation"] is not None}
+
+def recount_evaluations(snapshot, stats):
+    """
+    :return: tuple of (set of every Evaluation RID, set of Evaluation RIDs whose Plot_Count is wrong)
+    """
+    stats.requests += 1
+    counts = {row["Evaluation"]: row["n"] for row in
+              snapshot.get("/attributegroup/ETAS:Evaluation_Plot/Evaluation;n:=cnt(*)").json()}
+    evaluations = set()
+    wrong = set()
+    for row in _iter_keyset(snapshot, "/attribute/ETAS:Evaluation/RID,Plot_Count", stats):
+        evaluations.add(row["RID"])
+        if row["Plot_Count"] != counts.get(row["RID"], 0):
+            wrong.add(row["RID"])
+    return evaluations, wrong
+
+def plot_summaries(snapshot, evaluations, stats, full=False):
+    """
+    Compute Plot_Count and Plot_Previews
+    :param snapshot: ErmrestSnapshot
+    :param evaluations: Evaluation RIDs to summarize
+    :param stats: SummaryStats
+    :param full: read every plot instead of filtering on the Evaluations
+    :return: dict of Evaluation RID -> {"Plot_Count": int, "Plot_Previews": list}
+    """
+    projection = "/" + ",".join(["RID", "Evaluation"] + PREVIEW_COLUMNS)
+    if full:
+        rows = _iter_keyset(snapshot, PLOT_URL + projection, stats)
+    else:
+        rows = []
+        for url in _filter_urls("Evaluation", evaluations, projection):
+            stats.requests += 1
+            rows.extend(snapshot.get(url).json())
+    plots = {rid: [] for rid in evaluations}
+    for row in rows:
+        if row["Evaluation"] in plots:
+            plots[row["Evaluation"]].append(row)
+    summaries = {}
+    for rid, rows in plots.items():
+        rows.sort(key=lambda row: (row["Filename"] or "", row["RID"]))
+        summaries[rid] = {"Plot_Count": len(rows),
+                          "Plot_Previews": [{column: row[column] for column in PREVIEW_COLUMNS}
+                                            for row in rows[:MAX_PREVIEWS]]}
+    return summaries
+
+def update_summaries(catalog, summaries, stats):
+    """
+    Write the summaries to the live catalog, correlated on RID
+    :return:
+    """
+    updates = [dict(summary, RID=rid) for rid, summary in sorted(summaries.items())]
+    for i in range(0, len(updates), UPDATE_BATCH):
+        catalog.put("/attributegroup/ETAS:Evaluation/RID;Plot_Count,Plot_Previews", json=updates[i:i + UPDATE_BATCH])
+        stats.requests += 1
+    stats.updated += len(updates)
+
+def sync_summaries(catalog, watermark=None, full=False):
+    """
+    Recompute the plot summaries that may have changed since the watermark
+    :param catalog: ErmrestCatalog for the live catalog
+    :param watermark: Evaluation_Plot RMT saved by the last run, None to rely on the counts only
+    :param full: recompute every Evaluation
+    :return: tuple of (SummaryStats, new watermark)
+    """
+    start = time.perf_counter()
+    stats = SummaryStats()
+    snapshot = catalog.latest_snapshot()
+    stats.requests += 1
+    rows = snapshot.get("/aggregate/ETAS:Evaluation_Plot/max_rmt:=max(RMT)").json()
+    new_watermark = rows[0]["max_rmt"] if rows else None
+
+    evaluations, wrong = recount_evaluations(snapshot, stats)
+    if full:
+        todo = evaluations
+    else:
+        changed = changed_evaluations(snapshot, watermark, stats) if watermark is not None else set()
+        stats.changed_plots = len(changed & evaluations)
+        stats.recounted = len(wrong - changed)
+        todo = (changed & evaluations) | wrong
+    stats.evaluations = len(todo)
+    if todo:
+        update_summaries(catalog, plot_summaries(snapshot, todo, stats, full), stats)
+    stats.elapsed = time.perf_counter() - start
+    return stats, new_watermark
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the Plot_Count and Plot_Previews columns of Evaluation")
+    parser.add_argument("--full", action="store_true", help="recompute the summary of every Evaluation")
+    parser.add_argument("--watermark-file", default=DEFAULT_WATERMARK_FILE,
+                        help="where the Evaluation_Plot RMT watermark is kept (default: %(default)s)")
+    args = parser.parse_args()
+
+    hostname = 'forecast.derivacloud.org'  # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
+    catalog_id = '5'  # this was a throw-away catalog used to test this script (change to TBD)
+
+    catalog = connect_catalog(hostname, catalog_id)
+    watermark = None if args.full else load_watermark(args.watermark_file, hostname, catalog_id)
+    stats, new_watermark = sync_summaries(catalog, watermark, args.full)
+    stats.report()
+    if new_watermark is not None:
+        save_watermark(args.watermark_file, hostname, catalog_id, new_watermark)
+
+    sys.exit(0)
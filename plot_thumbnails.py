@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+
+
+"""plot_thumbnails.py: This script makes small thumbnails of the Evaluation_Plot PNGs, stores
+them in Hatrac and records them in the Evaluation_Plot Thumbnail_URL column, so the Preview
+columns that scec_config.py defines for Evaluation and Evaluation_Plot load a few KB per plot
+instead of the full size image.
+
+It is meant to run after the plots are uploaded (hatrac_upload.py and the bulk upload),
+and only handles the Evaluation_Plot rows that have no Thumbnail_URL yet (or all rows with
+--all). For each distinct plot MD5:
+    - a thumbnail already in the local cache (~/.scec_deriva/thumbnails/<size>/<md5>.png)
+      is reused,
+    - otherwise the source PNG is read from the local upload tree (--manifest, matched by
+      MD5 through the checksum cache) or downloaded from the plot's Hatrac URL, and scaled
+      down on a pool of worker processes.
+Thumbnails are stored under a content addressed Hatrac name, /hatrac/ETAS/thumbnails/<size>/<md5>.png,
+so plots with the same content share one thumbnail and a thumbnail is only sent once.
+
+Thumbnails are made with Pillow, which only this script needs:
+    pip install Pillow
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+from dataclasses import dataclass
+from requests import HTTPError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from deriva.core import urlquote
+from model_cache import connect_catalog, connect_hatrac
+from forecast_scanner import read_manifest
+from checksum_cache import ChecksumCache, DEFAULT_CACHE_FILE, md5_file, md5_hex_to_base64
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DEFAULT_THUMBNAIL_DIR = os.path.join(os.path.expanduser("~"), ".scec_deriva", "thumbnails")
+
+#
+# Longest side of a thumbnail in pixels; the previews are shown 120 pixels wide,
+# so this leaves room for high density displays
+DEFAULT_SIZE = 240
+
+DEFAULT_WORKERS = os.cpu_count() or 4
+
+DEFAULT_TRANSFERS = 4
+
+HATRAC_THUMBNAIL_DIR = "/hatrac/ETAS/thumbnails"
+
+#
+# Rows per Thumbnail_URL update request
+UPDATE_BATCH = 500
+
+PLOT_URL = "/attribute/ETAS:Evaluation_Plot"
+
+@dataclass
+class ThumbnailStats:
+    rows: int = 0
+    plots: int = 0
+    cached: int = 0
+    downloaded: int = 0
+    generated: int = 0
+    uploaded: int = 0
+    failed: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    elapsed: float = 0.0
+
+    def report(self):
+        """
+        Print a one line summary of the thumbnail pass
+        :return:
+        """
+        print("Thumbnails: {0} rows, {1} distinct plots, {2} cached, {3} downloaded, {4} generated, "
+              "{5} uploaded, {6} failed, {7:.1f} MB of plots -> {8:.1f} MB of thumbnails, {9:.3f} s".format(
+                  self.rows, self.plots, self.cached, self.downloaded, self.generated, self.uploaded,
+                  self.failed, self.bytes_in / (1024 * 1024), self.bytes_out / (1024 * 1024), self.elapsed))
+
+def make_thumbnail(source_path, thumbnail_path, size=DEFAULT_SIZE):
+    """
+    Scale a plot down so its longest side is at most size pixels. Runs in a worker process.
+    :param source_path: PNG file
+    :param thumbnail_path: where to write the thumbnail PNG
+    :param size: longest side in pixels
+    :return: thumbnail size in bytes
+    """
+    with Image.open(source_path) as image:
+        image.thumbnail((size, size), Image.LANCZOS)
+        if image.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            image = image.convert("RGBA")
+        tmp_path = thumbnail_path + ".tmp"
+        image.save(tmp_path, format="PNG", optimize=True)
+    os.replace(tmp_path, thumbnail_path)
+    return os.path.getsize(thumbnail_path)
+
+def thumbnail_hatrac_path(md5, size=DEFAULT_SIZE):
+    return "{0}/{1}/{2}.png".format(HATRAC_THUMBNAIL_DIR, size, md5)
+
+def fetch_plot_rows(catalog, all_rows=False, page_size=10000):
+    """
+    Read the Evaluation_Plot rows to make thumbnails for, in RID order, one page at a time
+    :param catalog: ErmrestCatalog
+    :param all_rows: include the rows that already have a Thumbnail_URL
+    :param page_size: rows per request
+    :return: generator of rows with RID, URL, MD5 and Length
+    """
+    base = PLOT_URL + ("" if all_rows else "/Thumbnail_URL::null::") + "/RID,URL,MD5,Length@sort(RID)"
+    after = ""
+    while True:
+        page = catalog.get("{0}{1}?limit={2}".format(base, after, page_size)).json()
+        yield from page
+        if len(page) < page_size:
+            return
+        after = "@after({0})".format(urlquote(page[-1]["RID"]))
+
+def local_plots(manifest, checksum_cache_file=DEFAULT_CACHE_FILE):
+    """
+    Map the MD5 of every PNG in an upload manifest to its local path
+    :param manifest: manifest written by forecast_scanner.py
+    :param checksum_cache_file: checksum cache, so unchanged files are not hashed again
+    :return: dict of md5 hex -> local path
+    """
+    root, records = read_manifest(manifest)
+    paths = [os.path.join(root, rec.path) for rec in records if rec.path.lower().endswith(".png")]
+    cache = ChecksumCache(checksum_cache_file)
+    checksums = cache.checksum_files(paths)
+    cache.close()
+    return {md5: path for path, md5 in checksums.items()}
+
+class ThumbnailPipeline:
+    """
+    Download, scale and upload stages for the thumbnails of the plots of Evaluation_Plot rows
+    """
+    def __init__(self, hostname, size=DEFAULT_SIZE, cache_dir=DEFAULT_THUMBNAIL_DIR,
+                 workers=DEFAULT_WORKERS, transfers=DEFAULT_TRANSFERS, local_files=None):
+        """
+        :param hostname: server holding the plots and thumbnails
+        :param size: longest side of a thumbnail in pixels
+        :param cache_dir: local thumbnail cache
+        :param workers: thumbnail worker processes
+        :param transfers: concurrent Hatrac downloads and uploads
+        :param local_files: dict of md5 -> local path of plots that need not be downloaded
+        """
+        self.hostname = hostname
+        self.size = size
+        self.cache_dir = os.path.join(cache_dir, str(size))
+        self.workers = workers
+        self.transfers = transfers
+        self.local_files = local_files or {}
+        self.stats = ThumbnailStats()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _store(self):
+        store = getattr(self._local, "store", None)
+        if store is None:
+            store = self._local.store = connect_hatrac(self.hostname)
+        return store
+
+    def cached_path(self, md5):
+        return os.path.join(self.cache_dir, md5 + ".png")
+
+    def _download(self, url, md5, download_dir):
+        path = os.path.join(download_dir, md5 + ".png")
+        self._store().get_obj(url.split("?")[0], destfilename=path)
+        with self._stats_lock:
+            self.stats.downloaded += 1
+            self.stats.bytes_in += os.path.getsize(path)
+        return path
+
+    def _upload(self, md5):
+        hatrac_path = thumbnail_hatrac_path(md5, self.size)
+        store = self._store()
+        thumbnail_md5 = md5_hex_to_base64(md5_file(self.cached_path(md5))[0])
+        try:
+            stored = store.content_equals(hatrac_path, md5=thumbnail_md5)
+        except HTTPError as err:
+            if err.response is None or err.response.status_code != 404:
+                raise
+            stored = False   # no thumbnail under this name yet
+        if not stored:
+            store.put_loc(hatrac_path, self.cached_path(md5), md5=thumbnail_md5, content_type="image/png",
+                          chunked=False, create_parents=True)
+            with self._stats_lock:
+                self.stats.uploaded += 1
+        return hatrac_path
+
+    def run(self, rows):
+        """
+        Make and store the thumbnails of the plots of a stream of Evaluation_Plot rows. Rows are
+        only read while fewer than a window of distinct plots are in flight, so memory does not
+        grow with the table, and each row is handed back as soon as its thumbnail is stored.
+        :param rows: iterable of rows with RID, URL and MD5
+        :return: generator of (RID, thumbnail URL) for the rows whose thumbnail is stored
+        """
+        start = time.perf_counter()
+        window = 2 * (self.workers + self.transfers)
+        stored = set()      # plots whose thumbnail is stored, so later rows with the same MD5 reuse it
+        failed = set()
+        waiting = {}        # md5 -> (plot URL, RIDs of the rows waiting for its thumbnail)
+        stages = {}         # future -> (stage, md5)
+        rows = iter(rows)
+
+        with tempfile.TemporaryDirectory(prefix="plot_thumbnails") as download_dir, \
+                ThreadPoolExecutor(max_workers=self.transfers) as transfers, \
+                ProcessPoolExecutor(max_workers=self.workers) as workers:
+
+            def scale(md5, source):
+                stages[workers.submit(make_thumbnail, source, self.cached_path(md5), self.size)] = ("scale", md5)
+
+            def store(md5):
+                stages[transfers.submit(self._upload, md5)] = ("store", md5)
+
+            exhausted = False
+            while True:
+                # Plots in the local upload tree go straight to a worker process; the others are
+                # downloaded first, and each one is handed over as soon as its download finishes
+                while not exhausted and len(waiting) < window:
+                    row = next(rows, None)
+                    if row is None:
+                        exhausted = True
+                        break
+                    self.stats.rows += 1
+                    md5 = row["MD5"]
+                    if md5 in stored:
+                        yield row["RID"], thumbnail_hatrac_path(md5, self.size)
+                    elif md5 in waiting:
+                        waiting[md5][1].append(row["RID"])
+                    elif md5 not in failed:
+                        waiting[md5] = (row["URL"], [row["RID"]])
+                        self.stats.plots += 1
+                        if os.path.exists(self.cached_path(md5)):
+                            self.stats.cached += 1
+                            store(md5)
+                        elif md5 in self.local_files:
+                            scale(md5, self.local_files[md5])
+                        else:
+                            stages[transfers.submit(self._download, row["URL"], md5, download_dir)] = ("read", md5)
+                if not stages:
+                    break
+
+                done, _ = wait(stages, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, md5 = stages.pop(future)
+                    if stage == "scale":
+                        download = os.path.join(download_dir, md5 + ".png")
+                        if os.path.exists(download):
+                            os.remove(download)
+                    try:
+                        result = future.result()
+                    except Exception as err:
+                        self.stats.failed += 1
+                        failed.add(md5)
+                        action = {"read": "reading plot", "scale": "making thumbnail of",
+                                  "store": "storing thumbnail of"}[stage]
+                        print("Error {0} {1}: {2}".format(action, waiting.pop(md5)[0], err))
+                        continue
+                    if stage == "read":
+                        scale(md5, result)
+                    elif stage == "scale":
+                        self.stats.bytes_out += result
+                        self.stats.generated += 1
+                        store(md5)
+                    else:
+                        stored.add(md5)
+                        for rid in waiting.pop(md5)[1]:
+                            yield rid, result
+        self.stats.elapsed += time.perf_counter() - start
+
+def update_thumbnail_urls(catalog, thumbnails):
+    """
+    Record the thumbnails in the Evaluation_Plot Thumbnail_URL column as they come in,
+    UPDATE_BATCH rows per request
+    :param catalog: ErmrestCatalog
+    :param thumbnails: iterable of (RID, thumbnail URL), e.g. from ThumbnailPipeline.run
+    :return: number of rows updated
+    """
+    updated = 0
+    batch = []
+    for rid, url in thumbnails:
+        batch.append({"RID": rid, "Thumbnail_URL": url})
+        if len(batch) == UPDATE_BATCH:
+            catalog.put("/attributegroup/ETAS:Evaluation_Plot/RID;Thumbnail_URL", json=batch)
+            updated += len(batch)
+            batch = []
+    if batch:
+        catalog.put("/attributegroup/ETAS:Evaluation_Plot/RID;Thumbnail_URL", json=batch)
+        updated += len(batch)
+    return updated
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make thumbnails of the Evaluation_Plot PNGs for the previews")
+    parser.add_argument("--manifest", help="forecast_scanner.py manifest of the upload tree, to read plots locally")
+    parser.add_argument("--checksum-cache", default=DEFAULT_CACHE_FILE,
+                        help="checksum cache file (default: %(default)s)")
+    parser.add_argument("--all", action="store_true", help="also redo the rows that already have a thumbnail")
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE,
+                        help="longest side of a thumbnail in pixels (default: %(default)s)")
+    parser.add_argument("--cache-dir", default=DEFAULT_THUMBNAIL_DIR,
+                        help="local thumbnail cache (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="thumbnail worker processes (default: %(default)s)")
+    parser.add_argument("--transfers", type=int, default=DEFAULT_TRANSFERS,
+                        help="concurrent Hatrac downloads and uploads (default: %(default)s)")
+    args = parser.parse_args()
+
+    if Image is None:
+        print("plot_thumbnails.py needs Pillow: pip install Pillow")
+        sys.exit(1)
+
+    hostname = 'forecast.derivacloud.org'  # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
+    catalog_id = '5'  # this was a throw-away catalog used to test this script (change to TBD)
+
+    catalog = connect_catalog(hostname, catalog_id)
+    local_files = local_plots(args.manifest, args.checksum_cache) if args.manifest else None
+
+    #
+    # The rows are streamed from the catalog through the pipeline, and the Thumbnail_URL updates
+    # are sent in batches as the thumbnails are stored
+    pipeline = ThumbnailPipeline(hostname, args.size, args.cache_dir, args.workers, args.transfers, local_files)
+    rows = (row for row in fetch_plot_rows(catalog, args.all) if row["MD5"] and row["URL"])
+    updated = update_thumbnail_urls(catalog, pipeline.run(rows))
+    pipeline.stats.report()
+    print("Updated Thumbnail_URL of {0} Evaluation_Plot rows".format(updated))
+
+    sys.exit(1 if pipeline.stats.failed else 0)
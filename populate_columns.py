@@ -11,10 +11,18 @@ Philip Maechling
 """
 import os
 import sys
+import re
 import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 from dataclasses import dataclass
-from deriva.core import DerivaServer, ErmrestCatalog, get_credential
-from deriva.chisel import Model, Schema, Table, Column, Key, ForeignKey, builtin_types, tag
+from deriva.core import urlquote
+from deriva.core.datapath import Max
+from model_cache import connect_catalog, load_model, path_builder
+from etas_vocab import VOCAB_SCHEMA, vocabulary_columns
 
 """
 Define information collected from Filenames:
@@ -181,40 +189,846 @@ class ETAS_metadata:
     post_event_date: str
     rupture_def: str
     RID: str
+    # typed values derived from the strings above, None when a name does not carry them
+    sim_start_date: str = None      # ISO date, "2019-07-16"
+    days_after: int = None          # 7 for "7DaysAfter"
+    magnitude: float = None         # 7.1 for "ComCatM7p1"
+    rupture_scale: float = None     # 1.14 for "...-scale1.14"
+    no_spont: bool = None           # True for "...-noSpont-...", False when the rupture def has no such flag
+
+_SIM_START_DATE_RE = re.compile(r"^(\d{4})_(\d{2})_(\d{2})$")
+_DAYS_AFTER_RE = re.compile(r"^(\d+)DaysAfter$")
+_MAGNITUDE_RE = re.compile(r"M(\d+)(?:[p.](\d+))?$")
+_RUPTURE_SCALE_RE = re.compile(r"(?:^|-)scale(\d+(?:\.\d*)?)(?:-|$)")
+
+def derive_typed_fields(sim_start_time, catalog_mag, post_event_date, rupture_def):
+    """
+    Derive the typed metadata values from the extracted strings
+    :return: tuple of (sim_start_date, days_after, magnitude, rupture_scale, no_spont)
+    """
+    sim_start_date = None
+    m = _SIM_START_DATE_RE.match(sim_start_time)
+    if m:
+        try:
+            sim_start_date = date(*map(int, m.groups())).isoformat()
+        except ValueError:
+            pass   # e.g. month 13, which the catalog would refuse as a date
+    m = _DAYS_AFTER_RE.match(post_event_date)
+    days_after = int(m.group(1)) if m else None
+    m = _MAGNITUDE_RE.search(catalog_mag)
+    magnitude = float("{0}.{1}".format(m.group(1), m.group(2) or "0")) if m else None
+    m = _RUPTURE_SCALE_RE.search(rupture_def)
+    rupture_scale = float(m.group(1)) if m else None
+    no_spont = "noSpont" in rupture_def.split("-")
+    return sim_start_date, days_after, magnitude, rupture_scale, no_spont
+
+#
+# Single pass pattern for an ETAS forecast directory name. It accepts the same names as the
+# extract_* methods above:
+#   <sim_start_time>-<catalog_mag>_<event_id>[_<post_event_date>]_<rupture_def>
+# where the rupture definition may carry three more dash separated fields, e.g.
+#   ShakeMapSurfaces-noSpont-full_td-scale1.14
+FORECAST_NAME_RE = re.compile(
+    r"^(?P<sim_start_time>[^-]+)-"
+    r"(?P<catalog_mag>[^-_]+)_"
+    r"(?P<event_id>[^-_]+)_"
+    r"(?:(?P<post_event_date>[^-_]+)_)?"
+    r"(?P<rupture_def>[^-_]+(?:-[^-]*-[^-]*-[^-]*)?)$"
+)
+
+class ForecastNameError(ValueError):
+    """
+    Raised by parse_forecast_name (and returned by parse_forecast_names) when a
+    forecast directory name does not follow the ETAS naming convention.
+    """
+    def __init__(self, name, reason, index=None):
+        super().__init__("Error parsing forecast dir name:{0} ({1})".format(name, reason))
+        self.name = name
+        self.reason = reason
+        self.index = index
+
+def _diagnose_forecast_name(name):
+    """
+    Explain why a name did not match FORECAST_NAME_RE. Only called on the error path.
+    :param name:
+    :return: string describing the first problem found
+    """
+    elems = name.split("-")
+    if len(elems) < 2:
+        return "no '-' after the sim start time"
+    if len(elems) not in (2, 5):
+        return "expected 2 or 5 '-' separated fields, found {0}".format(len(elems))
+    forecast_info = elems[1].split("_")
+    if len(forecast_info) not in (3, 4):
+        return "expected 3 or 4 '_' separated fields in {0}, found {1}".format(elems[1], len(forecast_info))
+    return "empty field"
+
+def parse_forecast_name(name, rid=""):
+    """
+    Tokenize a forecast directory name once and return all of the metadata fields.
+    Unlike the extract_* methods, this raises instead of printing and returning None.
+    :param name: forecast directory name
+    :param rid: RID of the Forecast row the name came from, if any
+    :return: ETAS_metadata
+    """
+    match = FORECAST_NAME_RE.match(name)
+    if match is None:
+        raise ForecastNameError(name, _diagnose_forecast_name(name))
+    sim_start_time, catalog_mag, event_id, post_event_date, rupture_def = match.groups("")
+    return ETAS_metadata(sim_start_time, catalog_mag, event_id, post_event_date, rupture_def, rid,
+                         *derive_typed_fields(sim_start_time, catalog_mag, post_event_date, rupture_def))
+
+def parse_forecast_names(names):
+    """
+    Parse a whole list (or iterator) of forecast directory names in one call.
+    Hidden entries (names starting with .) are skipped, as they are in directory listings.
+    :param names: iterable of forecast directory names
+    :return: tuple of (dict of forecast_name -> ETAS_metadata, list of ForecastNameError)
+    """
+    column_metadata = {}
+    errors = []
+    match = FORECAST_NAME_RE.match
+    for index, name in enumerate(names):
+        if name.startswith("."):
+            continue
+        m = match(name)
+        if m is None:
+            errors.append(ForecastNameError(name, _diagnose_forecast_name(name), index))
+            continue
+        sim_start_time, catalog_mag, event_id, post_event_date, rupture_def = m.groups("")
+        column_metadata[name] = ETAS_metadata(sim_start_time, catalog_mag, event_id, post_event_date, rupture_def, "",
+                                              *derive_typed_fields(sim_start_time, catalog_mag,
+                                                                   post_event_date, rupture_def))
+    return column_metadata, errors
+
+#
+# Forecast table columns that are populated from the metadata extracted from the
+# Forecast_Name, mapped to the ETAS_metadata field that holds each value.
+METADATA_COLUMNS = {
+    "Sim_Start_Time": "sim_start_time",
+    "Catalog_Mag": "catalog_mag",
+    "Event_ID": "event_id",
+    "Post_Event_Date": "post_event_date",
+    "Rupture_Definition": "rupture_def",
+}
+
+#
+# Typed Forecast columns derived from the same names (see derive_typed_fields), so range
+# filters such as Days_After or Magnitude run on the server. They are populated once
+# add_columns.py has created them.
+TYPED_COLUMNS = {
+    "Sim_Start_Date": "sim_start_date",
+    "Days_After": "days_after",
+    "Magnitude": "magnitude",
+    "Rupture_Scale": "rupture_scale",
+    "No_Spont": "no_spont",
+}
+
+#
+# The only Forecast columns the populate pass reads: the key, the name that is parsed,
+# and the current metadata values that the new values are compared against.
+READ_COLUMNS = ["RID", "Forecast_Name"] + list(METADATA_COLUMNS)
+
+#
+# With the vocabularies of add_columns.py in place, the Term columns are read and written too
+TERM_COLUMNS = list(vocabulary_columns.values())
+UPDATE_COLUMNS = list(METADATA_COLUMNS) + list(TYPED_COLUMNS) + TERM_COLUMNS
+
+#
+# The typed and Term columns that every parseable name fills in. A row where one of them is
+# still null has not been backfilled since add_columns.py created the columns. The others are
+# null for many names (e.g. Rupture_Scale without a -scale suffix, Post_Event_Date_Term without
+# a post event date), so incremental runs only look for nulls in these.
+BACKFILL_TYPED_COLUMNS = ["No_Spont"]
+BACKFILL_TERM_COLUMNS = [vocabulary_columns[column] for column in
+                         ["Sim_Start_Time", "Catalog_Mag", "Event_ID", "Rupture_Definition"]]
+
+def forecast_read_columns(typed=False, terms=None):
+    """
+    :param typed: also read the TYPED_COLUMNS
+    :param terms: TermCache, when the TERM_COLUMNS are kept
+    :return: the Forecast columns a populate pass reads
+    """
+    return READ_COLUMNS + (list(TYPED_COLUMNS) if typed else []) + (TERM_COLUMNS if terms is not None else [])
+
+def incremental_null_columns(typed=False, terms=None):
+    """
+    :param typed: the TYPED_COLUMNS are kept
+    :param terms: TermCache, when the TERM_COLUMNS are kept
+    :return: the columns whose null value selects a row in an incremental run
+    """
+    return (list(METADATA_COLUMNS) + (BACKFILL_TYPED_COLUMNS if typed else []) +
+            (BACKFILL_TERM_COLUMNS if terms is not None else []))
+
+#
+# Upper bound on the JSON body of one update request. Rows are packed into
+# batches until the next row would push the request past this size.
+DEFAULT_BATCH_BYTES = 512 * 1024
+
+#
+# Number of Forecast rows fetched per request when paging through the table.
+DEFAULT_PAGE_SIZE = 1000
+
+#
+# Where incremental runs keep the RMT watermark of the last successful run, per catalog.
+DEFAULT_WATERMARK_FILE = os.path.join(os.path.expanduser("~"), ".scec_deriva", "populate_watermark.json")
+
+#
+# Where the vocabulary term -> RID mappings are kept, per catalog.
+DEFAULT_TERM_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".scec_deriva", "vocab_terms.json")
+
+#
+# Keep the term lookup URLs well under common server and proxy limits
+MAX_URL_LENGTH = 4000
+
+@dataclass
+class UpdateStats:
+    rows_checked: int = 0
+    rows_changed: int = 0
+    requests: int = 0
+    bytes_sent: int = 0
+    elapsed: float = 0.0
+
+    def report(self):
+        """
+        Print a one line summary of the update pass
+        :return:
+        """
+        rate = self.rows_checked / self.elapsed if self.elapsed > 0 else 0.0
+        print("Checked {0} rows, updated {1} rows in {2} requests, {3} bytes sent, "
+              "{4:.3f} s ({5:.1f} rows/s)".format(self.rows_checked, self.rows_changed, self.requests,
+                                                   self.bytes_sent, self.elapsed, rate))
+
+def compute_updates(entities, terms=None):
+    """
+    Compute the new metadata for every Forecast row, and keep only the rows where
+    at least one of the METADATA_COLUMNS differs from the value already in the row.
+    The TYPED_COLUMNS are compared the same way when the rows carry them.
+    Rows whose Forecast_Name cannot be parsed are left untouched and returned as errors.
+    :param entities: iterable of Forecast rows, each with RID, Forecast_Name and the METADATA_COLUMNS
+                     (and the TERM_COLUMNS when terms is given)
+    :param terms: TermCache holding the terms of these rows, to also compare the TERM_COLUMNS
+    :return: tuple of (list of dicts holding the RID plus only the columns that changed,
+             list of ForecastNameError)
+    """
+    updates = []
+    errors = []
+    for index, row in enumerate(entities):
+        try:
+            mdata = parse_forecast_name(row["Forecast_Name"], row["RID"])
+        except ForecastNameError as err:
+            err.index = index
+            errors.append(err)
+            continue
+        changed = {"RID": row["RID"]}
+        for column, field in METADATA_COLUMNS.items():
+            value = getattr(mdata, field)
+            if row.get(column) != value:
+                changed[column] = value
+            if terms is not None and column in vocabulary_columns:
+                term_rid = terms.rids(column).get(value) if value else None
+                if row.get(vocabulary_columns[column]) != term_rid:
+                    changed[vocabulary_columns[column]] = term_rid
+        for column, field in TYPED_COLUMNS.items():
+            value = getattr(mdata, field)
+            if column in row and row[column] != value:
+                changed[column] = value
+        if len(changed) > 1:
+            updates.append(changed)
+    return updates, errors
+
+def batch_updates(updates, max_batch_bytes=DEFAULT_BATCH_BYTES):
+    """
+    Group the changed rows by the set of columns they change, since every row in an
+    ERMrest update must carry the same columns, then split each group into batches
+    whose JSON body stays under max_batch_bytes.
+    :param updates: list of dicts from compute_updates
+    :param max_batch_bytes: size bound for one request body
+    :return: generator of (target column list, list of rows, body size in bytes)
+    """
+    groups = {}
+    for row in updates:
+        targets = tuple(column for column in UPDATE_COLUMNS if column in row)
+        groups.setdefault(targets, []).append(row)
+
+    for targets, rows in groups.items():
+        batch = []
+        batch_bytes = 2   # the enclosing []
+        for row in rows:
+            row_bytes = len(json.dumps(row)) + 2   # separator between rows
+            if batch and batch_bytes + row_bytes > max_batch_bytes:
+                yield list(targets), batch, batch_bytes
+                batch = []
+                batch_bytes = 2
+            batch.append(row)
+            batch_bytes += row_bytes
+        if batch:
+            yield list(targets), batch, batch_bytes
+
+def update_in_batches(dataset, updates, max_batch_bytes=DEFAULT_BATCH_BYTES, stats=None):
+    """
+    Send the changed rows to the catalog, correlated on RID, writing only the changed columns.
+    The targets are always a subset of the UPDATE_COLUMNS, no other Forecast column is written.
+    :param dataset: pathbuilder table wrapper for ETAS:Forecast
+    :param updates: list of dicts from compute_updates
+    :param max_batch_bytes: size bound for one request body
+    :param stats: UpdateStats to accumulate into, a new one is created if None
+    :return: UpdateStats
+    """
+    if stats is None:
+        stats = UpdateStats()
+    for targets, batch, batch_bytes in batch_updates(updates, max_batch_bytes):
+        dataset.update(batch, correlation={"RID"}, targets=targets)
+        stats.requests += 1
+        stats.rows_changed += len(batch)
+        stats.bytes_sent += batch_bytes
+    return stats
+
+def fetch_forecast_page(dataset, after_rid=None, page_size=DEFAULT_PAGE_SIZE, predicate=None,
+                        read_columns=READ_COLUMNS):
+    """
+    Fetch one page of Forecast rows in RID order, starting after the given RID (keyset paging).
+    Only the read columns are requested, using an ERMrest attribute projection.
+    :param dataset: pathbuilder table wrapper for ETAS:Forecast
+    :param after_rid: last RID of the previous page, or None for the first page
+    :param page_size: maximum number of rows in the page
+    :param predicate: optional datapath filter applied on the server, e.g. from incremental_filter
+    :param read_columns: columns to read, READ_COLUMNS (plus the TERM_COLUMNS when terms are kept)
+    :return: list of rows holding only the read columns
+    """
+    path = dataset.path
+    if predicate is not None:
+        path = path.filter(predicate)
+    if after_rid is not None:
+        path = path.filter(dataset.RID > after_rid)
+    columns = [dataset.column_definitions[column] for column in read_columns]
+    return list(path.attributes(*columns).sort(dataset.RID).fetch(limit=page_size))
+
+def forecast_snapshot(catalog, model=None):
+    """
+    Pin the latest catalog snapshot, so that every page read from it is consistent
+    :param catalog: ErmrestCatalog for the live catalog
+    :param model: model already loaded for the live catalog, reused for the snapshot if given
+    :return: pathbuilder table wrapper for ETAS:Forecast in the snapshot
+    """
+    snapshot = catalog.latest_snapshot()
+    if model is not None:
+        pb = path_builder(snapshot, model)
+    else:
+        pb = snapshot.getPathBuilder()
+    return pb.schemas["ETAS"].tables["Forecast"]
+
+def iter_forecast_pages(dataset, page_size=DEFAULT_PAGE_SIZE, predicate=None, read_columns=READ_COLUMNS):
+    """
+    Generator over the Forecast table, one page at a time. The dataset should come from
+    forecast_snapshot so the pages are consistent with each other. The next page is
+    fetched in the background while the caller works on the current one.
+    :param dataset: pathbuilder table wrapper for ETAS:Forecast, normally in a pinned snapshot
+    :param page_size: maximum number of rows per page
+    :param predicate: optional datapath filter applied on the server
+    :param read_columns: columns to read
+    :return: generator of lists of rows
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(fetch_forecast_page, dataset, None, page_size, predicate, read_columns)
+        while pending is not None:
+            page = pending.result()
+            if len(page) < page_size:
+                pending = None
+            else:
+                pending = executor.submit(fetch_forecast_page, dataset, page[-1]["RID"], page_size, predicate,
+                                          read_columns)
+            if page:
+                yield page
+
+def incremental_filter(dataset, watermark, null_columns=METADATA_COLUMNS):
+    """
+    Build the server side filter for an incremental run: rows where any of the
+    null_columns is still null, or that were modified after the watermark
+    :param dataset: pathbuilder table wrapper for ETAS:Forecast
+    :param watermark: RMT value saved by the last successful run
+    :param null_columns: columns from incremental_null_columns
+    :return: datapath predicate
+    """
+    predicate = dataset.RMT > watermark
+    for column in null_columns:
+        # datapath turns == None into the ERMrest ::null:: filter
+        predicate = predicate | (dataset.column_definitions[column] == None)
+    return predicate
+
+def max_rmt(dataset):
+    """
+    Read the newest RMT in the table. Run against the pinned snapshot, this is the
+    watermark to store once the run has finished.
+    :param dataset: pathbuilder table wrapper for ETAS:Forecast
+    :return: RMT string, or None for an empty table
+    """
+    rows = dataset.path.aggregates(Max(dataset.RMT).alias("max_rmt")).fetch()
+    return rows[0]["max_rmt"] if len(rows) else None
+
+class TermCache:
+    """
+    Vocabulary term -> RID for the vocabulary tables of add_columns.py, kept in a local file
+    per catalog, so each term is looked up (or inserted) once rather than on every run.
+    Terms that are not cached are looked up in bulk, and the ones the vocabulary does not
+    have yet are inserted in one request per table (onconflict=skip, so concurrent runs
+    do not fail on each other's terms). The cached RIDs are checked against the vocabulary
+    tables once per run (verify), so a recreated vocabulary table does not leave stale RIDs.
+    """
+    def __init__(self, path, hostname, catalog_id):
+        """
+        :param path: cache file
+        :param hostname:
+        :param catalog_id:
+        """
+        self.path = path
+        self.key = "{0}/{1}".format(hostname, catalog_id)
+        try:
+            with open(path) as f:
+                self.all_terms = json.load(f)
+        except FileNotFoundError:
+            self.all_terms = {}
+        self.terms = self.all_terms.setdefault(self.key, {})
+        self.requests = 0
+        self.inserted = 0
+        self.verified = False
+
+    def rids(self, table):
+        """
+        :param table: vocabulary table (same name as the metadata column)
+        :return: dict of term -> RID
+        """
+        return self.terms.setdefault(table, {})
+
+    def missing(self, entities):
+        """
+        Parse the Forecast names and collect the terms that are not cached
+        :param entities: iterable of Forecast rows
+        :return: dict of vocabulary table -> set of terms
+        """
+        missing = {}
+        for row in entities:
+            try:
+                mdata = parse_forecast_name(row["Forecast_Name"])
+            except ForecastNameError:
+                continue
+            for column in vocabulary_columns:
+                value = getattr(mdata, METADATA_COLUMNS[column])
+                if value and value not in self.rids(column):
+                    missing.setdefault(column, set()).add(value)
+        return missing
+
+    @staticmethod
+    def lookup_urls(table, terms, column="Name"):
+        """
+        :param column: vocabulary column the terms are matched on, Name or RID
+        :return: generator of attribute URLs fetching the Name and RID of the terms, each under MAX_URL_LENGTH
+        """
+        prefix = "/attribute/{0}:{1}/".format(urlquote(VOCAB_SCHEMA), urlquote(table))
+        filters = []
+        length = len(prefix) + len("/Name,RID")
+        for term in sorted(terms):
+            item = "{0}={1}".format(column, urlquote(term))
+            if filters and length + len(item) + 1 > MAX_URL_LENGTH:
+                yield prefix + ";".join(filters) + "/Name,RID"
+                filters = []
+                length = len(prefix) + len("/Name,RID")
+            filters.append(item)
+            length += len(item) + 1
+        if filters:
+            yield prefix + ";".join(filters) + "/Name,RID"
+
+    @staticmethod
+    def insert_url(table):
+        return "/entity/{0}:{1}?onconflict=skip".format(urlquote(VOCAB_SCHEMA), urlquote(table))
+
+    @staticmethod
+    def term_rows(terms):
+        """
+        :return: vocabulary rows to insert for the terms; Description is required, the term itself is used
+        """
+        return [{"Name": term, "Description": term} for term in sorted(terms)]
+
+    def verify(self, catalog):
+        """
+        Check the cached RIDs against the vocabulary tables, once per run. Terms whose RID is
+        gone (e.g. the vocabulary table was recreated) are dropped, so they are looked up again.
+        :param catalog: ErmrestCatalog for the live catalog
+        :return:
+        """
+        if self.verified:
+            return
+        for table, rids in list(self.terms.items()):
+            found = {}
+            for url in self.lookup_urls(table, set(rids.values()), "RID"):
+                self.requests += 1
+                found.update((row["Name"], row["RID"]) for row in catalog.get(url).json())
+            self.terms[table] = found
+        self.verified = True
+
+    async def verify_async(self, catalog):
+        """
+        verify() for an AsyncCatalog
+        """
+        if self.verified:
+            return
+        for table, rids in list(self.terms.items()):
+            urls = list(self.lookup_urls(table, set(rids.values()), "RID"))
+            pages = await asyncio.gather(*(catalog.get_json(url) for url in urls))
+            self.requests += len(urls)
+            self.terms[table] = {row["Name"]: row["RID"] for rows in pages for row in rows}
+        self.verified = True
+
+    def add(self, table, rows):
+        rids = self.rids(table)
+        for row in rows:
+            rids[row["Name"]] = row["RID"]
+
+    def resolve(self, catalog, missing):
+        """
+        Look up, or insert, the missing terms
+        :param catalog: ErmrestCatalog for the live catalog
+        :param missing: dict from missing()
+        :return:
+        """
+        for table, terms in missing.items():
+            for url in self.lookup_urls(table, terms):
+                self.requests += 1
+                self.add(table, catalog.get(url).json())
+            new = sorted(terms - set(self.rids(table)))
+            if not new:
+                continue
+            self.requests += 1
+            inserted = catalog.post(self.insert_url(table), json=self.term_rows(new)).json()
+            self.inserted += len(inserted)
+            self.add(table, inserted)
+            # terms skipped on conflict were inserted by someone else meanwhile
+            for url in self.lookup_urls(table, set(new) - set(self.rids(table))):
+                self.requests += 1
+                self.add(table, catalog.get(url).json())
+
+    async def resolve_async(self, catalog, missing):
+        """
+        resolve() for an AsyncCatalog
+        """
+        for table, terms in missing.items():
+            pages = await asyncio.gather(*(catalog.get_json(url) for url in self.lookup_urls(table, terms)))
+            self.requests += len(pages)
+            for rows in pages:
+                self.add(table, rows)
+            new = sorted(terms - set(self.rids(table)))
+            if not new:
+                continue
+            self.requests += 1
+            inserted = await catalog.post_json(self.insert_url(table), self.term_rows(new))
+            self.inserted += len(inserted)
+            self.add(table, inserted)
+            for url in self.lookup_urls(table, set(new) - set(self.rids(table))):
+                self.requests += 1
+                self.add(table, await catalog.get_json(url))
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.all_terms, f)
+        os.replace(tmp_path, self.path)
+
+def typed_columns_ready(model):
+    """
+    :param model: model loaded for the catalog
+    :return: True if add_columns.py has created the TYPED_COLUMNS
+    """
+    names = {column.name for column in model.schemas["ETAS"].tables["Forecast"].column_definitions}
+    return all(column in names for column in TYPED_COLUMNS)
+
+def vocabularies_ready(model):
+    """
+    :param model: model loaded for the catalog
+    :return: True if add_columns.py has created the vocabularies and the Forecast Term columns
+    """
+    if VOCAB_SCHEMA not in model.schemas:
+        return False
+    forecast = model.schemas["ETAS"].tables["Forecast"]
+    names = {column.name for column in forecast.column_definitions}
+    return all(column in model.schemas[VOCAB_SCHEMA].tables and term_column in names
+               for column, term_column in vocabulary_columns.items())
+
+def populate(catalog, model, page_size=DEFAULT_PAGE_SIZE, max_batch_bytes=DEFAULT_BATCH_BYTES,
+             incremental=False, watermark=None, terms=None, typed=False):
+    """
+    One populate pass with the synchronous client: read the Forecast rows page by page from a
+    pinned snapshot, and send the changed metadata to the live catalog in size-bounded batches
+    :param catalog: ErmrestCatalog for the live catalog
+    :param model: model loaded for the catalog
+    :param page_size: Forecast rows fetched per request
+    :param max_batch_bytes: size bound for one update request body
+    :param incremental: only read rows with unpopulated metadata or modified after the watermark
+    :param watermark: RMT saved by the last successful incremental run, None for a full pass
+    :param terms: TermCache, to also fill in the Term columns
+    :param typed: also fill in the TYPED_COLUMNS
+    :return: tuple of (UpdateStats, new watermark or None)
+    """
+    pb = path_builder(catalog, model)
+    #
+    # The dataset object is used for updates against the live catalog.
+    # Rows are read page by page from a pinned snapshot, so memory stays flat however
+    # many forecasts the catalog holds, and the first updates go out after one round trip.
+    dataset = pb.schemas["ETAS"].tables["Forecast"]
+    snapshot_dataset = forecast_snapshot(catalog, model)
+
+    predicate = None
+    new_watermark = None
+    if incremental:
+        if watermark is not None:
+            predicate = incremental_filter(snapshot_dataset, watermark, incremental_null_columns(typed, terms))
+        new_watermark = max_rmt(snapshot_dataset)
+
+    # Extract the metadata for every row of a page, keep only the rows whose extracted columns
+    # differ from what is already stored, then send those in size-bounded batches that
+    # carry the RID plus the changed columns.
+    start = time.perf_counter()
+    stats = UpdateStats()
+    if terms is not None:
+        terms.verify(catalog)
+    read_columns = forecast_read_columns(typed, terms)
+    for page in iter_forecast_pages(snapshot_dataset, page_size, predicate, read_columns):
+        stats.rows_checked += len(page)
+        if terms is not None:
+            terms.resolve(catalog, terms.missing(page))
+        updates, errors = compute_updates(page, terms)
+        for err in errors:
+            print("Skipping RID {0}: {1}".format(page[err.index]["RID"], err))
+        update_in_batches(dataset, updates, max_batch_bytes, stats)
+    stats.elapsed = time.perf_counter() - start
+    return stats, new_watermark
+
+def populate_from_mirror(catalog, model, mirror, page_size=DEFAULT_PAGE_SIZE, max_batch_bytes=DEFAULT_BATCH_BYTES,
+                         incremental=False, watermark=None, terms=None, typed=False):
+    """
+    The populate pass reading the Forecast rows from a synced local mirror (etas_mirror.py),
+    so the only requests sent to the catalog are the update batches
+    :param catalog: ErmrestCatalog for the live catalog
+    :param model: model loaded for the catalog
+    :param mirror: EtasMirror with the Forecast table synced
+    :param page_size: rows compared per update round
+    :param max_batch_bytes: size bound for one update request body
+    :param incremental: only read rows with unpopulated metadata or modified after the watermark
+    :param watermark: RMT saved by the last successful incremental run, None for a full pass
+    :param terms: TermCache, to also fill in the Term columns
+    :param typed: also fill in the TYPED_COLUMNS
+    :return: tuple of (UpdateStats, new watermark or None)
+    """
+    dataset = path_builder(catalog, model).schemas["ETAS"].tables["Forecast"]
+    where = None
+    params = ()
+    new_watermark = None
+    if incremental:
+        if watermark is not None:
+            # the same rows incremental_filter selects on the server
+            where = " OR ".join(['"RMT" > ?'] + ['"{0}" IS NULL'.format(column)
+                                                 for column in incremental_null_columns(typed, terms)])
+            params = (watermark,)
+        new_watermark = mirror.state("Forecast")[1]
+
+    start = time.perf_counter()
+    stats = UpdateStats()
+    if terms is not None:
+        terms.verify(catalog)
+    read_columns = forecast_read_columns(typed, terms)
+    for page in mirror.iter_rows("Forecast", read_columns, where, params, page_size):
+        stats.rows_checked += len(page)
+        if terms is not None:
+            terms.resolve(catalog, terms.missing(page))
+        updates, errors = compute_updates(page, terms)
+        for err in errors:
+            print("Skipping RID {0}: {1}".format(page[err.index]["RID"], err))
+        update_in_batches(dataset, updates, max_batch_bytes, stats)
+    stats.elapsed = time.perf_counter() - start
+    return stats, new_watermark
+
+FORECAST_URL = "/attribute/ETAS:Forecast"
+
+def incremental_filter_url(watermark, null_columns=METADATA_COLUMNS):
+    """
+    The incremental_filter predicate as an ERMrest filter path element, for the async path
+    :param watermark: RMT value saved by the last successful run
+    :param null_columns: columns from incremental_null_columns
+    :return: filter string
+    """
+    terms = ["RMT::gt::{0}".format(urlquote(watermark))]
+    terms.extend("{0}::null::".format(urlquote(column)) for column in null_columns)
+    return ";".join(terms)
+
+async def forecast_page_bounds(snapshot, page_size=DEFAULT_PAGE_SIZE, filter_url=None, pages_per_request=1):
+    """
+    List the RIDs to process (RIDs only, keyset paged) and cut them into page ranges as they
+    arrive, so the pages themselves can be fetched concurrently. Only one listing request's
+    RIDs are held at a time.
+    :param snapshot: AsyncCatalog pinned to a snapshot
+    :param page_size: rows per page
+    :param filter_url: optional filter path element
+    :param pages_per_request: page ranges covered by one listing request
+    :return: async generator of (first RID, last RID) per page
+    """
+    base = FORECAST_URL + ("/" + filter_url if filter_url else "") + "/RID@sort(RID)"
+    limit = page_size * pages_per_request
+    after = ""
+    while True:
+        rids = [row["RID"] for row in await snapshot.get_json("{0}{1}?limit={2}".format(base, after, limit))]
+        for i in range(0, len(rids), page_size):
+            yield rids[i], rids[min(i + page_size, len(rids)) - 1]
+        if len(rids) < limit:
+            break
+        after = "@after({0})".format(urlquote(rids[-1]))
+
+async def populate_async(catalog, page_size=DEFAULT_PAGE_SIZE, max_batch_bytes=DEFAULT_BATCH_BYTES,
+                         incremental=False, watermark=None, terms=None, typed=False, max_pages=None):
+    """
+    The populate pass with the asyncio client: page fetches and update batches for different
+    pages overlap. A fixed set of max_pages workers takes the page ranges from a queue that
+    holds at most max_pages of them, so memory stays flat however many forecasts the catalog
+    holds and the first pages start as soon as the first RID listing arrives.
+    :param catalog: AsyncCatalog for the live catalog
+    :param page_size: Forecast rows fetched per request
+    :param max_batch_bytes: size bound for one update request body
+    :param incremental: only read rows with unpopulated metadata or modified after the watermark
+    :param watermark: RMT saved by the last successful incremental run, None for a full pass
+    :param terms: TermCache, to also fill in the Term columns
+    :param typed: also fill in the TYPED_COLUMNS
+    :param max_pages: pages being worked on at once, the catalog's concurrency bound if None
+    :return: tuple of (UpdateStats, new watermark or None)
+    """
+    if max_pages is None:
+        max_pages = catalog.concurrency
+    start = time.perf_counter()
+    stats = UpdateStats()
+    snapshot = await catalog.snapshot()
+    if terms is not None:
+        await terms.verify_async(catalog)
+
+    filter_url = None
+    if incremental and watermark is not None:
+        filter_url = incremental_filter_url(watermark, incremental_null_columns(typed, terms))
+    new_watermark = None
+    if incremental:
+        rows = await snapshot.get_json("/aggregate/ETAS:Forecast/max_rmt:=max(RMT)")
+        new_watermark = rows[0]["max_rmt"] if rows else None
+
+    read_columns = forecast_read_columns(typed, terms)
+    projection = ",".join(urlquote(column) for column in read_columns)
+    term_lock = asyncio.Lock()   # pages resolving the same new term must not insert it twice
+
+    async def process_page(first, last):
+        url = "{0}{1}/RID::geq::{2}&RID::leq::{3}/{4}".format(
+            FORECAST_URL, "/" + filter_url if filter_url else "", urlquote(first), urlquote(last), projection)
+        page = await snapshot.get_json(url)
+        stats.rows_checked += len(page)
+        if terms is not None:
+            async with term_lock:
+                await terms.resolve_async(catalog, terms.missing(page))
+        updates, errors = compute_updates(page, terms)
+        for err in errors:
+            print("Skipping RID {0}: {1}".format(page[err.index]["RID"], err))
+        batches = list(batch_updates(updates, max_batch_bytes))
+        await asyncio.gather(*(catalog.put_json("/attributegroup/ETAS:Forecast/RID;{0}".format(
+            ",".join(urlquote(column) for column in targets)), batch) for targets, batch, _ in batches))
+        for targets, batch, batch_bytes in batches:
+            stats.requests += 1
+            stats.rows_changed += len(batch)
+            stats.bytes_sent += batch_bytes
+
+    queue = asyncio.Queue(maxsize=max_pages)
+
+    async def list_pages():
+        async for bounds in forecast_page_bounds(snapshot, page_size, filter_url, max_pages):
+            await queue.put(bounds)   # waits while max_pages ranges are already queued
+        for _ in range(max_pages):
+            await queue.put(None)
+
+    async def work():
+        while True:
+            bounds = await queue.get()
+            if bounds is None:
+                return
+            await process_page(*bounds)
+
+    tasks = [asyncio.ensure_future(list_pages())] + [asyncio.ensure_future(work()) for _ in range(max_pages)]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()   # re-raise the first failure
+    finally:
+        for task in tasks:
+            task.cancel()
+    stats.elapsed = time.perf_counter() - start
+    return stats, new_watermark
+
+def load_watermark(path, hostname, catalog_id):
+    """
+    Read the watermark stored for this catalog by save_watermark
+    :param path: watermark file
+    :param hostname:
+    :param catalog_id:
+    :return: RMT string, or None if no run has been recorded
+    """
+    try:
+        with open(path) as f:
+            watermarks = json.load(f)
+    except FileNotFoundError:
+        return None
+    return watermarks.get("{0}/{1}".format(hostname, catalog_id))
+
+def save_watermark(path, hostname, catalog_id, watermark):
+    """
+    Record the watermark for this catalog, keeping the entries for other catalogs
+    :param path: watermark file
+    :param hostname:
+    :param catalog_id:
+    :param watermark: RMT string
+    :return:
+    """
+    try:
+        with open(path) as f:
+            watermarks = json.load(f)
+    except FileNotFoundError:
+        watermarks = {}
+    watermarks["{0}/{1}".format(hostname, catalog_id)] = watermark
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(watermarks, f, indent=2)
+    os.replace(tmp_path, path)
 
 if __name__ == "__main__":
     """
     Script that creates a dictionary with key of forecast_name, and a dataclass
     with entries for the metadata we extracted from it.
     """
-
-    column_metadata = {}
+    parser = argparse.ArgumentParser(description="Populate the ETAS Forecast metadata columns from Forecast_Name")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE,
+                        help="Forecast rows fetched per request (default: %(default)s)")
+    parser.add_argument("--batch-bytes", type=int, default=DEFAULT_BATCH_BYTES,
+                        help="maximum size of one update request body (default: %(default)s)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process rows with unpopulated metadata or modified since the last run")
+    parser.add_argument("--watermark-file", default=DEFAULT_WATERMARK_FILE,
+                        help="where incremental runs store their watermark (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="requests in flight at once; above 1 the asyncio client is used (default: %(default)s)")
+    parser.add_argument("--mirror", nargs="?", const="",
+                        help="sync the local SQLite mirror (optionally at this path) and read the rows from it")
+    parser.add_argument("--term-cache", default=DEFAULT_TERM_CACHE_FILE,
+                        help="where vocabulary term RIDs are cached (default: %(default)s)")
+    args = parser.parse_args()
 
     #
     # This first example tests the metadata extraction code, and creates a dictionary
     # This test code and isn't needed when running against Deriva instance
     #
-    files =  u3etas_files
-    for name in files:
-        if name.startswith("."):
-            continue
-        else:
-            sim_start_time = extract_sim_start_time(name)
-            catalog_mag = extract_cat_mag(name)
-            event_id = extract_event_id(name)
-            post_event_date = extract_post_event_date(name)
-            rupture_def = extract_rupture_def(name)
-            rid = "" # Define the RID as an empty string for now
-
-            mdata = ETAS_metadata(sim_start_time,
-                                  catalog_mag,
-                                  event_id,
-                                  post_event_date,
-                                  rupture_def,
-                                  rid)
-
-            column_metadata[name] = mdata
-
+    column_metadata, errors = parse_forecast_names(u3etas_files)
+    for err in errors:
+        print(err)
 
     # print("Results:")
     # for x in column_metadata:
@@ -227,78 +1041,63 @@ if __name__ == "__main__":
     hostname = 'forecast.derivacloud.org'  # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
     catalog_id = '5'  # this was a throw-away catalog used to test this script (change to TBD)
 
-    model = Model.from_catalog(
-        DerivaServer('https', hostname, credentials=get_credential(hostname)).connect_ermrest(catalog_id)
-    )
-
-    catalog = ErmrestCatalog('https', hostname, catalog_id, credentials=get_credential((hostname)))
+    # The model comes from the local model cache (revalidated with one request), and the
+    # pathbuilder is built over that same model rather than downloading the schema again
+    catalog = connect_catalog(hostname, catalog_id)
+    model = load_model(catalog)
 
-    # Use the pathbuilder approach
-    pb = catalog.getPathBuilder()
-    etas = pb.schemas["ETAS"]
-    #
-    # print("Schema: ETAS - table keys:",etas.tables.keys())
     #
-    # Query the ETAS Forecast Table to get column names
-    # The dataset object is used for updates
-    # The dataset path object is used to run the query and get the resultset
-    dataset = pb.schemas["ETAS"].tables["Forecast"]
-    # print("Dataset columns:",dataset.column_definitions.keys())
-    fcast = dataset.path
-    results = fcast.entities()
-    entities = results.fetch()
+    # In incremental mode the server only returns rows whose metadata columns are still null,
+    # or that changed after the watermark stored by the last successful run. Without a stored
+    # watermark this is a full pass. The new watermark is the newest RMT in the pinned snapshot,
+    # so rows modified while (or after) this run are picked up again next time.
+    watermark = None
+    if args.incremental:
+        watermark = load_watermark(args.watermark_file, hostname, catalog_id)
+        if watermark is not None:
+            print("Incremental run, watermark:", watermark)
+        else:
+            print("No watermark stored, running a full pass")
 
     #
-    # Results from retrieved entities
-    print("Result set len - forecast table entities",len(entities))
-    print("List entities before Update:",list(entities))
+    # Once add_columns.py has created the typed columns and the vocabularies, they are filled in
+    # as well. Incremental runs also pick up the rows whose typed or Term columns are still null,
+    # so rows populated before the columns existed are backfilled without a full pass.
+    typed = typed_columns_ready(model)
+    if not typed:
+        print("No typed metadata columns in the catalog yet (see add_columns.py), they are not populated")
+    terms = None
+    if vocabularies_ready(model):
+        terms = TermCache(args.term_cache, hostname, catalog_id)
+    else:
+        print("No vocabularies in the catalog yet (see add_columns.py), Term columns are not populated")
 
-    # This first resultset should contain contain empty strings for the metadata fields we plan to add
-    # Iterate through the result set, extract the forecast name, and extract the metadata fiels
-    #
-    # Declare updated entiries object here for visibility
-    updated_entities = None
-
-    for idx in range(len(entities)):
-        print(entities[idx],entities[idx]["RID"],entities[idx]["Forecast_Name"])
-        fname = entities[idx]["Forecast_Name"]
-
-        sim_start_time = extract_sim_start_time(fname)
-        catalog_mag = extract_cat_mag(fname)
-        event_id = extract_event_id(fname)
-        post_event_date = extract_post_event_date(fname)
-        rupture_def = extract_rupture_def(fname)
-        rid = entities[idx]["RID"]
-
-        #
-        # Now prepare update to current entities with metadata extracted
-        # from directory name. create a json row values
-        # newvals = {}
-        # newvals["Sim_Start_Time"] = sim_start_time
-        # newvals["Catalog_Mag"] = catalog_mag
-        # newvals["Event_ID"] = event_id
-        # newvals["Post_Event_Date"] = post_event_date
-        # newvals["Rupture_Definition"] = rupture_def
-        # newvals["RID"] = rid
-        # json_update = json.dumps(newvals)
-        # print(json_update)
-        #
-        # Alternative update method for comparison
-        # TODO : ask for preferred update method
-        entities[idx]["Sim_Start_Time"] = sim_start_time
-        entities[idx]["Catalog_Mag"] = catalog_mag
-        entities[idx]["Event_ID"] = event_id
-        entities[idx]["Post_Event_Date"] = post_event_date
-        entities[idx]["Rupture_Definition"] = rupture_def
-        entities[idx]["RID"] = rid
-        updated_entities = dataset.update(entities)
+    if args.mirror is not None:
+        from etas_mirror import EtasMirror, default_mirror_path
+        with EtasMirror(args.mirror or default_mirror_path(hostname, catalog_id)) as mirror:
+            counts = mirror.sync(catalog, ["Forecast"])["Forecast"]
+            print("Mirror Forecast: {0} rows fetched, {1} deleted".format(counts["fetched"], counts["deleted"]))
+            stats, new_watermark = populate_from_mirror(catalog, model, mirror, args.page_size, args.batch_bytes,
+                                                        args.incremental, watermark, terms, typed)
+    elif args.concurrency > 1:
+        from async_catalog import AsyncCatalog
 
-    #
-    # Now we have a dictionary with key of the forecast directory name, and an RID number.
-    # We update the columns with the extracted metadata
-    # Results from retrieved entities
-    print("Result set len - forecast table entities",len(updated_entities))
-    print("List entities before Update:",list(updated_entities))
+        async def run():
+            async with AsyncCatalog(hostname, catalog_id, args.concurrency) as async_catalog:
+                return await populate_async(async_catalog, args.page_size, args.batch_bytes,
+                                            args.incremental, watermark, terms, typed)
+        stats, new_watermark = asyncio.run(run())
+    else:
+        stats, new_watermark = populate(catalog, model, args.page_size, args.batch_bytes,
+                                        args.incremental, watermark, terms, typed)
+    stats.report()
+    if terms is not None:
+        terms.save()
+        print("Vocabulary terms: {0} inserted, {1} requests".format(terms.inserted, terms.requests))
+
+    if args.incremental and new_watermark is not None:
+        save_watermark(args.watermark_file, hostname, catalog_id, new_watermark)
+        print("Saved watermark:", new_watermark)
 
     sys.exit(0)
 
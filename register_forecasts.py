@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+
+"""register_forecasts.py: This script registers SCEC ETAS forecasts in the Forecast table
+from their directory names, in one pass.
+
+The names come from a directory listing (every subdirectory of a forecast output root is a
+forecast) or from a file with one name per line, like the u3etas_files list in
+populate_columns.py. They are parsed together with parse_forecast_names, and the new Forecast
+rows are inserted with their metadata columns already filled in (plus the typed and Term
+columns of add_columns.py when the catalog has them), in a few batched inserts that skip
+names that are already registered (onconflict=skip on the Forecast_Name key).
+
+This replaces the per-forecast query-then-insert of the bulk uploader and the separate
+populate_columns.py pass for new forecasts. Names that cannot be parsed are reported and
+not registered.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from dataclasses import dataclass
+from model_cache import connect_catalog, load_model
+from populate_columns import (METADATA_COLUMNS, TYPED_COLUMNS, DEFAULT_BATCH_BYTES, DEFAULT_TERM_CACHE_FILE,
+                              TermCache, parse_forecast_names, typed_columns_ready, vocabularies_ready,
+                              vocabulary_columns, u3etas_files)
+
+INSERT_URL = "/entity/ETAS:Forecast?onconflict=skip"
+
+@dataclass
+class RegisterStats:
+    names: int = 0
+    malformed: int = 0
+    inserted: int = 0
+    skipped: int = 0
+    requests: int = 0
+    elapsed: float = 0.0
+
+    def report(self):
+        """
+        Print a one line summary of the registration
+        :return:
+        """
+        print("Registered {0} of {1} forecasts ({2} already registered, {3} malformed names) "
+              "in {4} requests, {5:.3f} s".format(self.inserted, self.names, self.skipped,
+                                                  self.malformed, self.requests, self.elapsed))
+
+def read_forecast_names(source):
+    """
+    :param source: a directory, whose subdirectories are the forecasts, or a file with one
+                   forecast name per line (blank lines and lines starting with # are ignored)
+    :return: list of forecast names
+    """
+    if os.path.isdir(source):
+        with os.scandir(source) as it:
+            return sorted(entry.name for entry in it if entry.is_dir() and not entry.name.startswith("."))
+    with open(source) as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+def forecast_rows(column_metadata, typed=False, terms=None):
+    """
+    Build the Forecast rows to insert
+    :param column_metadata: dict of forecast name -> ETAS_metadata, from parse_forecast_names
+    :param typed: also fill in the TYPED_COLUMNS
+    :param terms: TermCache holding the terms of these names, to also fill in the Term columns
+    :return: list of row dicts, all with the same columns
+    """
+    rows = []
+    for name, mdata in sorted(column_metadata.items()):
+        row = {"Forecast_Name": name}
+        for column, field in METADATA_COLUMNS.items():
+            row[column] = getattr(mdata, field)
+        if typed:
+            for column, field in TYPED_COLUMNS.items():
+                row[column] = getattr(mdata, field)
+        if terms is not None:
+            for column, term_column in vocabulary_columns.items():
+                value = row[column]
+                row[term_column] = terms.rids(column).get(value) if value else None
+        rows.append(row)
+    return rows
+
+def insert_batches(rows, max_batch_bytes=DEFAULT_BATCH_BYTES):
+    """
+    Split the rows into batches whose JSON body stays under max_batch_bytes
+    :return: generator of lists of rows
+    """
+    batch = []
+    batch_bytes = 2   # the enclosing []
+    for row in rows:
+        row_bytes = len(json.dumps(row)) + 2   # separator between rows
+        if batch and batch_bytes + row_bytes > max_batch_bytes:
+            yield batch
+            batch = []
+            batch_bytes = 2
+        batch.append(row)
+        batch_bytes += row_bytes
+    if batch:
+        yield batch
+
+def register_forecasts(catalog, names, typed=False, terms=None, max_batch_bytes=DEFAULT_BATCH_BYTES):
+    """
+    Parse the forecast names and insert the new Forecast rows with their metadata
+    :param catalog: ErmrestCatalog for the live catalog
+    :param names: iterable of forecast names, duplicates are registered once
+    :param typed: also fill in the TYPED_COLUMNS
+    :param terms: TermCache, to also fill in the Term columns
+    :param max_batch_bytes: size bound for one insert request body
+    :return: tuple of (RegisterStats, list of ForecastNameError)
+    """
+    start = time.perf_counter()
+    stats = RegisterStats()
+    names = list(dict.fromkeys(names))
+    stats.names = len(names)
+    column_metadata, errors = parse_forecast_names(names)
+    stats.malformed = len(errors)
+    if terms is not None:
+        terms.verify(catalog)
+        terms.resolve(catalog, terms.missing({"Forecast_Name": name} for name in column_metadata))
+    for batch in insert_batches(forecast_rows(column_metadata, typed, terms), max_batch_bytes):
+        inserted = catalog.post(INSERT_URL, json=batch).json()
+        stats.requests += 1
+        stats.inserted += len(inserted)
+        stats.skipped += len(batch) - len(inserted)
+    stats.elapsed = time.perf_counter() - start
+    return stats, errors
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Register ETAS forecasts, with their metadata, from their names")
+    parser.add_argument("sources", nargs="*",
+                        help="forecast output directories, or files with one forecast name per line")
+    parser.add_argument("--example", action="store_true",
+                        help="register the example names of populate_columns.py (u3etas_files)")
+    parser.add_argument("--batch-bytes", type=int, default=DEFAULT_BATCH_BYTES,
+                        help="maximum size of one insert request body (default: %(default)s)")
+    parser.add_argument("--term-cache", default=DEFAULT_TERM_CACHE_FILE,
+                        help="where vocabulary term RIDs are cached (default: %(default)s)")
+    parser.add_argument("--dry-run", action="store_true", help="parse the names and report, without inserting")
+    args = parser.parse_args()
+
+    names = list(u3etas_files) if args.example else []
+    for source in args.sources:
+        names.extend(read_forecast_names(source))
+    if not names:
+        parser.error("no forecast names given")
+
+    if args.dry_run:
+        column_metadata, errors = parse_forecast_names(names)
+        for err in errors:
+            print(err)
+        print("{0} names, {1} parsed, {2} malformed".format(len(names), len(column_metadata), len(errors)))
+        sys.exit(1 if errors else 0)
+
+    # Connect to server and catalog ------------------------------------------------------------------#
+
+    hostname = 'forecast.derivacloud.org'  # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
+    catalog_id = '5'  # this was a throw-away catalog used to test this script (change to TBD)
+
+    catalog = connect_catalog(hostname, catalog_id)
+    model = load_model(catalog)   # cached locally, revalidated with one request
+
+    #
+    # The typed and Term columns are only filled in once add_columns.py has created them
+    typed = typed_columns_ready(model)
+    terms = TermCache(args.term_cache, hostname, catalog_id) if vocabularies_ready(model) else None
+
+    stats, errors = register_forecasts(catalog, names, typed, terms, args.batch_bytes)
+    for err in errors:
+        print(err)
+    stats.report()
+    if terms is not None:
+        terms.save()
+        print("Vocabulary terms: {0} inserted, {1} requests".format(terms.inserted, terms.requests))
+
+    sys.exit(1 if errors else 0)
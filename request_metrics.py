@@ -0,0 +1,207 @@
+"""request_metrics.py: Per-request instrumentation of the ERMrest and Hatrac sessions used by the scripts.
+
+Every connection made through model_cache.connect_catalog / connect_hatrac (and the snapshots
+taken from it) has its HTTP session wrapped, so each request is timed and counted. Requests
+are grouped by endpoint type, e.g. "GET schema", "GET attribute", "PUT attributegroup",
+"PUT annotation" or "PUT hatrac chunk", and for each type the count, status codes, bytes
+sent and received, total and maximum time, and a latency histogram are kept.
+
+At exit a JSON summary is written to the file named by SCEC_DERIVA_METRICS, or to
+~/.scec_deriva/metrics/<script>.json when it is not set ("-" writes it to stderr).
+Setting SCEC_DERIVA_TRACE to a file name also writes one JSON line per request (time,
+method, URL, status, seconds, bytes) for slow-request analysis; SCEC_DERIVA_TRACE_MIN_MS
+limits the trace to requests at least that slow.
+"""
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import threading
+from urllib.parse import urlsplit
+
+METRICS_ENV = "SCEC_DERIVA_METRICS"
+TRACE_ENV = "SCEC_DERIVA_TRACE"
+TRACE_MIN_MS_ENV = "SCEC_DERIVA_TRACE_MIN_MS"
+
+DEFAULT_METRICS_DIR = os.path.join(os.path.expanduser("~"), ".scec_deriva", "metrics")
+
+#
+# Upper bounds (ms) of the latency histogram buckets, the last bucket is open ended
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_ERMREST_RE = re.compile(r"^/ermrest/catalog/[^/]+/?(?P<rest>.*)$")
+
+def endpoint_type(method, url):
+    """
+    Classify a request by the kind of ERMrest or Hatrac resource it addresses
+    :param method: HTTP method
+    :param url: request URL
+    :return: string such as "GET attribute" or "PUT hatrac chunk"
+    """
+    path = urlsplit(url).path
+    if path.startswith("/hatrac"):
+        if ";upload" in path:
+            tail = path.split(";upload", 1)[1].strip("/")
+            kind = "hatrac chunk" if "/" in tail else "hatrac upload job"
+        else:
+            kind = "hatrac object"
+        return "{0} {1}".format(method, kind)
+    m = _ERMREST_RE.match(path)
+    if m is None:
+        return "{0} other".format(method)
+    segments = m.group("rest").split("/")
+    if not segments[0]:
+        return "{0} catalog".format(method)
+    if segments[0] in ("entity", "attribute", "aggregate", "attributegroup"):
+        return "{0} {1}".format(method, segments[0])
+    for resource in ("annotation", "acl_binding", "acl", "comment"):
+        if resource in segments:
+            return "{0} {1}".format(method, resource)
+    return "{0} {1}".format(method, segments[0].split("@")[0])
+
+def _body_size(prepared):
+    if prepared is None:
+        return 0
+    body = getattr(prepared, "body", None)
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    length = prepared.headers.get("Content-Length")
+    return int(length) if length else 0
+
+class RequestMetrics:
+    """
+    Thread safe request counters, shared by every instrumented session of the process
+    """
+    def __init__(self, trace_path=None, trace_min_ms=0.0):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.started = time.time()
+        self.trace = open(trace_path, "a") if trace_path else None
+        self.trace_min_ms = trace_min_ms
+
+    def record(self, method, url, status, seconds, bytes_out, bytes_in):
+        """
+        Add one request
+        :param method:
+        :param url:
+        :param status: HTTP status, or None when the request raised
+        :param seconds: elapsed time
+        :param bytes_out: request body size
+        :param bytes_in: response body size
+        :return:
+        """
+        kind = endpoint_type(method, url)
+        ms = seconds * 1000.0
+        bucket = len(LATENCY_BUCKETS_MS)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                bucket = i
+                break
+        with self.lock:
+            stats = self.endpoints.get(kind)
+            if stats is None:
+                stats = self.endpoints[kind] = {"requests": 0, "errors": 0, "status": {}, "bytes_sent": 0,
+                                                "bytes_received": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                                "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+            stats["requests"] += 1
+            status_key = str(status) if status is not None else "error"
+            stats["status"][status_key] = stats["status"].get(status_key, 0) + 1
+            if status is None or status >= 400:
+                stats["errors"] += 1
+            stats["bytes_sent"] += bytes_out
+            stats["bytes_received"] += bytes_in
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["histogram"][bucket] += 1
+            if self.trace is not None and ms >= self.trace_min_ms:
+                self.trace.write(json.dumps({"time": time.time() - seconds, "kind": kind, "method": method,
+                                             "url": url, "status": status, "seconds": round(seconds, 6),
+                                             "bytes_sent": bytes_out, "bytes_received": bytes_in,
+                                             "thread": threading.current_thread().name}) + "\n")
+
+    def summary(self):
+        """
+        :return: JSON serializable summary of every endpoint type, plus totals
+        """
+        with self.lock:
+            endpoints = json.loads(json.dumps(self.endpoints))
+        totals = {"requests": 0, "errors": 0, "bytes_sent": 0, "bytes_received": 0, "seconds": 0.0}
+        for stats in endpoints.values():
+            for name in totals:
+                totals[name] += stats[name]
+            stats["mean_ms"] = 1000.0 * stats["seconds"] / stats["requests"]
+        return {"script": os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "python",
+                "wall_seconds": time.time() - self.started, "totals": totals,
+                "histogram_bounds_ms": LATENCY_BUCKETS_MS, "endpoints": endpoints}
+
+    def write_summary(self, path=None):
+        """
+        Write the summary as JSON
+        :param path: file name, "-" for stderr, or None for the default location
+        :return: path written, or None if no request was made
+        """
+        if self.trace is not None:
+            self.trace.flush()
+        if not self.endpoints:
+            return None
+        summary = self.summary()
+        if path == "-":
+            json.dump(summary, sys.stderr, indent=2)
+            sys.stderr.write("\n")
+            return path
+        if path is None:
+            path = os.path.join(DEFAULT_METRICS_DIR, os.path.splitext(summary["script"])[0] + ".json")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        totals = summary["totals"]
+        print("Request metrics: {0} requests, {1:.3f} s, {2} bytes sent, {3} bytes received ({4})".format(
+            totals["requests"], totals["seconds"], totals["bytes_sent"], totals["bytes_received"], path))
+        return path
+
+METRICS = RequestMetrics(os.environ.get(TRACE_ENV), float(os.environ.get(TRACE_MIN_MS_ENV) or 0))
+
+atexit.register(lambda: METRICS.write_summary(os.environ.get(METRICS_ENV)))
+
+def instrument(binding, metrics=METRICS):
+    """
+    Wrap the HTTP session of an ErmrestCatalog, ErmrestSnapshot or HatracStore so every
+    request it makes is recorded. Snapshots taken from an instrumented catalog are
+    instrumented too.
+    :param binding: deriva binding
+    :param metrics: RequestMetrics to record into
+    :return: the binding
+    """
+    session = getattr(binding, "_session", None)
+    if session is None or getattr(session, "_scec_metrics", None) is metrics:
+        return binding
+    request = session.request
+
+    def timed_request(method, url, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = request(method, url, *args, **kwargs)
+        except Exception:
+            metrics.record(method.upper(), url, None, time.perf_counter() - start, 0, 0)
+            raise
+        elapsed = time.perf_counter() - start
+        length = response.headers.get("Content-Length")
+        if length is not None:
+            bytes_in = int(length)
+        elif not kwargs.get("stream"):
+            bytes_in = len(response.content)
+        else:
+            bytes_in = 0
+        metrics.record(method.upper(), url, response.status_code, elapsed,
+                       _body_size(response.request), bytes_in)
+        return response
+
+    session.request = timed_request
+    session._scec_metrics = metrics
+
+    latest_snapshot = getattr(binding, "latest_snapshot", None)
+    if latest_snapshot is not None:
+        binding.latest_snapshot = lambda *args, **kwargs: instrument(latest_snapshot(*args, **kwargs), metrics)
+    return binding
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+
+"""rid_resolver.py: This script resolves the parent RIDs that the bulk upload asset mappings
+look up with their metadata_query_templates, for a whole upload plan at once.
+
+Most asset mappings resolve a parent RID with a per-file query such as
+    /attribute/ETAS:Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1
+so one forecast with thousands of result files makes thousands of identical lookups.
+The RidResolver collects the distinct keys (forecast_name, evaluation_group_name, plot
+basename) from the plan, fetches all of the matching RIDs with a few bulk queries that
+filter on a disjunction of key values, and then serves every per-file lookup from memory.
+With --mirror the keys are looked up in the local SQLite mirror of etas_mirror.py instead,
+after an incremental sync of the tables the templates refer to.
+"""
+import re
+import sys
+import asyncio
+import argparse
+from deriva.core import urlquote
+from model_cache import connect_catalog
+from async_catalog import AsyncCatalog
+from etas_mirror import EtasMirror, default_mirror_path
+from upload_planner import AssetMatcher, iter_tree, load_asset_mappings, plan_paths
+from forecast_scanner import manifest_plan
+
+#
+# The form of metadata query template that can be answered from a bulk lookup:
+#   /attribute/<schema>:<table>/<column>={<group>_urlencoded}<suffix>/<alias>:=RID?limit=1
+_TEMPLATE_RE = re.compile(
+    r"^/attribute/(?P<schema>[^:/]+):(?P<table>[^/]+)/(?P<column>[^=/]+)="
+    r"\{(?P<group>\w+)_urlencoded\}(?P<suffix>[^/{}]*)/(?P<alias>\w+):=RID\?limit=1$"
+)
+
+#
+# Keep the bulk query URLs well under common server and proxy limits
+MAX_URL_LENGTH = 4000
+
+class RidLookup:
+    """
+    One metadata query template, parsed
+    """
+    def __init__(self, template):
+        m = _TEMPLATE_RE.match(template)
+        if m is None:
+            raise ValueError("Unsupported metadata query template: {0}".format(template))
+        self.template = template
+        self.schema = m.group("schema")
+        self.table = m.group("table")
+        self.column = m.group("column")
+        self.group = m.group("group")
+        self.suffix = m.group("suffix")
+        self.alias = m.group("alias")
+
+    @property
+    def target(self):
+        return self.schema, self.table, self.column
+
+    def key(self, groups):
+        """
+        :param groups: captured groups of one plan entry
+        :return: the column value the template would look up
+        """
+        return groups[self.group] + self.suffix
+
+class RidResolver:
+    """
+    Answers the metadata_query_templates of an upload plan from a few bulk queries
+    """
+    def __init__(self, catalog, asset_mappings, mirror=None):
+        """
+        :param catalog: ErmrestCatalog
+        :param asset_mappings: bulk upload asset mappings
+        :param mirror: optional synced EtasMirror, used for the tables it holds
+        """
+        self.catalog = catalog
+        self.lookups = [[RidLookup(template) for template in mapping.get("metadata_query_templates", [])]
+                        for mapping in asset_mappings]
+        self.mirror = mirror
+        self.rids = {}
+        self.requests = 0
+
+    def tables(self):
+        """
+        :return: set of (schema, table) the templates look up
+        """
+        return {lookup.target[:2] for lookups in self.lookups for lookup in lookups}
+
+    def _from_mirror(self, target, values):
+        """
+        Answer the lookups of one target from the mirror, when it holds the table
+        :return: True if the target was answered
+        """
+        schema, table, column = target
+        if self.mirror is None or schema != self.mirror.schema_name or not self.mirror.has_table(table):
+            return False
+        rids = self.rids.setdefault(target, {})
+        for value, rid in self.mirror.lookup(table, column, values).items():
+            rids.setdefault(value, rid)
+        return True
+
+    def collect(self, plan):
+        """
+        Gather the distinct key values per looked up column from an upload plan
+        :param plan: iterable of PlanEntry
+        :return: dict of (schema, table, column) -> set of values
+        """
+        keys = {}
+        for entry in plan:
+            for lookup in self.lookups[entry.mapping]:
+                keys.setdefault(lookup.target, set()).add(lookup.key(entry.groups))
+        return keys
+
+    def _bulk_urls(self, target, values):
+        schema, table, column = target
+        prefix = "/attribute/{0}:{1}/".format(urlquote(schema), urlquote(table))
+        projection = "/{0},RID".format(urlquote(column))
+        filters = []
+        length = len(prefix) + len(projection)
+        for value in sorted(values):
+            term = "{0}={1}".format(urlquote(column), urlquote(value))
+            if filters and length + len(term) + 1 > MAX_URL_LENGTH:
+                yield prefix + ";".join(filters) + projection
+                filters = []
+                length = len(prefix) + len(projection)
+            filters.append(term)
+            length += len(term) + 1
+        if filters:
+            yield prefix + ";".join(filters) + projection
+
+    def resolve(self, plan):
+        """
+        Fetch the RIDs for every key in the plan
+        :param plan: iterable of PlanEntry
+        :return: number of distinct keys looked up
+        """
+        keys = self.collect(plan)
+        for target, values in keys.items():
+            values = values - set(self.rids.get(target, {}))
+            if self._from_mirror(target, values):
+                continue
+            rids = self.rids.setdefault(target, {})
+            column = target[2]
+            for url in self._bulk_urls(target, values):
+                self.requests += 1
+                for row in self.catalog.get(url).json():
+                    # the per-file templates use ?limit=1, so keep the first row for a key
+                    rids.setdefault(row[column], row["RID"])
+        return sum(len(values) for values in keys.values())
+
+    async def resolve_async(self, plan, async_catalog):
+        """
+        Like resolve, but the bulk queries run concurrently on an AsyncCatalog
+        :param plan: iterable of PlanEntry
+        :param async_catalog: AsyncCatalog for the catalog
+        :return: number of distinct keys looked up
+        """
+        keys = self.collect(plan)
+        queries = []
+        for target, values in keys.items():
+            values = values - set(self.rids.get(target, {}))
+            if self._from_mirror(target, values):
+                continue
+            self.rids.setdefault(target, {})
+            queries.extend((target, url) for url in self._bulk_urls(target, values))
+        self.requests += len(queries)
+        results = await asyncio.gather(*(async_catalog.get_json(url) for target, url in queries))
+        for (target, url), rows in zip(queries, results):
+            rids = self.rids[target]
+            for row in rows:
+                rids.setdefault(row[target[2]], row["RID"])
+        return sum(len(values) for values in keys.values())
+
+    def lookup(self, entry):
+        """
+        Serve the metadata query templates of one plan entry from memory
+        :param entry: PlanEntry
+        :return: dict of alias -> RID (None when the catalog has no matching row)
+        """
+        result = {}
+        for lookup in self.lookups[entry.mapping]:
+            result[lookup.alias] = self.rids.get(lookup.target, {}).get(lookup.key(entry.groups))
+        return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk resolve the parent RIDs of an upload plan")
+    parser.add_argument("source", help="upload tree, or a forecast_scanner.py manifest with --manifest")
+    parser.add_argument("--manifest", action="store_true", help="read the plan from a manifest")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="bulk queries in flight at once (default: %(default)s)")
+    parser.add_argument("--mirror", nargs="?", const="",
+                        help="sync and use the local SQLite mirror (optionally at this path)")
+    args = parser.parse_args()
+
+    hostname = 'forecast.derivacloud.org'  # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
+    catalog_id = '5'  # this was a throw-away catalog used to test this script (change to TBD)
+
+    asset_mappings = load_asset_mappings()
+    matcher = AssetMatcher(asset_mappings)
+    if args.manifest:
+        root, records, plan = manifest_plan(args.source, matcher)
+    else:
+        plan, unmatched = plan_paths(iter_tree(args.source), matcher)
+
+    catalog = connect_catalog(hostname, catalog_id)
+    mirror = None
+    if args.mirror is not None:
+        mirror = EtasMirror(args.mirror or default_mirror_path(hostname, catalog_id))
+    resolver = RidResolver(catalog, asset_mappings, mirror)
+    if mirror is not None:
+        tables = sorted(table for schema, table in resolver.tables() if schema == mirror.schema_name)
+        for name, counts in mirror.sync(catalog, tables).items():
+            print("Mirror {0}: {1} rows fetched, {2} deleted".format(name, counts["fetched"], counts["deleted"]))
+    if args.concurrency > 1:
+        async def run():
+            async with AsyncCatalog(hostname, catalog_id, args.concurrency) as async_catalog:
+                return await resolver.resolve_async(plan, async_catalog)
+        nkeys = asyncio.run(run())
+    else:
+        nkeys = resolver.resolve(plan)
+
+    per_file = 0
+    unresolved = 0
+    for entry in plan:
+        rids = resolver.lookup(entry)
+        per_file += len(rids)
+        unresolved += sum(1 for rid in rids.values() if rid is None)
+    print("Resolved {0} distinct keys with {1} requests, replacing {2} per-file lookups".format(
+        nkeys, resolver.requests, per_file))
+    print("Lookups with no matching row:", unresolved)
+
+    sys.exit(0)
@@ -0,0 +1,240 @@
+"""Bulk upload annotation for the ETAS schema.
+
+The asset_mappings below tell the DERIVA bulk uploader how to map the files in a
+forecast output tree (<forecast_name>/<evaluation_group_name>/{results,plots}/...)
+onto the ETAS tables. scec_config.py applies this annotation to the catalog, and
+upload_planner.py uses it to classify local files before an upload.
+"""
+
+# NOTE: this is not really intended for you to absorb right not. This is one of the most complicated
+#       annotations to set on the catalog. But I'm including it here for completeness of the catalog
+#       setup.
+
+bulk_upload_annotation = {
+    "asset_mappings": [
+        {
+            "column_map": {
+                "Forecast_Name": "{forecast_name}",
+                "Forecast_Config_JSON": "{URI}"
+            },
+            "file_pattern": "^(?P<forecast_name>[^/]+)/config.json$",
+            "target_table": [
+                "ETAS",
+                "Forecast"
+            ],
+            "checksum_types": [
+                "md5"
+            ],
+            "hatrac_options": {
+                "versioned_uris": "True"
+            },
+            "hatrac_templates": {
+                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{file_name}"
+            },
+            "record_query_template": "/entity/{target_table}/Forecast_Name={forecast_name_urlencoded}/Forecast_Config_JSON={URI_urlencoded}",
+            "create_record_before_upload": "False"
+        },
+        {
+            "column_map": {
+                "Forecast": "{etas_forecast_rid}",
+                "URL": "{URI}",
+                "MD5": "{md5}",
+                "Filename": "{file_name}",
+                "Length": "{file_size}",
+            },
+            "file_pattern": "^(?P<forecast_name>[^/]+)/[^/]+[.](?P<ext>bin|slurm|slurm[.]e.*|slurm[.]o.*)$",
+            "target_table": [
+                "ETAS",
+                "Forecast_File"
+            ],
+            "checksum_types": [
+                "md5"
+            ],
+            "hatrac_options": {
+                "versioned_uris": "True"
+            },
+            "hatrac_templates": {
+                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{file_name}"
+            },
+            "metadata_query_templates": [
+                "/attribute/ETAS:Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1"
+            ],
+            "record_query_template": "/entity/{target_table}/URL={URI_urlencoded}",
+            "create_record_before_upload": "False"
+        },
+        {
+            "column_map": {
+                "Forecast": "{etas_forecast_rid}",
+                "Evaluation_Group_Name": "{evaluation_group_name}",
+                "README_md": "{URI}"
+            },
+            "file_pattern": "^(?P<forecast_name>[^/]+)/(?P<evaluation_group_name>[^/]+)/README.md$",
+            "target_table": [
+                "ETAS",
+                "Evaluation_Group"
+            ],
+            "checksum_types": [
+                "md5"
+            ],
+            "hatrac_options": {
+                "versioned_uris": "True"
+            },
+            "hatrac_templates": {
+                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{evaluation_group_name}/{file_name}"
+            },
+            "metadata_query_templates": [
+                "/attribute/ETAS:Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1"
+            ],
+            "record_query_template": "/entity/{target_table}/Evaluation_Group_Name={evaluation_group_name_urlencoded}",
+            "create_record_before_upload": "False"
+        },
+        {
+            "column_map": {
+                "Forecast": "{etas_forecast_rid}",
+                "Evaluation_Group_Name": "{evaluation_group_name}",
+                "Config_JSON": "{URI}"
+            },
+            "file_pattern": "^(?P<forecast_name>[^/]+)/(?P<evaluation_group_name>[^/]+)/config.json$",
+            "target_table": [
+                "ETAS",
+                "Evaluation_Group"
+            ],
+            "checksum_types": [
+                "md5"
+            ],
+            "hatrac_options": {
+                "versioned_uris": "True"
+            },
+            "hatrac_templates": {
+                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{evaluation_group_name}/{file_name}"
+            },
+            "metadata_query_templates": [
+                "/attribute/ETAS:Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1"
+            ],
+            "record_query_template": "/entity/{target_table}/Evaluation_Group_Name={evaluation_group_name_urlencoded}",
+            "create_record_before_upload": "False"
+        },
+        {
+            "column_map": {
+                "Forecast": "{etas_forecast_rid}",
+                "Evaluation_Group_Name": "{evaluation_group_name}",
+                "Meta_JSON": "{URI}"
+            },
+            "file_pattern": "^(?P<forecast_name>[^/]+)/(?P<evaluation_group_name>[^/]+)/meta.json$",
+            "target_table": [
+                "ETAS",
+                "Evaluation_Group"
+            ],
+            "checksum_types": [
+                "md5"
+            ],
+            "hatrac_options": {
+                "versioned_uris": "True"
+            },
+            "hatrac_templates": {
+                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{evaluation_group_name}/{file_name}"
+            },
+            "metadata_query_templates": [
+                "/attribute/ETAS:Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1"
+            ],
+            "record_query_template": "/entity/{target_table}/Evaluation_Group_Name={evaluation_group_name_urlencoded}",
+            "create_record_before_upload": "False"
+        },
+        {
+            "column_map": {
+                "Forecast": "{etas_forecast_rid}",
+                "Evaluation_Group_Name": "{evaluation_group_name}",
+                "Evaluation_Catalog_JSON": "{URI}"
+            },
+            "file_pattern": "^(?P<forecast_name>[^/]+)/(?P<evaluation_group_name>[^/]+)/evaluation_catalog.json$",
+            "target_table": [
+                "ETAS",
+                "Evaluation_Group"
+            ],
+            "checksum_types": [
+                "md5"
+            ],
+            "hatrac_options": {
+                "versioned_uris": "True"
+            },
+            "hatrac_templates": {
+                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{evaluation_group_name}/{file_name}"
+            },
+            "metadata_query_templates": [
+                "/attribute/ETAS:Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1"
+            ],
+            "record_query_template": "/entity/{target_table}/Evaluation_Group_Name={evaluation_group_name_urlencoded}",
+            "create_record_before_upload": "False"
+        },
+        {
+            "column_map": {
+                "Evaluation_Group": "{etas_evaluation_group_rid}",
+                "Evaluation_Type": "{evaluation_type}",
+                "URL": "{URI}",
+                "MD5": "{md5}",
+                "Filename": "{file_name}",
+                "Length": "{file_size}",
+            },
+            "file_pattern": "^(?P<forecast_name>[^/]+)/(?P<evaluation_group_name>[^/]+)/results/(?P<evaluation_type>.+-test).*[.]json$",
+            "target_table": [
+                "ETAS",
+                "Evaluation"
+            ],
+            "checksum_types": [
+                "md5"
+            ],
+            "hatrac_options": {
+                "versioned_uris": "True"
+            },
+            "hatrac_templates": {
+                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{evaluation_group_name}/results/{file_name}"
+            },
+            "metadata_query_templates": [
+                "/attribute/ETAS:Evaluation_Group/Evaluation_Group_Name={evaluation_group_name_urlencoded}/etas_evaluation_group_rid:=RID?limit=1"
+            ],
+            "record_query_template": "/entity/{target_table}/URL={URI_urlencoded}",
+            "create_record_before_upload": "False"
+        },
+        {
+            "column_map": {
+                "Evaluation": "{etas_evaluation_rid}",
+                "URL": "{URI}",
+                "MD5": "{md5}",
+                "Filename": "{file_name}",
+                "Length": "{file_size}",
+            },
+            "file_pattern": "^(?P<forecast_name>[^/]+)/(?P<evaluation_group_name>[^/]+)/plots/(?P<basename>.+)[.]png",
+            "target_table": [
+                "ETAS",
+                "Evaluation_Plot"
+            ],
+            "checksum_types": [
+                "md5"
+            ],
+            "hatrac_options": {
+                "versioned_uris": "True"
+            },
+            "hatrac_templates": {
+                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{evaluation_group_name}/plots/{file_name}"
+            },
+            "metadata_query_templates": [
+                "/attribute/ETAS:Evaluation/Filename={basename_urlencoded}.json/etas_evaluation_rid:=RID?limit=1"
+            ],
+            "record_query_template": "/entity/{target_table}/URL={URI_urlencoded}",
+            "create_record_before_upload": "False"
+        },
+    ],
+    "mime_overrides": {
+        "mime/type/goes/here": [
+            "file_ext_goes_here"
+        ]
+    },
+    "relative_path_validation": True,
+    "version_update_url": "https://github.com/informatics-isi-edu/deriva-client",
+    "version_compatibility": [
+        [
+            ">=1.0.0",
+            "<2.0.0"
+        ]
+    ]
+}
@@ -1,16 +1,19 @@
 """Minimal example of a possible rendering of the ETAS starter model.
 """
-from deriva.core import DerivaServer, get_credential
-from deriva.chisel import Model, tag
+from deriva.chisel import tag
+from model_cache import connect_catalog, load_model
+from scec_bulk_upload import bulk_upload_annotation
+from annotation_apply import element_hashes, apply_changed
+from etas_vocab import vocabulary_columns
 
 # Connect to server and catalog ------------------------------------------------------------------#
 
 hostname = 'forecast.derivacloud.org'   # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
 catalog_id = '5'            # this was a throw-away catalog used to test this script (change to TBD)
 
-model = Model.from_catalog(
-    DerivaServer('https', hostname, credentials=get_credential(hostname)).connect_ermrest(catalog_id)
-)
+catalog = connect_catalog(hostname, catalog_id)
+model = load_model(catalog)   # cached locally, revalidated with one request
+baseline = element_hashes(model)   # live annotations and acls, to send only what changes below
 
 # ACLs --------------------------------------------------------------------------------------------#
 
@@ -71,6 +74,29 @@ model.schemas['ETAS'].annotations[tag.display] = {
 # Visible Columns Annotations ---------------------------------------------------------------------#
 
 # Note: These annotations will modify the default display of columns for the annotated tables below
+#       The plot previews show the thumbnail made by plot_thumbnails.py (or the full size plot
+#       until it has one), linked to the full size plot
+
+# The Forecast facets go through the Term foreign keys, so Chaise reads the small vocabulary
+# tables of add_columns.py instead of scanning the Forecast table for distinct values.
+# The typed columns get range facets, which the catalog filters on directly.
+model.schemas['ETAS'].tables['Forecast'].annotations[tag.visible_columns] = {
+    "filter": {
+        "and": [
+            {
+                "source": [{"outbound": ["ETAS", "Forecast_{0}_fkey".format(term_column)]}, "Name"],
+                "markdown_name": column.replace("_", " ")
+            }
+            for column, term_column in vocabulary_columns.items()
+        ] + [
+            {"source": "Magnitude", "ux_mode": "ranges"},
+            {"source": "Days_After", "ux_mode": "ranges", "markdown_name": "Days After"},
+            {"source": "Sim_Start_Date", "ux_mode": "ranges", "markdown_name": "Sim Start Date"},
+            {"source": "Rupture_Scale", "ux_mode": "ranges", "markdown_name": "Rupture Scale"},
+            {"source": "No_Spont", "ux_mode": "choices", "markdown_name": "No Spont"}
+        ]
+    }
+}
 
 model.schemas['ETAS'].tables['Forecast_File'].annotations[tag.visible_columns] = {
     'compact': [
@@ -85,22 +111,17 @@ model.schemas['ETAS'].tables['Evaluation'].annotations[tag.visible_columns] = {
         'Evaluation_Type',
         'URL',
         {
-            "source": [
-                {
-                    "inbound": [
-                        "ETAS",
-                        "Evaluation_Plot_Evaluation_fkey"
-                    ]
-                },
-                "RID"
-            ],
+            # Plot_Previews is kept up to date by plot_summary.py, so no inbound aggregate is needed
+            "source": "Plot_Previews",
             "markdown_name": "Plot",
-            "entity": True,
-            "aggregate": "array_d",
             "display": {
-                "markdown_pattern": "{{#each $self}}[![{{{this.values.Filename}}}]({{{this.values.URL}}}){width=120}]({{{this.values.URL}}}){{/each}}",
+                "markdown_pattern": "{{#each _Plot_Previews}}[![{{{this.Filename}}}]({{#if this.Thumbnail_URL}}{{{this.Thumbnail_URL}}}{{else}}{{{this.URL}}}{{/if}}){width=120}]({{{this.URL}}}){{/each}}",
                 "template_engine": "handlebars"
             }
+        },
+        {
+            "source": "Plot_Count",
+            "markdown_name": "Plots"
         }
     ]
 }
@@ -111,7 +132,8 @@ model.schemas['ETAS'].tables['Evaluation_Plot'].annotations[tag.visible_columns]
         "URL",
         {
             "display": {
-                "markdown_pattern": "[![{{{Filename}}}]({{{URL}}}){width=120}]({{{URL}}})"
+                "markdown_pattern": "[![{{{Filename}}}]({{#if Thumbnail_URL}}{{{Thumbnail_URL}}}{{else}}{{{URL}}}{{/if}}){width=120}]({{{URL}}})",
+                "template_engine": "handlebars"
             },
             "markdown_name": "Preview"
         }
@@ -127,7 +149,8 @@ model.schemas['ETAS'].tables['Evaluation_Plot'].annotations[tag.visible_columns]
         {
             "markdown_name": "Preview",
             "display": {
-                "markdown_pattern": "[![{{{Filename}}}]({{{URL}}}){width=120}]({{{URL}}})"
+                "markdown_pattern": "[![{{{Filename}}}]({{#if Thumbnail_URL}}{{{Thumbnail_URL}}}{{else}}{{{URL}}}{{/if}}){width=120}]({{{URL}}})",
+                "template_engine": "handlebars"
             }
         }
     ]
@@ -154,243 +177,18 @@ model.schemas['ETAS'].tables['Forecast'].annotations[tag.visible_foreign_keys] =
 
 # Bulk Upload Annotation --------------------------------------------------------------------------#
 
-# NOTE: this is not really intended for you to absorb right not. This is one of the most complicated
-#       annotations to set on the catalog. But I'm including it here for completeness of the catalog
-#       setup.
+# NOTE: the asset mappings live in scec_bulk_upload.py, so that local tools such as
+#       upload_planner.py can use them without connecting to the catalog.
 
-model.annotations[tag.bulk_upload] = {
-    "asset_mappings": [
-        {
-            "column_map": {
-                "Forecast_Name": "{forecast_name}",
-                "Forecast_Config_JSON": "{URI}"
-            },
-            "file_pattern": "^(?P<forecast_name>[^/]+)/config.json$",
-            "target_table": [
-                "ETAS",
-                "Forecast"
-            ],
-            "checksum_types": [
-                "md5"
-            ],
-            "hatrac_options": {
-                "versioned_uris": "True"
-            },
-            "hatrac_templates": {
-                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{file_name}"
-            },
-            "record_query_template": "/entity/{target_table}/Forecast_Name={forecast_name_urlencoded}/Forecast_Config_JSON={URI_urlencoded}",
-            "create_record_before_upload": "False"
-        },
-        {
-            "column_map": {
-                "Forecast": "{etas_forecast_rid}",
-                "URL": "{URI}",
-                "MD5": "{md5}",
-                "Filename": "{file_name}",
-                "Length": "{file_size}",
-            },
-            "file_pattern": "^(?P<forecast_name>[^/]+)/[^/]+[.](?P<ext>bin|slurm|slurm[.]e.*|slurm[.]o.*)$",
-            "target_table": [
-                "ETAS",
-                "Forecast_File"
-            ],
-            "checksum_types": [
-                "md5"
-            ],
-            "hatrac_options": {
-                "versioned_uris": "True"
-            },
-            "hatrac_templates": {
-                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{file_name}"
-            },
-            "metadata_query_templates": [
-                "/attribute/ETAS:Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1"
-            ],
-            "record_query_template": "/entity/{target_table}/URL={URI_urlencoded}",
-            "create_record_before_upload": "False"
-        },
-        {
-            "column_map": {
-                "Forecast": "{etas_forecast_rid}",
-                "Evaluation_Group_Name": "{evaluation_group_name}",
-                "README_md": "{URI}"
-            },
-            "file_pattern": "^(?P<forecast_name>[^/]+)/(?P<evaluation_group_name>[^/]+)/README.md$",
-            "target_table": [
-                "ETAS",
-                "Evaluation_Group"
-            ],
-            "checksum_types": [
-                "md5"
-            ],
-            "hatrac_options": {
-                "versioned_uris": "True"
-            },
-            "hatrac_templates": {
-                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{evaluation_group_name}/{file_name}"
-            },
-            "metadata_query_templates": [
-                "/attribute/ETAS:Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1"
-            ],
-            "record_query_template": "/entity/{target_table}/Evaluation_Group_Name={evaluation_group_name_urlencoded}",
-            "create_record_before_upload": "False"
-        },
-        {
-            "column_map": {
-                "Forecast": "{etas_forecast_rid}",
-                "Evaluation_Group_Name": "{evaluation_group_name}",
-                "Config_JSON": "{URI}"
-            },
-            "file_pattern": "^(?P<forecast_name>[^/]+)/(?P<evaluation_group_name>[^/]+)/config.json$",
-            "target_table": [
-                "ETAS",
-                "Evaluation_Group"
-            ],
-            "checksum_types": [
-                "md5"
-            ],
-            "hatrac_options": {
-                "versioned_uris": "True"
-            },
-            "hatrac_templates": {
-                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{evaluation_group_name}/{file_name}"
-            },
-            "metadata_query_templates": [
-                "/attribute/ETAS:Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1"
-            ],
-            "record_query_template": "/entity/{target_table}/Evaluation_Group_Name={evaluation_group_name_urlencoded}",
-            "create_record_before_upload": "False"
-        },
-        {
-            "column_map": {
-                "Forecast": "{etas_forecast_rid}",
-                "Evaluation_Group_Name": "{evaluation_group_name}",
-                "Meta_JSON": "{URI}"
-            },
-            "file_pattern": "^(?P<forecast_name>[^/]+)/(?P<evaluation_group_name>[^/]+)/meta.json$",
-            "target_table": [
-                "ETAS",
-                "Evaluation_Group"
-            ],
-            "checksum_types": [
-                "md5"
-            ],
-            "hatrac_options": {
-                "versioned_uris": "True"
-            },
-            "hatrac_templates": {
-                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{evaluation_group_name}/{file_name}"
-            },
-            "metadata_query_templates": [
-                "/attribute/ETAS:Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1"
-            ],
-            "record_query_template": "/entity/{target_table}/Evaluation_Group_Name={evaluation_group_name_urlencoded}",
-            "create_record_before_upload": "False"
-        },
-        {
-            "column_map": {
-                "Forecast": "{etas_forecast_rid}",
-                "Evaluation_Group_Name": "{evaluation_group_name}",
-                "Evaluation_Catalog_JSON": "{URI}"
-            },
-            "file_pattern": "^(?P<forecast_name>[^/]+)/(?P<evaluation_group_name>[^/]+)/evaluation_catalog.json$",
-            "target_table": [
-                "ETAS",
-                "Evaluation_Group"
-            ],
-            "checksum_types": [
-                "md5"
-            ],
-            "hatrac_options": {
-                "versioned_uris": "True"
-            },
-            "hatrac_templates": {
-                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{evaluation_group_name}/{file_name}"
-            },
-            "metadata_query_templates": [
-                "/attribute/ETAS:Forecast/Forecast_Name={forecast_name_urlencoded}/etas_forecast_rid:=RID?limit=1"
-            ],
-            "record_query_template": "/entity/{target_table}/Evaluation_Group_Name={evaluation_group_name_urlencoded}",
-            "create_record_before_upload": "False"
-        },
-        {
-            "column_map": {
-                "Evaluation_Group": "{etas_evaluation_group_rid}",
-                "Evaluation_Type": "{evaluation_type}",
-                "URL": "{URI}",
-                "MD5": "{md5}",
-                "Filename": "{file_name}",
-                "Length": "{file_size}",
-            },
-            "file_pattern": "^(?P<forecast_name>[^/]+)/(?P<evaluation_group_name>[^/]+)/results/(?P<evaluation_type>.+-test).*[.]json$",
-            "target_table": [
-                "ETAS",
-                "Evaluation"
-            ],
-            "checksum_types": [
-                "md5"
-            ],
-            "hatrac_options": {
-                "versioned_uris": "True"
-            },
-            "hatrac_templates": {
-                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{evaluation_group_name}/results/{file_name}"
-            },
-            "metadata_query_templates": [
-                "/attribute/ETAS:Evaluation_Group/Evaluation_Group_Name={evaluation_group_name_urlencoded}/etas_evaluation_group_rid:=RID?limit=1"
-            ],
-            "record_query_template": "/entity/{target_table}/URL={URI_urlencoded}",
-            "create_record_before_upload": "False"
-        },
-        {
-            "column_map": {
-                "Evaluation": "{etas_evaluation_rid}",
-                "URL": "{URI}",
-                "MD5": "{md5}",
-                "Filename": "{file_name}",
-                "Length": "{file_size}",
-            },
-            "file_pattern": "^(?P<forecast_name>[^/]+)/(?P<evaluation_group_name>[^/]+)/plots/(?P<basename>.+)[.]png",
-            "target_table": [
-                "ETAS",
-                "Evaluation_Plot"
-            ],
-            "checksum_types": [
-                "md5"
-            ],
-            "hatrac_options": {
-                "versioned_uris": "True"
-            },
-            "hatrac_templates": {
-                "hatrac_uri": "/hatrac/ETAS/Forecast/{forecast_name}/{evaluation_group_name}/plots/{file_name}"
-            },
-            "metadata_query_templates": [
-                "/attribute/ETAS:Evaluation/Filename={basename_urlencoded}.json/etas_evaluation_rid:=RID?limit=1"
-            ],
-            "record_query_template": "/entity/{target_table}/URL={URI_urlencoded}",
-            "create_record_before_upload": "False"
-        },
-    ],
-    "mime_overrides": {
-        "mime/type/goes/here": [
-            "file_ext_goes_here"
-        ]
-    },
-    "relative_path_validation": True,
-    "version_update_url": "https://github.com/informatics-isi-edu/deriva-client",
-    "version_compatibility": [
-        [
-            ">=1.0.0",
-            "<2.0.0"
-        ]
-    ]
-}
+model.annotations[tag.bulk_upload] = bulk_upload_annotation
 
 
 # Apply Changes ---------------------------------------------------------------------------------#
 
-model.apply()  # <-- after any acl or annotations changes, we have to 'apply()' to update the server
+# Only the elements whose annotations or acls differ from the live catalog are sent
+# (model.apply() would send every element again)
+stats = apply_changed(model, baseline)
+stats.report()
 
 # -----------------------------------------------------------------------------------------------#
 
@@ -1,28 +1,17 @@
 """Minimal example of a possible rendering of the ETAS starter model.
 """
-from deriva.core import DerivaServer, get_credential
+import sys
+import argparse
 from deriva.chisel import Model, Schema, Table, Column, Key, ForeignKey, builtin_types, tag
-
-# Connect to server and catalog ------------------------------------------------------------------#
-
-hostname = 'forecast.derivacloud.org'   # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
-catalog_id = '5'            # this was a throw-away catalog used to test this script (change to TBD)
-
-model = Model.from_catalog(
-    DerivaServer('https', hostname, credentials=get_credential(hostname)).connect_ermrest(catalog_id)
-)
-
-# Cleanup ----------------------------------------------------------------------------------------#
-
-if 'ETAS' in model.schemas:
-    # Purge anything so we can "do over" repeatedly at this point
-    model.schemas['ETAS'].drop(cascade=True)
-
+from model_cache import connect_catalog, load_model
+from schema_reconcile import plan_schema, print_plan, apply_changes
 
 # ETAS schema ------------------------------------------------------------------------------------#
 
-# Create the "schema" to organize tables in the catalog "model"
-model.create_schema(Schema.define('ETAS'))
+# The definitions below are the desired state of the "ETAS" schema, which organizes the tables in
+# the catalog "model". They are plain data, so other scripts can import them; running this script
+# reconciles the live catalog against them (see schema_reconcile.py).
+etas_table_defs = []
 
 
 # ETAS Forecast ----------------------------------------------------------------------------------#
@@ -30,7 +19,7 @@ model.create_schema(Schema.define('ETAS'))
 # Create the tables at the "Forecast" level of the table hierarchy
 
 # Forecast
-model.schemas['ETAS'].create_table(Table.define(  # <--- 'Table.define(...)' defines a general-purpose table
+etas_table_defs.append(Table.define(  # <--- 'Table.define(...)' defines a general-purpose table
     'Forecast',                                                             # table name
     column_defs=[                                                           # column definitions
         Column.define('Forecast_Name', builtin_types.text, nullok=False),   # column for the name of the forecast
@@ -49,7 +38,7 @@ model.schemas['ETAS'].create_table(Table.define(  # <--- 'Table.define(...)' def
 
 # Forecast_File
 #  This is for storing the 'forecast_config.json', 'slurm_log', 'slurm_stdout', and 'slurm_stderr'
-model.schemas['ETAS'].create_table(Table.define_asset(  # <--- 'Table.define_asset(...)' defines a table for storing files
+etas_table_defs.append(Table.define_asset(  # <--- 'Table.define_asset(...)' defines a table for storing files
     'ETAS', 'Forecast_File',                                            # schema_name, table_name
     column_defs=[                                                       # column definitions
         Column.define('Forecast', builtin_types.ermrest_rid)            # a key we will use as fkey column
@@ -68,7 +57,7 @@ model.schemas['ETAS'].create_table(Table.define_asset(  # <--- 'Table.define_ass
 # Create the tables at the "Evaluation" level of the table hierarchy
 
 # Evaluation_Group
-model.schemas['ETAS'].create_table(Table.define(
+etas_table_defs.append(Table.define(
     'Evaluation_Group',
     column_defs=[
         Column.define('Evaluation_Group_Name', builtin_types.text, nullok=False),   # evaluation group name
@@ -114,11 +103,15 @@ model.schemas['ETAS'].create_table(Table.define(
 
 # Evaluation
 #  This is for storing the result files (one file reference per row)
-model.schemas['ETAS'].create_table(Table.define_asset(
+etas_table_defs.append(Table.define_asset(
     'ETAS', 'Evaluation',
     column_defs=[
         Column.define('Evaluation_Group', builtin_types.ermrest_rid),        # foreign key columns
-        Column.define('Evaluation_Type', builtin_types.text)                # type of the evaluation
+        Column.define('Evaluation_Type', builtin_types.text),               # type of the evaluation
+        Column.define('Plot_Count', builtin_types.int4,                     # plot summary, see plot_summary.py
+                      comment="Number of plots of the evaluation"),
+        Column.define('Plot_Previews', builtin_types.jsonb,
+                      comment="Filename, URL and Thumbnail_URL of the first plots of the evaluation")
     ],
     fkey_defs=[
         ForeignKey.define(  # This FKey will reference the Evaluation table
@@ -131,10 +124,12 @@ model.schemas['ETAS'].create_table(Table.define_asset(
 
 # Evaluation_Plot
 #  This is for storing the plot files (one file reference per row)
-model.schemas['ETAS'].create_table(Table.define_asset(
+etas_table_defs.append(Table.define_asset(
     'ETAS', 'Evaluation_Plot',
     column_defs=[
         Column.define('Evaluation', builtin_types.ermrest_rid), # foreign key column
+        Column.define('Thumbnail_URL', builtin_types.text,      # small copy for previews, see plot_thumbnails.py
+                      comment="Hatrac URL of a thumbnail of the plot"),
     ],
     fkey_defs=[
         ForeignKey.define(  # This FKey will reference the Evaluation table
@@ -146,6 +141,37 @@ model.schemas['ETAS'].create_table(Table.define_asset(
 
 # -----------------------------------------------------------------------------------------------#
 
-print('Congratulations! You have created a DERIVA catalog model.')
-print('Run the scec_annotations.py to apply annotations to the catalog.')
-print('https://{hostname}/chaise/recordset/#{catalog_id}/ETAS:Forecast'.format(hostname=hostname, catalog_id=catalog_id))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or update the ETAS schema to match the definitions above")
+    parser.add_argument("--dry-run", action="store_true", help="print the changes without applying them")
+    parser.add_argument("--drop", action="store_true",
+                        help="drop the ETAS schema (and all of its data) and create it from scratch")
+    args = parser.parse_args()
+
+    # Connect to server and catalog --------------------------------------------------------------#
+
+    hostname = 'forecast.derivacloud.org'   # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
+    catalog_id = '5'            # this was a throw-away catalog used to test this script (change to TBD)
+
+    catalog = connect_catalog(hostname, catalog_id)
+    model = load_model(catalog)   # cached locally, revalidated with one request
+
+    # Cleanup ------------------------------------------------------------------------------------#
+
+    if args.drop and 'ETAS' in model.schemas and not args.dry_run:
+        # Purge anything so we can "do over" repeatedly at this point
+        model.schemas['ETAS'].drop(cascade=True)
+
+    # Reconcile ----------------------------------------------------------------------------------#
+
+    # Only the tables, columns, keys, foreign keys and annotations that are missing or differ
+    # are changed. Nothing is dropped, so existing data is kept.
+    changes = plan_schema(model, 'ETAS', etas_table_defs)
+    print_plan(changes)
+    if args.dry_run:
+        sys.exit(0)
+    apply_changes(changes)
+
+    print('Congratulations! You have created a DERIVA catalog model.')
+    print('Run the scec_config.py to apply annotations to the catalog.')
+    print('https://{hostname}/chaise/recordset/#{catalog_id}/ETAS:Forecast'.format(hostname=hostname, catalog_id=catalog_id))
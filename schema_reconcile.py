@@ -0,0 +1,221 @@
+"""schema_reconcile.py: Declarative reconciliation of a catalog schema against its desired definition.
+
+scec_model.py and create_erd.py used to drop the ETAS schema with cascade and rebuild every table,
+which deletes all of the data. Instead, the desired definition (the Table.define / Column.define /
+Key.define / ForeignKey.define documents the scripts already build) is diffed against the live
+model, and only the missing or changed pieces are applied:
+
+  * missing schemas and tables are created (a new table brings its columns, keys and fkeys along)
+  * missing columns, keys and foreign keys are added to existing tables
+  * nullok and default changes are applied to existing columns
+  * annotation tags and comments named in the definition are set where they differ; annotation
+    tags that only exist on the live element (e.g. from scec_config.py) are left alone
+
+Nothing is ever dropped. Differences that would need data migration (a column type change) and
+live tables and columns that are not in the definition are reported, not changed.
+
+The plan is a list of Change objects, which can be printed (dry run) before it is applied.
+"""
+from dataclasses import dataclass
+from deriva.chisel import Schema
+from annotation_apply import put_annotations
+
+@dataclass
+class Change:
+    description: str
+    apply: object = None    # callable, or None for a difference that is only reported
+
+    @property
+    def manual(self):
+        return self.apply is None
+
+def _put_annotations(element, tags):
+    element.annotations.update(tags)
+    put_annotations(element)
+
+def _put_comment(element, comment):
+    element.comment = comment
+    element.catalog.put(element.uri_path + "/comment", data=comment.encode("utf-8"))
+
+def plan_element(element, label, definition):
+    """
+    Compare the annotations and comment of one live element with its definition
+    :param element: live model element
+    :param label: name used in the change descriptions
+    :param definition: definition document (from Table.define, Column.define, ...)
+    :return: list of Change
+    """
+    changes = []
+    tags = {tag: value for tag, value in (definition.get("annotations") or {}).items()
+            if element.annotations.get(tag) != value}
+    if tags:
+        changes.append(Change("set annotations {0} on {1}".format(sorted(tags), label),
+                              lambda: _put_annotations(element, tags)))
+    comment = definition.get("comment")
+    if comment is not None and element.comment != comment:
+        changes.append(Change("set comment on {0}".format(label), lambda: _put_comment(element, comment)))
+    return changes
+
+def plan_columns(table, column_defs, report_extra=True):
+    """
+    :param table: live table
+    :param column_defs: list of Column.define documents
+    :param report_extra: report live columns that are not in column_defs
+    :return: list of Change
+    """
+    changes = []
+    live = {column.name: column for column in table.columns}
+    for cdef in column_defs:
+        name = cdef["name"]
+        label = "column {0}:{1}.{2}".format(table.schema.name, table.name, name)
+        column = live.get(name)
+        if column is None:
+            changes.append(Change("create " + label, lambda cdef=cdef: table.create_column(cdef)))
+            continue
+        if column.type.typename != cdef["type"]["typename"]:
+            changes.append(Change("{0} is {1}, defined as {2} (needs a manual migration)".format(
+                label, column.type.typename, cdef["type"]["typename"])))
+        alterations = {}
+        if "nullok" in cdef and column.nullok != cdef["nullok"]:
+            alterations["nullok"] = cdef["nullok"]
+        if cdef.get("default") is not None and column.default != cdef["default"]:
+            alterations["default"] = cdef["default"]
+        if alterations:
+            changes.append(Change("alter {0} {1}".format(label, alterations),
+                                  lambda column=column, alterations=alterations: column.alter(**alterations)))
+        changes.extend(plan_element(column, label, cdef))
+    defined = {cdef["name"] for cdef in column_defs}
+    for name in live:
+        if report_extra and name not in defined and name not in ("RID", "RCT", "RMT", "RCB", "RMB"):
+            changes.append(Change("column {0}:{1}.{2} is not in the definition (kept)".format(
+                table.schema.name, table.name, name)))
+    return changes
+
+def _key_signature(columns):
+    return frozenset(columns)
+
+def plan_keys(table, key_defs):
+    """
+    :param table: live table
+    :param key_defs: list of Key.define documents
+    :return: list of Change
+    """
+    changes = []
+    live = {_key_signature(column.name for column in key.unique_columns): key for key in table.keys}
+    for kdef in key_defs:
+        signature = _key_signature(kdef["unique_columns"])
+        label = "key {0}:{1}({2})".format(table.schema.name, table.name, ", ".join(kdef["unique_columns"]))
+        key = live.get(signature)
+        if key is None:
+            changes.append(Change("create " + label, lambda kdef=kdef: table.create_key(kdef)))
+        else:
+            changes.extend(plan_element(key, label, kdef))
+    return changes
+
+def _fkey_signature(fk_columns, ref_schema, ref_table, ref_columns):
+    return tuple(fk_columns), ref_schema, ref_table, tuple(ref_columns)
+
+def plan_fkeys(table, fkey_defs):
+    """
+    :param table: live table
+    :param fkey_defs: list of ForeignKey.define documents
+    :return: list of Change
+    """
+    changes = []
+    live = {}
+    for fkey in table.foreign_keys:
+        ref = fkey.referenced_columns[0].table
+        live[_fkey_signature([c.name for c in fkey.foreign_key_columns], ref.schema.name, ref.name,
+                             [c.name for c in fkey.referenced_columns])] = fkey
+    for fkdef in fkey_defs:
+        ref = fkdef["referenced_columns"][0]
+        fk_columns = [c["column_name"] for c in fkdef["foreign_key_columns"]]
+        signature = _fkey_signature(fk_columns, ref["schema_name"], ref["table_name"],
+                                    [c["column_name"] for c in fkdef["referenced_columns"]])
+        label = "fkey {0}:{1}({2}) -> {3}:{4}".format(table.schema.name, table.name, ", ".join(fk_columns),
+                                                     ref["schema_name"], ref["table_name"])
+        fkey = live.get(signature)
+        if fkey is None:
+            changes.append(Change("create " + label, lambda fkdef=fkdef: table.create_fkey(fkdef)))
+        else:
+            changes.extend(plan_element(fkey, label, fkdef))
+    return changes
+
+def plan_table(schema, tdef):
+    """
+    :param schema: live schema
+    :param tdef: Table.define (or define_asset, define_vocabulary) document
+    :return: list of Change
+    """
+    tname = tdef["table_name"]
+    if tname not in schema.tables:
+        return [Change("create table {0}:{1}".format(schema.name, tname),
+                       lambda: schema.create_table(tdef))]
+    table = schema.tables[tname]
+    changes = []
+    changes.extend(plan_columns(table, tdef.get("column_definitions", [])))
+    changes.extend(plan_keys(table, tdef.get("keys", [])))
+    changes.extend(plan_fkeys(table, tdef.get("foreign_keys", [])))
+    changes.extend(plan_element(table, "table {0}:{1}".format(schema.name, tname), tdef))
+    return changes
+
+def plan_schema(model, schema_name, table_defs, schema_annotations=None, report_extra=True):
+    """
+    Diff the desired tables of one schema against the live model
+    :param model: live Model
+    :param schema_name:
+    :param table_defs: list of table definition documents, in dependency order
+    :param schema_annotations: optional dict of annotation tags for the schema itself
+    :param report_extra: report live tables that are not in table_defs
+    :return: list of Change
+    """
+    if schema_name not in model.schemas:
+        # the tables can only be planned once the schema exists, so plan them lazily
+        def create_all():
+            model.create_schema(Schema.define(schema_name, annotations=schema_annotations or {}))
+            for tdef in table_defs:
+                model.schemas[schema_name].create_table(tdef)
+        names = ", ".join(tdef["table_name"] for tdef in table_defs)
+        return [Change("create schema {0} with tables {1}".format(schema_name, names), create_all)]
+
+    schema = model.schemas[schema_name]
+    changes = []
+    if schema_annotations:
+        changes.extend(plan_element(schema, "schema " + schema_name, {"annotations": schema_annotations}))
+    for tdef in table_defs:
+        changes.extend(plan_table(schema, tdef))
+    defined = {tdef["table_name"] for tdef in table_defs}
+    for name in schema.tables:
+        if report_extra and name not in defined:
+            changes.append(Change("table {0}:{1} is not in the definition (kept)".format(schema_name, name)))
+    return changes
+
+def print_plan(changes):
+    """
+    Print a plan, separating the changes that will be applied from the ones that are only reported
+    :param changes: list of Change
+    :return:
+    """
+    todo = [change for change in changes if not change.manual]
+    notes = [change for change in changes if change.manual]
+    if not todo:
+        print("Schema is up to date, nothing to apply")
+    for change in todo:
+        print("  + " + change.description)
+    for change in notes:
+        print("  ! " + change.description)
+
+def apply_changes(changes):
+    """
+    Apply the changes of a plan, in order
+    :param changes: list of Change
+    :return: number of changes applied
+    """
+    applied = 0
+    for change in changes:
+        if change.manual:
+            continue
+        change.apply()
+        applied += 1
+    print("Applied {0} schema changes".format(applied))
+    return applied
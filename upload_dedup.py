@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+
+"""upload_dedup.py: This script drops files from an upload plan when the catalog already holds
+the same asset under the same parent, so re-running an ingest over a partially uploaded
+forecast tree does not send those files again.
+
+The asset tables that record MD5 and Length (Forecast_File, Evaluation and Evaluation_Plot)
+are read for just the forecasts named in the plan, with a few bulk attribute queries that
+join down from ETAS:Forecast, together with the Evaluation_Group and Evaluation rows that
+name each asset's parent. Every asset becomes a (forecast name, evaluation group name,
+Filename, MD5, Length) key in one hash set per table, and a planned file is removed before
+any bytes move only when its own key is in the set for its target table. Identical content
+under another forecast or evaluation group (e.g. empty slurm.e* files, or the same plot in
+two forecasts) is still uploaded and registered under its own parent. The number of files
+and bytes avoided is reported.
+"""
+import os
+import sys
+import argparse
+from dataclasses import dataclass
+from deriva.core import urlquote
+from model_cache import connect_catalog
+from upload_planner import AssetMatcher, load_asset_mappings
+from forecast_scanner import manifest_plan
+from checksum_cache import ChecksumCache, DEFAULT_CACHE_FILE
+
+#
+# Queries below ETAS:Forecast (path, projection) for the parent rows and the asset rows
+PARENT_QUERIES = {
+    "forecasts": ([], "RID,Forecast_Name"),
+    "groups": (["ETAS:Evaluation_Group"], "RID,Forecast,Evaluation_Group_Name"),
+    "evaluations": (["ETAS:Evaluation_Group", "ETAS:Evaluation"], "RID,Evaluation_Group"),
+}
+ASSET_QUERIES = {
+    ("ETAS", "Forecast_File"): (["ETAS:Forecast_File"], "Forecast,Filename,MD5,Length"),
+    ("ETAS", "Evaluation"): (["ETAS:Evaluation_Group", "ETAS:Evaluation"], "Evaluation_Group,Filename,MD5,Length"),
+    ("ETAS", "Evaluation_Plot"): (["ETAS:Evaluation_Group", "ETAS:Evaluation", "ETAS:Evaluation_Plot"],
+                                  "Evaluation,Filename,MD5,Length"),
+}
+
+#
+# Keep the bulk query URLs well under common server and proxy limits
+MAX_URL_LENGTH = 4000
+
+@dataclass
+class DedupStats:
+    files_checked: int = 0
+    files_skipped: int = 0
+    bytes_avoided: int = 0
+    requests: int = 0
+
+    def report(self):
+        """
+        Print how much transfer the dedup stage avoided
+        :return:
+        """
+        print("Dedup: {0} of {1} files already in the catalog, {2:.1f} MB of transfer avoided "
+              "({3} catalog requests)".format(self.files_skipped, self.files_checked,
+                                              self.bytes_avoided / (1024 * 1024), self.requests))
+
+def _forecast_filters(forecast_names, fixed_length):
+    """
+    Split the forecast names into Forecast_Name disjunctions that keep each URL short
+    :param forecast_names: iterable of names
+    :param fixed_length: length of the rest of the URL
+    :return: generator of filter strings
+    """
+    filters = []
+    length = fixed_length
+    for name in sorted(forecast_names):
+        term = "Forecast_Name={0}".format(urlquote(name))
+        if filters and length + len(term) + 1 > MAX_URL_LENGTH:
+            yield ";".join(filters)
+            filters = []
+            length = fixed_length
+        filters.append(term)
+        length += len(term) + 1
+    if filters:
+        yield ";".join(filters)
+
+def _query_urls(forecast_names, queries):
+    """
+    :param forecast_names: iterable of Forecast_Name values
+    :param queries: dict of query name -> (joins below ETAS:Forecast, projection)
+    :return: generator of (query name, URL) for every query and every chunk of forecast names
+    """
+    suffixes = {name: "".join("/" + join for join in joins) + "/" + columns
+                for name, (joins, columns) in queries.items()}
+    fixed_length = len("/attribute/ETAS:Forecast/") + max(len(suffix) for suffix in suffixes.values())
+    for filters in _forecast_filters(forecast_names, fixed_length):
+        for name, suffix in suffixes.items():
+            yield name, "/attribute/ETAS:Forecast/" + filters + suffix
+
+def asset_key(forecast_name, evaluation_group_name, filename, md5, length):
+    """
+    :return: the key an asset is deduplicated on: its parent, its Filename and its content
+    """
+    return forecast_name, evaluation_group_name, filename, md5, int(length)
+
+def fetch_existing_assets(catalog, forecast_names, stats=None):
+    """
+    Read the assets already in the asset tables for the given forecasts
+    :param catalog: ErmrestCatalog
+    :param forecast_names: iterable of Forecast_Name values
+    :param stats: DedupStats to count requests in, optional
+    :return: dict of (schema, table) -> set of asset_key tuples
+    """
+    forecast_names = set(forecast_names)
+    if not forecast_names:
+        return {target: set() for target in ASSET_QUERIES}
+    queries = dict(PARENT_QUERIES)
+    queries.update(ASSET_QUERIES)
+    rows = {name: [] for name in queries}
+    for name, url in _query_urls(forecast_names, queries):
+        if stats is not None:
+            stats.requests += 1
+        rows[name].extend(catalog.get(url).json())
+
+    # Forecast RID -> name, Evaluation_Group RID -> (forecast name, group name), Evaluation RID -> same
+    forecasts = {row["RID"]: row["Forecast_Name"] for row in rows["forecasts"]}
+    groups = {row["RID"]: (forecasts.get(row["Forecast"]), row["Evaluation_Group_Name"]) for row in rows["groups"]}
+    evaluations = {row["RID"]: groups.get(row["Evaluation_Group"], (None, None)) for row in rows["evaluations"]}
+    parents = {
+        ("ETAS", "Forecast_File"): lambda row: (forecasts.get(row["Forecast"]), None),
+        ("ETAS", "Evaluation"): lambda row: groups.get(row["Evaluation_Group"], (None, None)),
+        ("ETAS", "Evaluation_Plot"): lambda row: evaluations.get(row["Evaluation"], (None, None)),
+    }
+    existing = {}
+    for target in ASSET_QUERIES:
+        keys = existing.setdefault(target, set())
+        for row in rows[target]:
+            forecast_name, group_name = parents[target](row)
+            if forecast_name is not None and row["MD5"] is not None and row["Length"] is not None:
+                keys.add(asset_key(forecast_name, group_name, row["Filename"], row["MD5"], row["Length"]))
+    return existing
+
+def dedup_plan(records, plan, asset_mappings, checksums, existing, root, stats=None):
+    """
+    Remove the planned files that are already recorded in their target table, under the same
+    forecast (and evaluation group), with the same Filename, MD5 and length
+    :param records: list of ManifestRecord
+    :param plan: list of PlanEntry, in the same order as records
+    :param asset_mappings: list of asset mapping dicts
+    :param checksums: dict of local path -> md5 hex
+    :param existing: dict from fetch_existing_assets
+    :param root: scanned root of the manifest
+    :param stats: DedupStats to fill in, optional
+    :return: tuple of (records, plan) still to upload
+    """
+    if stats is None:
+        stats = DedupStats()
+    keep_records = []
+    keep_plan = []
+    for rec, entry in zip(records, plan):
+        stats.files_checked += 1
+        target = tuple(asset_mappings[entry.mapping]["target_table"])
+        md5 = checksums[os.path.join(root, rec.path)]
+        key = asset_key(entry.groups["forecast_name"], entry.groups.get("evaluation_group_name"),
+                        os.path.basename(rec.path), md5, rec.size)
+        if key in existing.get(target, ()):
+            stats.files_skipped += 1
+            stats.bytes_avoided += rec.size
+            continue
+        keep_records.append(rec)
+        keep_plan.append(entry)
+    return keep_records, keep_plan
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report which files of a manifest are already in the catalog")
+    parser.add_argument("manifest", help="manifest written by forecast_scanner.py")
+    parser.add_argument("--checksum-cache", default=DEFAULT_CACHE_FILE,
+                        help="checksum cache file (default: %(default)s)")
+    parser.add_argument("--list", action="store_true", help="print the files that still need uploading")
+    args = parser.parse_args()
+
+    hostname = 'forecast.derivacloud.org'  # this is a dev server for throw-away work (change to 'forecast.derivacloud.org)
+    catalog_id = '5'  # this was a throw-away catalog used to test this script (change to TBD)
+
+    asset_mappings = load_asset_mappings()
+    root, records, plan = manifest_plan(args.manifest, AssetMatcher(asset_mappings))
+
+    cache = ChecksumCache(args.checksum_cache)
+    checksums = cache.checksum_files(os.path.join(root, rec.path) for rec in records)
+    cache.close()
+
+    catalog = connect_catalog(hostname, catalog_id)
+    stats = DedupStats()
+    existing = fetch_existing_assets(catalog, {entry.groups["forecast_name"] for entry in plan}, stats)
+    records, plan = dedup_plan(records, plan, asset_mappings, checksums, existing, root, stats)
+
+    if args.list:
+        for rec in records:
+            print(rec.path)
+    stats.report()
+
+    sys.exit(0)
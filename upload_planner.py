@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+
+"""upload_planner.py: This script classifies every file in a SCEC ETAS forecast output tree
+using the asset_mappings of the bulk_upload annotation, and builds an upload plan.
+
+The bulk uploader checks each mapping's file_pattern regex against each path. Our forecast
+trees hold millions of .bin, slurm, results and plots files, so here all of the patterns
+are compiled into one matcher (a single alternation, with the named groups of each mapping
+renamed so they do not collide) and the whole tree is classified in one pass.
+
+The asset mappings are read from scec_bulk_upload.py, or from the live catalog with --catalog.
+"""
+import os
+import re
+import sys
+import time
+import argparse
+from dataclasses import dataclass
+from deriva.chisel import tag
+from model_cache import connect_catalog, load_model
+from scec_bulk_upload import bulk_upload_annotation
+
+_GROUP_RE = re.compile(r"\(\?P<(\w+)>")
+_BACKREF_RE = re.compile(r"\(\?P=(\w+)\)")
+
+@dataclass
+class PlanEntry:
+    path: str
+    mapping: int
+    groups: dict
+
+class AssetMatcher:
+    """
+    All of the asset mapping file_patterns compiled into one regex. Matching a path gives
+    the same result as trying each file_pattern in order and keeping the first that matches.
+    """
+    def __init__(self, asset_mappings):
+        self.asset_mappings = list(asset_mappings)
+        alternatives = []
+        self._group_names = []
+        for idx, mapping in enumerate(self.asset_mappings):
+            pattern = mapping["file_pattern"]
+            if pattern.startswith("^"):
+                pattern = pattern[1:]
+            prefix = "_m{0}_".format(idx)
+            names = _GROUP_RE.findall(pattern)
+            pattern = _GROUP_RE.sub(lambda m: "(?P<{0}{1}>".format(prefix, m.group(1)), pattern)
+            pattern = _BACKREF_RE.sub(lambda m: "(?P={0}{1})".format(prefix, m.group(1)), pattern)
+            alternatives.append("(?P<_m{0}>{1})".format(idx, pattern))
+            self._group_names.append([(prefix + name, name) for name in names])
+        self._regex = re.compile("^(?:" + "|".join(alternatives) + ")")
+        # the wrapper group of each alternative is the last group to close, so
+        # lastindex of a match identifies the mapping that matched
+        self._mapping_by_group = {self._regex.groupindex["_m{0}".format(idx)]: idx
+                                  for idx in range(len(self.asset_mappings))}
+
+    def match(self, path):
+        """
+        Classify one path, relative to the root of the upload tree and using / separators
+        :param path:
+        :return: tuple of (mapping index, dict of captured groups), or None if no mapping matches
+        """
+        m = self._regex.match(path)
+        if m is None:
+            return None
+        idx = self._mapping_by_group[m.lastindex]
+        groups = {}
+        for renamed, name in self._group_names[idx]:
+            value = m.group(renamed)
+            if value is not None:
+                groups[name] = value
+        return idx, groups
+
+def load_asset_mappings(hostname=None, catalog_id=None):
+    """
+    Load the asset mappings, from the live catalog if a hostname is given, otherwise
+    from the annotation defined in scec_bulk_upload.py
+    :param hostname:
+    :param catalog_id:
+    :return: list of asset mapping dicts
+    """
+    if hostname is None:
+        return bulk_upload_annotation["asset_mappings"]
+    model = load_model(connect_catalog(hostname, catalog_id))
+    return model.annotations[tag.bulk_upload]["asset_mappings"]
+
+def iter_tree(root):
+    """
+    Walk an upload tree
+    :param root: top of the tree, the directory that holds the forecast directories
+    :return: generator of paths relative to root, using / separators
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        if rel_dir == ".":
+            prefix = ""
+        else:
+            prefix = rel_dir.replace(os.sep, "/") + "/"
+        for filename in filenames:
+            yield prefix + filename
+
+def plan_paths(paths, matcher):
+    """
+    Classify paths into an upload plan
+    :param paths: iterable of relative paths
+    :param matcher: AssetMatcher
+    :return: tuple of (list of PlanEntry, number of paths that matched no mapping)
+    """
+    plan = []
+    unmatched = 0
+    match = matcher.match
+    for path in paths:
+        result = match(path)
+        if result is None:
+            unmatched += 1
+        else:
+            plan.append(PlanEntry(path, result[0], result[1]))
+    return plan, unmatched
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify a forecast output tree into a bulk upload plan")
+    parser.add_argument("root", help="directory holding the <forecast_name> directories")
+    parser.add_argument("--catalog", nargs=2, metavar=("HOSTNAME", "CATALOG_ID"),
+                        help="load the asset mappings from this catalog instead of scec_bulk_upload.py")
+    parser.add_argument("--list", action="store_true", help="print every planned file and its captured groups")
+    args = parser.parse_args()
+
+    if args.catalog:
+        asset_mappings = load_asset_mappings(*args.catalog)
+    else:
+        asset_mappings = load_asset_mappings()
+    matcher = AssetMatcher(asset_mappings)
+
+    start = time.perf_counter()
+    paths = list(iter_tree(args.root))
+    walked = time.perf_counter()
+    plan, unmatched = plan_paths(paths, matcher)
+    done = time.perf_counter()
+
+    if args.list:
+        for entry in plan:
+            print(entry.path, "/".join(asset_mappings[entry.mapping]["target_table"]), entry.groups)
+
+    counts = {}
+    for entry in plan:
+        counts[entry.mapping] = counts.get(entry.mapping, 0) + 1
+    for idx in sorted(counts):
+        print("Mapping {0} ({1}): {2} files".format(idx, ":".join(asset_mappings[idx]["target_table"]), counts[idx]))
+    print("Unmatched files:", unmatched)
+
+    match_time = done - walked
+    rate = len(paths) / match_time if match_time > 0 else 0.0
+    print("Walked {0} paths in {1:.3f} s, classified in {2:.3f} s ({3:.0f} paths/s)".format(
+        len(paths), walked - start, match_time, rate))
+
+    sys.exit(0)